@@ -0,0 +1,91 @@
+'''Batch runner of Macrotracking, the traces are processed in parallel worker processes'''
+import os
+import csv
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from file_handlers import data_loader
+from utils.utils import Utils
+
+
+config = Utils.get_config()
+logger = Utils.get_logger()
+
+
+def process_trace(trace_name:str, profile:bool = False, force:bool = False) -> dict:
+    '''Worker: runs one trace with its own log, a failure is returned as a result'''
+    start_time = time.perf_counter()
+    try:
+        output_folder = data_loader.get_output_folder(trace_name)
+        Utils.create_folder(output_folder)
+        Utils.redirect_log(output_folder)
+
+        # imported here, the main module reads the config and creates the logger when loaded
+        import main
+        if profile:
+            main.Profiler.configure(True)
+        result = main.run_trace(trace_name, force=force)
+        result["status"] = "ok"
+        return result
+
+    except Exception as exception:
+        Utils.get_logger().error(f"Trace {trace_name} failed: {exception}\n{traceback.format_exc()}")
+        return {"trace": trace_name, "status": "failed", "error": repr(exception), "runtime": time.perf_counter() - start_time}
+
+
+def run_batch(trace_names, workers:int, profile:bool = False, force:bool = False) -> list:
+    '''Process the traces on a process pool, returns the results in the order of trace_names'''
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_trace, trace_name, profile, force): trace_name for trace_name in trace_names}
+        for future in as_completed(futures):
+            trace_name = futures[future]
+            try:
+                results[trace_name] = future.result()
+            except Exception as exception:
+                # the worker process itself died
+                results[trace_name] = {"trace": trace_name, "status": "failed", "error": repr(exception)}
+            logger.info(f"Trace {trace_name} finished with status: {results[trace_name]['status']}")
+
+    return [results[trace_name] for trace_name in trace_names]
+
+
+def write_summary(results, output_root:str):
+    '''Summary of all traces as JSON (complete) and CSV (main values)'''
+    with open(os.path.join(output_root, "batch_summary.json"), "w") as summary_file:
+        json.dump(results, summary_file, indent=2)
+
+    columns = ["trace", "status", "messages", "states", "total_distance", "end_distance",
+               "distance", "std_dev_of_distance", "p95", "max", "frechet", "runtime", "error"]
+    with open(os.path.join(output_root, "batch_summary.csv"), "w", newline='') as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            row = dict(result)
+            metrics = result.get("metrics") or {}
+            row["p95"] = metrics.get("closest_point", {}).get("p95")
+            row["max"] = metrics.get("closest_point", {}).get("max")
+            row["frechet"] = metrics.get("frechet")
+            writer.writerow(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run macrotracking on many traces in parallel.")
+    parser.add_argument("traces", nargs="*", help="trace names of the catalog (default: every trace)")
+    parser.add_argument("-w", "--workers", type=int, default=config.getint("Batch", "workers", fallback=os.cpu_count()),
+                        help="number of worker processes")
+    parser.add_argument("--profile", action="store_true", help="write a profile.json report for every trace")
+    parser.add_argument("--force", action="store_true", help="process the traces even if their inputs are unchanged")
+    args = parser.parse_args()
+
+    trace_names = args.traces if args.traces else data_loader.trace_names()
+    logger.info(f"Running batch of {len(trace_names)} traces on {args.workers} workers.")
+
+    batch_start = time.perf_counter()
+    batch_results = run_batch(trace_names, args.workers, args.profile, args.force)
+    write_summary(batch_results, config['File_locations']['output_root'])
+
+    failed = [result["trace"] for result in batch_results if result["status"] != "ok"]
+    logger.info(f"Batch finished in {time.perf_counter() - batch_start:.1f} s, {len(batch_results) - len(failed)} ok, {len(failed)} failed {failed}.")
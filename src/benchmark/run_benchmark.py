@@ -0,0 +1,222 @@
+'''Benchmark of the macrotracking stages on synthetic traces and road grids, runs offline'''
+import os
+import json
+import shutil
+import argparse
+import platform
+import subprocess
+from benchmark.synthetic_trace import DEFAULT_RATES, generate_trace
+from benchmark.synthetic_map import SyntheticGraphCache
+from file_handlers.file_handlers import TrajectoryFileHandler, TRAJECTORY_FILE
+from map.map import Map
+from map.postition import Position
+from map.projection import Projection
+from plot import plot_generator
+from trace_handler.trace_reader import TraceFileReader
+from trace_handler.trace_cache import TraceCache
+from trace_handler.trace_comparator import compare_trajectories
+from vehicle.vehicle_model import Vehicle
+from utils.utils import Utils
+from utils.profiler import Profiler
+
+
+config = Utils.get_config()
+logger = Utils.get_logger()
+
+START_LATITUDE = 47.4723
+START_LONGITUDE = 19.0594
+START_HEADING = 0  # along the x axis of the grid
+
+STAGES = ("generate", "parsing", "parsing_line", "trace_cache_build", "parsing_cached", "dead_reckoning",
+          "message_model", "map_correction", "output", "location_log", "comparison", "plot")
+
+
+def parse_size(text:str) -> int:
+    '''Number of messages, with k, M or G suffix (e.g. 100k, 10M)'''
+    multipliers = {"k": 10 ** 3, "m": 10 ** 6, "g": 10 ** 9}
+    text = text.strip()
+    if text[-1].lower() in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1].lower()])
+    return int(text)
+
+
+def parse_mix(text:str) -> dict:
+    '''Message mix as comma separated id:rate pairs, e.g. 0x180:100,0x410:50,0x280:200'''
+    rates = {}
+    for item in text.split(","):
+        arbitration_id, rate = item.split(":")
+        rates[int(arbitration_id, 16)] = float(rate)
+    return rates
+
+
+def get_commit() -> str:
+    '''Current commit of the repository, marked if the tree has uncommitted changes'''
+    repository = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repository,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repository,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def new_vehicle(trace_file:str, map_based_correction:bool) -> Vehicle:
+    car = Vehicle(Position(longitude=START_LONGITUDE, latitude=START_LATITUDE), START_HEADING, trace_file)
+    car.perform_map_based_correction = map_based_correction
+    return car
+
+
+def process_frames(car:Vehicle, columns):
+    '''The per message path of the vehicle model on column arrays'''
+    if car.last_update_time == 0 and columns.first_timestamp is not None:
+        car.last_update_time = columns.first_timestamp
+    payload = columns.data.tobytes()
+    for i, (timestamp, arbitration_id) in enumerate(zip(columns.timestamp.tolist(), columns.arbitration_id.tolist())):
+        car.process_frame(timestamp, arbitration_id, payload[8*i:8*i+8])
+
+
+def run_size(messages:int, args) -> dict:
+    '''Time every stage on a trace of the given length, returns the profiler report'''
+    Profiler.reset()
+    mix = "_".join(f"{arbitration_id:x}-{rate:g}" for arbitration_id, rate in sorted(args.mix.items()))
+    trace_file = os.path.join(args.data_folder, f"synthetic_{messages}_{args.seed}_{mix}.log")
+    output_folder = os.path.join(args.data_folder, f"output_{messages}/")
+    os.makedirs(output_folder, exist_ok=True)
+
+    if not os.path.isfile(trace_file):
+        with Profiler.stage("generate"):
+            generate_trace(trace_file, messages, rates=args.mix, seed=args.seed)
+
+    # the text parsers are measured without the binary cache
+    cache = TraceCache(trace_file)
+    shutil.rmtree(cache.cache_folder, ignore_errors=True)
+    reader = TraceFileReader(trace_file)
+
+    with Profiler.stage("parsing"):
+        columns = reader.read_columns(Vehicle.used_arbitration_ids)
+
+    if messages <= args.line_limit:
+        with Profiler.stage("parsing_line"):
+            for _ in reader.read_line():
+                pass
+
+    with Profiler.stage("trace_cache_build"):
+        cache.build(reader.iter_column_chunks())
+    with Profiler.stage("parsing_cached"):
+        TraceFileReader(trace_file).read_columns(Vehicle.used_arbitration_ids)
+
+    dead_reckoning = new_vehicle(trace_file, False)
+    with Profiler.stage("dead_reckoning"):
+        dead_reckoning.process_can_columns(columns)
+
+    if messages <= args.line_limit:
+        with Profiler.stage("message_model"):
+            process_frames(new_vehicle(trace_file, False), columns)
+
+    tracked = dead_reckoning
+    if messages <= args.correction_limit:
+        tracked = new_vehicle(trace_file, True)
+        map_cache = os.path.join(output_folder, "map_cache/")
+        shutil.rmtree(map_cache, ignore_errors=True)
+        tracked.map = Map(graph_cache=SyntheticGraphCache(START_LATITUDE, START_LONGITUDE, args.grid_spacing, cache_folder=map_cache))
+        with Profiler.stage("map_correction"):
+            tracked.map.update_map(tracked.position)
+            tracked.process_can_columns(columns)
+        if tracked.map.snap_cache is not None:
+            tracked.map.snap_cache.save()
+
+    with Profiler.stage("output"):
+        tracked.save_trajectory(output_folder + TRAJECTORY_FILE)
+    if messages <= args.line_limit:
+        with Profiler.stage("location_log"):
+            tracked.dump_states_to_files(output_folder + "location.log")
+
+    # the dead reckoning trajectory stands in for the ground truth,
+    # short traces may end before the car starts (no states to compare)
+    mean_distance = None
+    with Profiler.stage("comparison"):
+        xs, ys = TrajectoryFileHandler(output_folder + TRAJECTORY_FILE).read_xy()
+        if len(xs) > 0 and len(dead_reckoning.trajectory) > 0:
+            metrics, _, _ = compare_trajectories(dead_reckoning.trajectory.column("x"), dead_reckoning.trajectory.column("y"), xs, ys)
+            mean_distance = metrics["closest_point"]["mean"]
+
+    if len(xs) > 0:
+        with Profiler.stage("plot"):
+            plot_generator.generate_plot(output_folder)
+
+    report = Profiler.report()
+    report["messages"] = messages
+    report["model_frames"] = len(columns.index)
+    report["states"] = len(tracked.trajectory)
+    report["mean_distance_to_dead_reckoning"] = mean_distance
+    return report
+
+
+def compare_results(results:dict, reference:dict):
+    '''Log the stage times next to the ones of an earlier result file'''
+    logger.info(f"Comparison with {reference['commit']}:")
+    for size, report in results["results"].items():
+        reference_report = reference["results"].get(size)
+        if reference_report is None:
+            continue
+        for stage in STAGES:
+            current = report["stages"].get(stage)
+            previous = reference_report["stages"].get(stage)
+            if current is None or previous is None:
+                continue
+            ratio = current["wall_time"] / previous["wall_time"] if previous["wall_time"] > 0 else float("inf")
+            logger.info(f"{size:>12} {stage:<18} {previous['wall_time']:10.4f} s -> {current['wall_time']:10.4f} s  ({ratio:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the macrotracking stages on synthetic data.")
+    parser.add_argument("sizes", nargs="*", default=["10k", "100k", "1M"], help="trace lengths in messages, e.g. 10k 1M 100M")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random payloads")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_RATES,
+                        help="frames per second of each arbitration id, e.g. 0x180:100,0x410:50,0x280:200")
+    parser.add_argument("--line-limit", type=parse_size, default=parse_size("1M"),
+                        help="largest trace of the per message parser and model")
+    parser.add_argument("--correction-limit", type=parse_size, default=parse_size("10M"),
+                        help="largest trace of the map based correction")
+    parser.add_argument("--grid-spacing", type=float, default=100.0, help="distance of the synthetic roads in meters")
+    parser.add_argument("--data-folder", default=config.get("Benchmark", "data_folder", fallback="../benchmark_data/"),
+                        help="folder of the generated traces (kept for the next runs)")
+    parser.add_argument("--results-folder", default=config.get("Benchmark", "results_folder", fallback="../benchmark_results/"),
+                        help="folder of the result files, one per commit")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_folder, exist_ok=True)
+    os.makedirs(args.results_folder, exist_ok=True)
+    Profiler.configure(True)
+
+    results = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "map_mode": config.get("Map", "mode", fallback="window"),
+        "projection_mode": Projection.get_mode(),
+        "mix": {f"0x{arbitration_id:x}": rate for arbitration_id, rate in sorted(args.mix.items())},
+        "results": {},
+    }
+    for size in args.sizes:
+        messages = parse_size(size)
+        logger.info(f"Benchmark with {messages} messages...")
+        report = run_size(messages, args)
+        results["results"][str(messages)] = report
+        for stage in STAGES:
+            if stage in report["stages"]:
+                logger.info(f"{stage:<18} {report['stages'][stage]['wall_time']:10.4f} s")
+
+    result_file = os.path.join(args.results_folder, f"{results['commit']}.json")
+    with open(result_file, "w") as results_output:
+        json.dump(results, results_output, indent=2)
+    logger.info(f"Benchmark results saved to: {result_file}")
+
+    if args.compare:
+        with open(args.compare) as reference_file:
+            compare_results(results, json.load(reference_file))
@@ -0,0 +1,94 @@
+'''Synthetic road grid served through the graph cache instead of OSM downloads'''
+import math
+import networkx
+import numpy
+from map.graph_cache import GraphCache
+from map.projection import Projection
+
+
+class SyntheticGraphCache(GraphCache):
+    """
+    Graph cache of an endless road grid, every window and tile is built on request.
+
+    The grid lines go through the origin (the start of the synthetic drive) with the given spacing
+    in epsg:3857 meters, the nodes are moved by a small deterministic offset, like real roads
+    they are never exactly parallel to the axes. Node ids are derived from the grid coordinates,
+    so the windows and tiles of the same area share their nodes like OSM downloads do.
+    """
+
+    _OFFSET = 1 << 20
+
+    def __init__(self, origin_latitude:float, origin_longitude:float, spacing:float = 100.0, jitter:float = 5.0, **kwargs) -> None:
+        kwargs.setdefault("offline", False)
+        super().__init__(**kwargs)
+        self.spacing = spacing
+        self.jitter = jitter
+        self.origin_x, self.origin_y = Projection.to_xy(origin_latitude, origin_longitude)
+
+
+    def get_graph(self, latitude:float, longitude:float, radius:float, network_type:str = 'drive',
+                  simplify:bool = False, dist_type:str = 'network'):
+        '''Grid nodes in the square around the quantized center (every grid node is an intersection)'''
+        key = self.key(latitude, longitude, radius, network_type, simplify, dist_type)
+        center_x, center_y = Projection.to_xy(*self.quantize(latitude, longitude))
+        return self._get(key, lambda: self._area(center_x - radius, center_y - radius, center_x + radius, center_y + radius))
+
+
+    def get_tile(self, column:int, row:int, tile_size:float, network_type:str = 'drive'):
+        '''Grid nodes of a tile with the edges leaving it (like truncate_by_edge of osmnx)'''
+        key = f"tile_{tile_size:g}_{column}_{row}_{network_type}"
+        return self._get(key, lambda: self._area(column * tile_size, row * tile_size, (column + 1) * tile_size,
+                                                 (row + 1) * tile_size, truncate_by_edge=True))
+
+
+    def _area(self, west:float, south:float, east:float, north:float, truncate_by_edge:bool = False):
+        '''Graph of the nodes inside the area, optionally with the edges leaving it and their outer nodes'''
+        margin = self.jitter + self.spacing
+        columns = range(math.floor((west - margin - self.origin_x) / self.spacing), math.ceil((east + margin - self.origin_x) / self.spacing) + 1)
+        rows = range(math.floor((south - margin - self.origin_y) / self.spacing), math.ceil((north + margin - self.origin_y) / self.spacing) + 1)
+        graph = self._grid(columns, rows)
+
+        if truncate_by_edge:
+            # tiles are half open areas, so every node belongs to exactly one tile
+            inside = {node for node, data in graph.nodes(data=True) if west <= data['x'] < east and south <= data['y'] < north}
+            graph.remove_edges_from([(u, v, k) for u, v, k in graph.edges(keys=True) if u not in inside and v not in inside])
+            graph.remove_nodes_from([node for node in list(graph.nodes) if node not in inside and graph.degree(node) == 0])
+        else:
+            inside = {node for node, data in graph.nodes(data=True) if west <= data['x'] <= east and south <= data['y'] <= north}
+            graph.remove_nodes_from([node for node in list(graph.nodes) if node not in inside])
+        return graph
+
+
+    def _node_ids(self, i, j):
+        return (i + self._OFFSET) * (self._OFFSET << 1) + (j + self._OFFSET)
+
+
+    def _grid(self, columns:range, rows:range):
+        '''Projected graph of the grid lines, two way edges between the neighbouring nodes'''
+        graph = networkx.MultiDiGraph(crs='epsg:3857')
+        i, j = numpy.meshgrid(numpy.array(columns), numpy.array(rows), indexing='ij')
+        i, j = i.ravel(), j.ravel()
+        node_ids = self._node_ids(i, j)
+
+        # deterministic offsets in [-jitter, jitter] from the node id
+        hashed = node_ids.astype(numpy.uint64) * numpy.uint64(2654435761)
+        offset_x = ((hashed >> numpy.uint64(8)) % numpy.uint64(1024)).astype(numpy.float64) / 1023 * 2 - 1
+        offset_y = ((hashed >> numpy.uint64(20)) % numpy.uint64(1024)).astype(numpy.float64) / 1023 * 2 - 1
+        xs = self.origin_x + i * self.spacing + offset_x * self.jitter
+        ys = self.origin_y + j * self.spacing + offset_y * self.jitter
+        latitudes, longitudes = Projection.to_latlon_array(xs, ys)
+
+        graph.add_nodes_from((node, {'x': x, 'y': y, 'lat': lat, 'lon': lon, 'street_count': 4})
+                             for node, x, y, lat, lon in zip(node_ids.tolist(), xs.tolist(), ys.tolist(),
+                                                             latitudes.tolist(), longitudes.tolist()))
+        positions = {node: (x, y) for node, x, y in zip(node_ids.tolist(), xs.tolist(), ys.tolist())}
+        edges = []
+        for a, b, u in zip(i.tolist(), j.tolist(), node_ids.tolist()):
+            for c, d in ((a + 1, b), (a, b + 1)):
+                if c in columns and d in rows:
+                    v = self._node_ids(c, d)
+                    length = math.dist(positions[u], positions[v])
+                    edges.append((u, v, 0, {'length': length}))
+                    edges.append((v, u, 0, {'length': length}))
+        graph.add_edges_from(edges)
+        return graph
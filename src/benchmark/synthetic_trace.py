@@ -0,0 +1,106 @@
+'''Synthetic CAN traces in the format of the trace reader'''
+import math
+import numpy
+from vehicle.vehicle_model import Vehicle
+
+# example line of the generated trace
+# 1483093132.049669        0380    000    8    30 bb 82 00 9d 53 00 81
+
+START_TIME = 1483093132.0
+
+# arbitration id -> frames per second, the model uses 0x180 (steering) and 0x410 (speed)
+DEFAULT_RATES = {0x180: 100, 0x410: 50, 0x280: 100, 0x380: 100, 0x1A0: 50, 0x5C0: 10}
+
+
+class DriveProfile:
+    """
+    Repeating drive of a car on a road grid: waiting, driving straight, then a 90 degree turn.
+
+    Every stop_every-th cycle starts with a stop. The turn direction is a pseudo random
+    function of the cycle number, so any part of the drive can be generated independently.
+    """
+
+    def __init__(self, speed_kmh:float = 30, straight_time:float = 20, wait_time:float = 15,
+                 turn_steering:int = 3000, stop_every:int = 10) -> None:
+        self.speed_kmh = speed_kmh
+        self.turn_steering = turn_steering
+        self.stop_every = stop_every
+        self.wait_time = wait_time
+        self.straight_time = straight_time
+
+        # duration of a quarter circle with the default constants of the vehicle model
+        radius = abs(2.7 * math.tan(2.8e-05 * turn_steering + math.pi / 2))
+        speed = speed_kmh / 3.6 * 1.1
+        self.turn_time = (math.pi / 2) * radius / speed
+        self.cycle_time = wait_time + straight_time + self.turn_time
+
+    def signals(self, times:numpy.ndarray):
+        '''Raw speed (0.01 km/h) and steering position at the given times (seconds from the start)'''
+        cycle = (times // self.cycle_time).astype(numpy.int64)
+        phase = times - cycle * self.cycle_time
+
+        speed = numpy.full(len(times), int(self.speed_kmh * 100), dtype=numpy.int64)
+        speed[(cycle % self.stop_every == 0) & (phase < self.wait_time)] = 0
+
+        direction = numpy.where((cycle * 2654435761 >> 7) & 1, 1, -1)
+        steering = numpy.where(phase >= self.wait_time + self.straight_time, direction * self.turn_steering, 0)
+        return speed, steering
+
+
+def frame_times(start:float, end:float, rates:dict):
+    '''Timestamps (relative) and arbitration ids of the periodic frames in [start, end), in time order'''
+    times = []
+    ids = []
+    for number, (arbitration_id, rate) in enumerate(sorted(rates.items())):
+        phase = number / (len(rates) * rate)  # the streams do not send at the same instants
+        first = math.ceil((start - phase) * rate)
+        last = math.ceil((end - phase) * rate)
+        stream = numpy.arange(first, last, dtype=numpy.float64) / rate + phase
+        times.append(stream)
+        ids.append(numpy.full(len(stream), arbitration_id, dtype=numpy.uint32))
+
+    times = numpy.concatenate(times)
+    ids = numpy.concatenate(ids)
+    order = numpy.argsort(times, kind='stable')
+    return times[order], ids[order]
+
+
+def payloads(times:numpy.ndarray, ids:numpy.ndarray, profile:DriveProfile, rng:numpy.random.Generator) -> numpy.ndarray:
+    '''8 byte payloads, random for the unused frames, speed and steering values for the frames of the model'''
+    data = rng.integers(0, 256, size=(len(times), 8), dtype=numpy.uint8)
+    speed, steering = profile.signals(times)
+
+    speed_rows = ids == Vehicle._speed_id
+    data[speed_rows, 1] = speed[speed_rows] >> 8
+    data[speed_rows, 2] = speed[speed_rows] & 0xFF
+
+    # the model negates the two's complement value of bytes 2-3
+    steering_rows = ids == Vehicle._steering_pos_id
+    raw = (-steering[steering_rows]) & 0xFFFF
+    data[steering_rows, 2] = raw >> 8
+    data[steering_rows, 3] = raw & 0xFF
+    return data
+
+
+def generate_trace(file_name:str, messages:int, rates:dict = None, profile:DriveProfile = None,
+                   seed:int = 0, chunk_messages:int = 1 << 20) -> float:
+    '''Write a trace of the given number of messages, returns its duration in seconds'''
+    rates = rates if rates is not None else DEFAULT_RATES
+    profile = profile if profile is not None else DriveProfile()
+    rng = numpy.random.default_rng(seed)
+    chunk_time = chunk_messages / sum(rates.values())
+
+    written = 0
+    start = 0.0
+    with open(file_name, "w", encoding="ascii") as trace:
+        while written < messages:
+            times, ids = frame_times(start, start + chunk_time, rates)
+            times, ids = times[:messages - written], ids[:messages - written]
+            data = payloads(times, ids, profile, rng)
+
+            trace.write(''.join(f"{START_TIME + timestamp:.6f}        {arbitration_id:04x}    000    8    {row.hex(' ')}\n"
+                                for timestamp, arbitration_id, row in zip(times.tolist(), ids.tolist(), map(bytes, data))))
+            written += len(times)
+            start += chunk_time
+
+    return start if written == 0 else float(times[-1])
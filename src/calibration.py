@@ -0,0 +1,153 @@
+'''Parameter sweep of the vehicle model, the parameter sets are evaluated in parallel'''
+import os
+import csv
+import json
+import time
+import random
+import argparse
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from file_handlers import data_loader
+from file_handlers.file_handlers import LocationFileHandler
+from map.map import Map
+from map.graph_cache import GraphCache
+from map.projection import Projection
+from trace_handler.trace_reader import TraceFileReader
+from trace_handler.trace_comparator import compare_trajectories
+from vehicle.vehicle_model import Vehicle
+from utils.utils import Utils
+
+
+config = Utils.get_config()
+logger = Utils.get_logger()
+
+# data shared by every evaluation in a worker process, set once by the pool initializer
+_shared = {}
+
+
+class SweepData:
+    '''Everything an evaluation needs that does not depend on the parameters'''
+
+    def __init__(self, trace_name:str) -> None:
+        car, start_index, offset, _, self.output_folder, ground_truth = data_loader.get_data(trace_name)
+        self.trace_name = trace_name
+        self.trace_file = car.trace_file
+        self.start_position = car.start_position
+        self.start_heading = car.heading
+        self.map_based_correction = car.perform_map_based_correction
+        self.parameters = car.get_parameters()  # with the overrides of the catalog
+
+        # the trace is parsed only once
+        last_message = None if offset == -1 else start_index + offset + 1
+        self.columns = TraceFileReader(car.trace_file, use_cache=config.getboolean("Macrotracking", "trace_cache", fallback=False)).read_columns(
+            Vehicle.used_arbitration_ids, start_index, last_message)
+
+        self.ground_truth_x, self.ground_truth_y = Projection.to_xy_array(*LocationFileHandler(ground_truth).read_coordinates())
+
+        # every map window of the run stays in memory, the workers inherit or receive it with the sweep data
+        self.graph_cache = GraphCache(memory_entries=1 << 20)
+
+
+def evaluate(data:SweepData, parameters:dict) -> dict:
+    '''Run the vehicle model on the shared data with one parameter set and score it'''
+    start_time = time.perf_counter()
+
+    car = Vehicle(data.start_position, data.start_heading, data.trace_file)
+    car.set_parameters(dict(data.parameters, **parameters))
+    parameters = car.get_parameters()  # the complete parameter set of the evaluation
+    car.map = Map(graph_cache=data.graph_cache)
+    if data.map_based_correction:
+        car.map.update_map(car.position)
+
+    car.process_can_columns(data.columns)
+
+    metrics, _, _ = compare_trajectories(data.ground_truth_x, data.ground_truth_y,
+                                         car.trajectory.column("x"), car.trajectory.column("y"))
+    return {
+        "parameters": parameters,
+        "score": metrics["closest_point"]["mean"],
+        "metrics": metrics,
+        "total_distance": car.trajectory.total_distance(),
+        "end_distance": car.trajectory.end_distance(car.start_position),
+        "runtime": time.perf_counter() - start_time,
+    }
+
+
+def _init_worker(data:SweepData):
+    _shared["data"] = data
+
+
+def _evaluate_in_worker(parameters:dict) -> dict:
+    try:
+        return evaluate(_shared["data"], parameters)
+    except Exception as exception:
+        Utils.get_logger().error(f"Parameter set {parameters} failed: {exception}\n{traceback.format_exc()}")
+        return {"parameters": parameters, "score": float("inf"), "error": repr(exception)}
+
+
+def parameter_grid(samples:int = None, seed:int = 0) -> list:
+    """
+    Parameter sets from the [Calibration] config section, every key is a vehicle parameter
+    with a comma separated list of values. The full grid is used, or a random sample of it.
+    """
+    section = config["Calibration"] if config.has_section("Calibration") else {}
+    names = [name for name in section if name in Vehicle.tunable_parameters]
+    values = [[float(value) for value in section[name].split(",")] for name in names]
+
+    grid = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+def run_sweep(trace_name:str, parameter_sets:list, workers:int) -> list:
+    '''Evaluate every parameter set, returns the results sorted by score (mean distance to ground truth)'''
+    data = SweepData(trace_name)
+
+    # the baseline run loads the map windows once, before the workers start
+    baseline = evaluate(data, {})
+    logger.info(f"Baseline score: {baseline['score']:.3f} m ({data.graph_cache.misses} map windows loaded).")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as executor:
+        results = list(executor.map(_evaluate_in_worker, parameter_sets, chunksize=max(1, len(parameter_sets) // (4 * workers))))
+
+    results.append(baseline)
+    return sorted(results, key=lambda result: result["score"])
+
+
+def write_results(results:list, output_folder:str):
+    with open(os.path.join(output_folder, "calibration_results.json"), "w") as result_file:
+        json.dump(results, result_file, indent=2)
+
+    names = list(Vehicle.tunable_parameters)
+    with open(os.path.join(output_folder, "calibration_results.csv"), "w", newline='') as result_file:
+        writer = csv.writer(result_file)
+        writer.writerow(["score", "p95", "max", "total_distance", "end_distance"] + names)
+        for result in results:
+            metrics = result.get("metrics", {}).get("closest_point", {})
+            parameters = result["parameters"]
+            writer.writerow([result["score"], metrics.get("p95"), metrics.get("max"), result.get("total_distance"),
+                             result.get("end_distance")] + [parameters.get(name, "") for name in names])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the vehicle model parameters on a trace.")
+    parser.add_argument("trace", nargs="?", default=None, help="trace name of the catalog (default: the first one)")
+    parser.add_argument("-w", "--workers", type=int, default=config.getint("Batch", "workers", fallback=os.cpu_count()),
+                        help="number of worker processes")
+    parser.add_argument("-n", "--samples", type=int, default=None, help="evaluate a random sample of the parameter grid")
+    parser.add_argument("-t", "--top", type=int, default=5, help="number of best parameter sets to report")
+    args = parser.parse_args()
+
+    trace_name = args.trace if args.trace else data_loader.trace_names()[0]
+    parameter_sets = parameter_grid(args.samples)
+    logger.info(f"Evaluating {len(parameter_sets)} parameter sets on {trace_name} with {args.workers} workers.")
+
+    sweep_start = time.perf_counter()
+    sweep_results = run_sweep(trace_name, parameter_sets, args.workers)
+    write_results(sweep_results, data_loader.get_output_folder(trace_name))
+
+    logger.info(f"Sweep finished in {time.perf_counter() - sweep_start:.1f} s. Best parameter sets:")
+    for rank, result in enumerate(sweep_results[:args.top], start=1):
+        logger.info(f"{rank}. mean distance: {result['score']:.3f} m, parameters: {result['parameters']}")
@@ -1,45 +1,160 @@
-'''Trace data loader module'''
-from enum import Enum
+'''Trace data loader module, the traces and their metadata are listed in a manifest file'''
+import os
+import csv
+import json
+from typing import NamedTuple, Optional
 from vehicle.vehicle_model import Vehicle
 from map.postition import Position
 from utils.utils import Utils
 
+# columns of the manifest, a trace of the catalog needs at least name, trace, latitude, longitude and heading
+# trace, ground_truth and gps are relative to trace_root unless they are absolute paths,
+# offset -1 means the whole trace, further columns named like a tunable vehicle parameter override it
+MANIFEST_FIELDS = ("name", "trace", "ground_truth", "gps", "latitude", "longitude", "heading", "start_index", "offset")
+_REQUIRED_FIELDS = ("name", "trace", "latitude", "longitude", "heading")
 
-class TraceIds(Enum):
-    '''List of supported traces'''
-    SAMPLE_TRACE = 1
+_catalog = None
 
 
-def get_data(trace_id:TraceIds):
-    '''Load data for the specified trace'''
+class TraceEntry(NamedTuple):
+    '''One trace of the catalog'''
+    name: str
+    trace: str
+    ground_truth: str
+    gps: Optional[str]
+    latitude: float
+    longitude: float
+    heading: float
+    start_index: int
+    offset: int
+    parameters: dict
+
+
+def _read_manifest(manifest:str) -> list:
+    '''Rows of a CSV, JSON (list or {"traces": [...]}) or TOML ([[traces]] tables) manifest'''
+    extension = os.path.splitext(manifest)[1].lower()
+    if extension == ".csv":
+        with open(manifest, newline='') as manifest_file:
+            # lines starting with # are comments
+            return list(csv.DictReader(line for line in manifest_file if not line.lstrip().startswith("#")))
+    if extension == ".json":
+        with open(manifest) as manifest_file:
+            rows = json.load(manifest_file)
+        return rows["traces"] if isinstance(rows, dict) else rows
+    if extension == ".toml":
+        try:
+            import tomllib  # python 3.11+
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise Exception("Error: A TOML manifest needs python 3.11 or the tomli package")
+        with open(manifest, "rb") as manifest_file:
+            return tomllib.load(manifest_file).get("traces", [])
+    raise Exception(f"Error: Unknown manifest format: {manifest} (csv, json or toml)")
+
+
+def _trace_path(trace_root:str, path) -> Optional[str]:
+    if path is None or str(path).strip() == "":
+        return None
+    path = str(path).strip()
+    return path if os.path.isabs(path) else os.path.join(trace_root, path)
+
+
+def _parse_entry(row:dict, trace_root:str, manifest:str) -> TraceEntry:
+    row = {str(key).strip(): value for key, value in row.items() if key is not None}
+    # empty CSV cells count as missing
+    row = {key: value for key, value in row.items() if not (isinstance(value, str) and value.strip() == "")}
+    missing = [field for field in _REQUIRED_FIELDS if field not in row]
+    if missing:
+        raise Exception(f"Error: Trace {row.get('name', '?')} of {manifest} has no {', '.join(missing)}")
+
+    unknown = [key for key in row if key not in MANIFEST_FIELDS and key not in Vehicle.tunable_parameters]
+    if unknown:
+        raise Exception(f"Error: Unknown columns of trace {row['name']} in {manifest}: {', '.join(unknown)}")
+
+    try:
+        return TraceEntry(
+            name=str(row["name"]).strip(),
+            trace=_trace_path(trace_root, row["trace"]),
+            ground_truth=_trace_path(trace_root, row.get("ground_truth")) or "",
+            gps=_trace_path(trace_root, row.get("gps")),
+            latitude=float(row["latitude"]),
+            longitude=float(row["longitude"]),
+            heading=float(row["heading"]),
+            start_index=int(row.get("start_index", 0)),
+            offset=int(row.get("offset", -1)),
+            parameters={name: float(row[name]) for name in Vehicle.tunable_parameters if name in row},
+        )
+    except ValueError as exception:
+        raise Exception(f"Error: Invalid value of trace {row['name']} in {manifest}: {exception}")
+
+
+def load_catalog(manifest:str = None) -> dict:
+    '''Traces of the manifest by name, in the order of the manifest'''
+    config = Utils.get_config()
+    manifest = manifest if manifest else config.get("Catalog", "manifest", fallback="../config/traces.csv")
+    if not os.path.isfile(manifest):
+        raise Exception(f"Error: Trace manifest not found: {manifest}")
+
+    catalog = {}
+    for row in _read_manifest(manifest):
+        entry = _parse_entry(row, config['File_locations']['trace_root'], manifest)
+        if entry.name in catalog:
+            raise Exception(f"Error: Trace {entry.name} is listed twice in {manifest}")
+        catalog[entry.name] = entry
+    Utils.get_logger().debug(f"{len(catalog)} traces loaded from {manifest}")
+    return catalog
+
+
+def get_catalog() -> dict:
+    '''Catalog of the configured manifest, loaded once'''
+    global _catalog
+    if _catalog is None:
+        _catalog = load_catalog()
+    return _catalog
+
+
+def trace_names() -> list:
+    return list(get_catalog())
+
+
+def get_entry(trace) -> TraceEntry:
+    '''Catalog entry of a trace name (entries are returned as they are)'''
+    if isinstance(trace, TraceEntry):
+        return trace
+    catalog = get_catalog()
+    if trace not in catalog:
+        raise Exception(f"Error: Unknown trace: {trace}")
+    return catalog[trace]
+
+
+def get_output_folder(trace) -> str:
+    '''Output folder of a trace'''
     config = Utils.get_config()
+    out_folder = config['File_locations']['output_root'] + get_entry(trace).name
+    if not config.getboolean("Macrotracking", "map_based_correction"):
+        return out_folder + "_uncorrected/"
+    return out_folder + "/"
+
+
+def get_data(trace):
+    '''Load data for the specified trace'''
     logger = Utils.get_logger()
+    entry = get_entry(trace)
 
-    perform_map_based_correction = config.getboolean("Macrotracking", "map_based_correction")
-    gps_file = None
-    trace_root = config['File_locations']['trace_root']
-    ground_truth_log = ""
-    
-    out_folder = config['File_locations']['output_root'] + trace_id.name
-    if not perform_map_based_correction:
-        out_folder = out_folder + "_uncorrected/"
-    else:
-        out_folder = out_folder + "/"
+    out_folder = get_output_folder(entry)
 
     # create folder if not exists
     Utils.create_folder(out_folder)
     # clear output folder
     #Utils.clear_out_folder(out_folder)
 
-    if trace_id == TraceIds.SAMPLE_TRACE:
-        trace = trace_root + "trace.log"
-        ground_truth_log = trace_root + "ground_truth.log"
-        car = Vehicle(Position(latitude=47.47175, longitude=19.05932), start_heading=45, trace_file=trace)
-        start_index = 0
-        offset = 125000  # the total trace
+    car = Vehicle(Position(latitude=entry.latitude, longitude=entry.longitude), start_heading=entry.heading, trace_file=entry.trace)
+    if entry.parameters:
+        car.set_parameters(entry.parameters)
 
-    if trace:
-        logger.debug(f'Selected trace: {trace.split("/")[-1]}')
-        logger.debug(f"Ground truth log location: {ground_truth_log}")
+    logger.debug(f'Selected trace: {entry.trace.split("/")[-1]}')
+    logger.debug(f"Ground truth log location: {entry.ground_truth}")
 
-    return car, start_index, offset, gps_file, out_folder, ground_truth_log
+    return car, entry.start_index, entry.offset, entry.gps, out_folder, entry.ground_truth
@@ -1,6 +1,17 @@
-from typing import List
+from typing import Iterable, List, Optional
+import zipfile
+import numpy
 from map.postition import Position
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # parquet trajectories are optional
+    pyarrow = None
+
+
+TRAJECTORY_FILE = "trajectory.npz"
+
 
 class LocationFileHandler():
     def __init__(self, file_name:str) -> None:
@@ -26,13 +37,26 @@ class LocationFileHandler():
                 location_file.write(f"Time: {state['time']:.6f} \t Lat:{state['lat']:.5f} \t Long:{state['lon']:.5f} \t Heading: {state['heading']:3.5f} \t Speed:{state['speed']:2.5f}\n")
 
     def read_position_from_location_file(self):
-        position_entries = []
+        longitudes = []
+        latitudes = []
+        with open(self.file_name, encoding="ascii") as file:
+            for line in file:
+                line_parts = [x for x in line.split("\t") if x != '']
+                longitudes.append(float(line_parts[2].split(":")[1]))
+                latitudes.append(float(line_parts[1].split(":")[1]))
+        # project all entries in one batch
+        return Position.positions_from_coordinates(longitudes, latitudes)
+
+    def read_coordinates(self):
+        '''Latitude and longitude columns of a location file as arrays'''
+        latitudes = []
+        longitudes = []
         with open(self.file_name, encoding="ascii") as file:
             for line in file:
                 line_parts = [x for x in line.split("\t") if x != '']
-                position_entries.append(Position(longitude=float(line_parts[2].split(":")[1]),
-                                                 latitude=float(line_parts[1].split(":")[1])))
-        return position_entries
+                latitudes.append(float(line_parts[1].split(":")[1]))
+                longitudes.append(float(line_parts[2].split(":")[1]))
+        return numpy.array(latitudes, dtype=numpy.float64), numpy.array(longitudes, dtype=numpy.float64)
 
     def write_positions_to_location_file(self, entries:List['Position']):
         with open(self.file_name, "w") as location_file:
@@ -40,6 +64,71 @@ class LocationFileHandler():
                 location_file.write(f"Time: {0.0:.6f} \t Lat:{state.latitude:.5f} \t Long:{state.longitude:.5f} \t Heading: {0.0:3.5f} \t Speed:{0.0:2.5f}\n")
 
 
+class TrajectoryFileHandler():
+    """
+    Binary columnar file of a trajectory, one array per state column.
+
+    The default is an uncompressed NumPy .npz archive, a .parquet file name selects Parquet
+    (needs pyarrow). Both are written in blocks of block_size states (Parquet row groups), so
+    no copy of a whole column is made. Columns are read back without parsing, only the
+    requested ones are loaded.
+    """
+
+    def __init__(self, file_name:str, block_size:int = 1 << 16) -> None:
+        self.file_name = file_name
+        self.block_size = block_size
+        self.parquet = file_name.endswith(".parquet")
+        if self.parquet and pyarrow is None:
+            raise Exception("Error: Parquet trajectory files need the pyarrow package!")
+
+    def write_trajectory(self, trajectory):
+        '''Write the used part of every column of a Trajectory'''
+        columns = {name: trajectory.column(name) for name in trajectory.columns}
+        if self.parquet:
+            table = pyarrow.table(columns)
+            pyarrow.parquet.write_table(table, self.file_name, row_group_size=self.block_size)
+            return
+        # the same layout as numpy.savez: one stored .npy member per column
+        with zipfile.ZipFile(self.file_name, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, column in columns.items():
+                column = numpy.ascontiguousarray(column)
+                with archive.open(name + ".npy", "w", force_zip64=True) as member:
+                    numpy.lib.format.write_array_header_1_0(member, numpy.lib.format.header_data_from_array_1_0(column))
+                    for start in range(0, len(column), self.block_size):
+                        member.write(memoryview(column[start:start + self.block_size]).cast("B"))
+
+    def read_columns(self, names:Optional[Iterable[str]] = None) -> dict:
+        '''Column name -> array, all columns if no names are given'''
+        if self.parquet:
+            table = pyarrow.parquet.read_table(self.file_name, columns=None if names is None else list(names))
+            return {name: table.column(name).to_numpy() for name in table.column_names}
+        with numpy.load(self.file_name) as archive:
+            return {name: archive[name] for name in (archive.files if names is None else names)}
+
+    def read_coordinates(self):
+        '''Latitude and longitude columns as arrays, like LocationFileHandler.read_coordinates'''
+        columns = self.read_columns(("latitude", "longitude"))
+        return columns["latitude"], columns["longitude"]
+
+    def read_xy(self):
+        '''Projected coordinate columns as arrays'''
+        columns = self.read_columns(("x", "y"))
+        return columns["x"], columns["y"]
+
+    def read_positions(self) -> List[Position]:
+        '''Positions of the states, the stored projected coordinates are used as they are'''
+        columns = self.read_columns(("latitude", "longitude", "x", "y"))
+        positions = []
+        for latitude, longitude, x, y in zip(*(columns[name].tolist() for name in ("latitude", "longitude", "x", "y"))):
+            position = Position.__new__(Position)
+            position.latitude = latitude
+            position.longitude = longitude
+            position.x = x
+            position.y = y
+            positions.append(position)
+        return positions
+
+
 class NodeListHandler():
     def __init__(self, file_name:str) -> None:
         self.file_name = file_name
@@ -54,6 +143,18 @@ class NodeListHandler():
         return nodes
 
 
+    def read_node_coordinates(self):
+        '''Latitude and longitude columns of a node log (lat, lon, id per line) as arrays'''
+        latitudes = []
+        longitudes = []
+        with open(self.file_name, encoding="ascii") as file:
+            for line in file:
+                line_parts = line.split("\t")
+                latitudes.append(float(line_parts[0]))
+                longitudes.append(float(line_parts[1]))
+        return numpy.array(latitudes, dtype=numpy.float64), numpy.array(longitudes, dtype=numpy.float64)
+
+
     def write_node_list(self, entries):
         with open(self.file_name, "w") as node_log:
             for node in entries:
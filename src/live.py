@@ -0,0 +1,223 @@
+'''Live macrotracking on a CAN bus, the position updates are emitted while the frames arrive'''
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+import traceback
+import numpy
+import can
+from file_handlers import data_loader
+from file_handlers.file_handlers import TRAJECTORY_FILE
+from map.map import Map
+from map.postition import Position
+from trace_handler.trace_reader import TraceFileReader
+from vehicle.vehicle_model import Vehicle
+from utils.utils import Utils
+
+
+config = Utils.get_config()
+logger = Utils.get_logger()
+
+
+class LiveTracker:
+    """
+    Online tracking of a vehicle on a python-can bus.
+
+    The receive thread only reads the bus and queues the frames of the vehicle model with their
+    arrival time. The model thread runs the vehicle model and the map based correction, the next
+    map window is loaded on a background thread, so slow map work delays the updates but never
+    the bus reader. Every saved vehicle state is emitted as an update together with its latency,
+    the time from the arrival of the frame that triggered it.
+    """
+
+    def __init__(self, bus:can.BusABC, car:Vehicle, queue_size:int = None) -> None:
+        self.bus = bus
+        self.car = car
+        queue_size = queue_size if queue_size is not None else config.getint("Live", "queue_size", fallback=100000)
+        self.frames = queue.Queue(maxsize=queue_size)
+
+        self.listeners = []  # called with every update on the model thread
+        self._streams = []  # (event loop, asyncio queue) of the running async iterators
+        self._lock = threading.Lock()
+
+        self.received = 0  # frames read from the bus
+        self.dropped = 0  # used frames lost because the queue was full
+        self.max_queue_length = 0
+        self.latencies = []
+
+        self._running = threading.Event()
+        self._receiver:threading.Thread = None
+        self._model:threading.Thread = None
+        self._arrival_time = None
+
+        car.state_listeners.append(self._on_state)
+        if car.map is not None:
+            car.map.background_loading = True
+
+
+    def add_listener(self, listener):
+        '''Register a callback, it gets every update as a dict (see Trajectory.state) extended with index and latency'''
+        self.listeners.append(listener)
+
+
+    def start(self):
+        self._running.set()
+        self._model = threading.Thread(target=self._process, name="live_model", daemon=True)
+        self._receiver = threading.Thread(target=self._receive, name="live_receiver", daemon=True)
+        self._model.start()
+        self._receiver.start()
+        logger.info(f"Live tracking started on {self.bus.channel_info}.")
+
+
+    def stop(self, timeout:float = None):
+        '''Stop reading the bus, the queued frames are still processed'''
+        self._running.clear()
+        if self._receiver is not None:
+            self._receiver.join(timeout)
+        self.frames.put(None)
+        if self._model is not None:
+            self._model.join(timeout)
+        logger.info("Live tracking stopped.")
+
+
+    def is_running(self) -> bool:
+        return self._model is not None and self._model.is_alive()
+
+
+    async def updates(self):
+        '''Async iterator of the updates, it ends when the tracker is stopped'''
+        loop = asyncio.get_running_loop()
+        stream = asyncio.Queue()
+        with self._lock:
+            self._streams.append((loop, stream))
+        try:
+            while True:
+                update = await stream.get()
+                if update is None:
+                    return
+                yield update
+        finally:
+            with self._lock:
+                self._streams.remove((loop, stream))
+
+
+    def latency_report(self) -> dict:
+        '''Latency statistics of the updates in milliseconds and the counters of the receive path'''
+        latencies = numpy.asarray(self.latencies) * 1000
+        report = {"updates": len(latencies), "received": self.received, "dropped": self.dropped,
+                  "max_queue_length": self.max_queue_length}
+        if len(latencies):
+            report.update({"mean": float(latencies.mean()), "median": float(numpy.median(latencies)),
+                           "p95": float(numpy.percentile(latencies, 95)), "p99": float(numpy.percentile(latencies, 99)),
+                           "max": float(latencies.max())})
+        return report
+
+
+    def _receive(self):
+        wanted = set(self.car.used_arbitration_ids)
+        while self._running.is_set():
+            msg = self.bus.recv(timeout=0.1)
+            if msg is None:
+                continue
+            self.received += 1
+            if msg.is_error_frame or msg.arbitration_id not in wanted:
+                continue
+            try:
+                self.frames.put_nowait((time.perf_counter(), msg))
+            except queue.Full:
+                self.dropped += 1
+                continue
+            self.max_queue_length = max(self.max_queue_length, self.frames.qsize())
+
+
+    def _process(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            self._arrival_time, msg = item
+            try:
+                self.car.process_can_message(msg)
+            except Exception as exception:
+                logger.error(f"Processing of frame {msg} failed: {exception}\n{traceback.format_exc()}")
+
+        with self._lock:
+            for loop, stream in self._streams:
+                loop.call_soon_threadsafe(stream.put_nowait, None)
+
+
+    def _on_state(self, index:int):
+        latency = time.perf_counter() - self._arrival_time
+        self.latencies.append(latency)
+
+        update = self.car.trajectory.state(index)
+        update["index"] = index
+        update["latency"] = latency
+
+        for listener in self.listeners:
+            try:
+                listener(update)
+            except Exception as exception:
+                logger.error(f"Update listener failed: {exception}")
+        with self._lock:
+            for loop, stream in self._streams:
+                loop.call_soon_threadsafe(stream.put_nowait, update)
+
+
+def replay_trace(trace_file:str, bus:can.BusABC, stop:threading.Event = None):
+    '''Send the frames of a trace onto a bus with their original timing (for testing without a vehicle)'''
+    for msg in can.MessageSync(TraceFileReader(trace_file).read_line(), timestamps=True):
+        if stop is not None and stop.is_set():
+            break
+        bus.send(msg)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track a vehicle live on a CAN bus.")
+    parser.add_argument("trace", nargs="?", default=None,
+                        help="trace name of the catalog (default: the first one), its start position and output folder are used")
+    parser.add_argument("-i", "--interface", default=config.get("Live", "interface", fallback="virtual"), help="python-can interface")
+    parser.add_argument("-c", "--channel", default=config.get("Live", "channel", fallback="vcan0"), help="python-can channel")
+    parser.add_argument("--position", nargs=3, type=float, metavar=("LATITUDE", "LONGITUDE", "HEADING"),
+                        help="start position instead of the one of the trace")
+    parser.add_argument("--replay", action="store_true", help="replay the trace onto the bus in real time")
+    args = parser.parse_args()
+
+    car, _, _, _, output_folder, _ = data_loader.get_data(args.trace if args.trace else data_loader.trace_names()[0])
+    if args.position:
+        car = Vehicle(Position(longitude=args.position[1], latitude=args.position[0]), args.position[2], car.trace_file)
+
+    # the first window is loaded before the bus is read
+    car.map = Map()
+    if car.perform_map_based_correction:
+        car.map.update_map(car.position)
+
+    bus = can.Bus(interface=args.interface, channel=args.channel, receive_own_messages=False)
+    tracker = LiveTracker(bus, car)
+    tracker.add_listener(lambda update: logger.info("Position: %.6f %.6f \t heading: %.2f \t latency: %.2f ms",
+                                                    update['latitude'], update['longitude'], update['heading'], update['latency'] * 1000))
+    tracker.start()
+
+    stop = threading.Event()
+    try:
+        if args.replay:
+            with can.Bus(interface=args.interface, channel=args.channel) as replay_bus:
+                replay_trace(car.trace_file, replay_bus, stop)
+        else:
+            while tracker.is_running():
+                time.sleep(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        tracker.stop()
+        bus.shutdown()
+
+    Utils.create_folder(output_folder)
+    car.save_trajectory(output_folder + "live_" + TRAJECTORY_FILE)
+    if config.getboolean("Macrotracking", "location_log", fallback=True):
+        car.dump_states_to_files(output_folder + "live_location.log")
+    with open(output_folder + "live_latency.json", "w") as latency_file:
+        json.dump(tracker.latency_report(), latency_file, indent=2)
+    logger.info(f"Latency of the updates: {tracker.latency_report()}")
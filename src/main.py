@@ -1,78 +1,196 @@
 '''Main module to run Macrotracking'''
+import time
+import argparse
 from trace_handler import trace_reader
+from trace_handler import pipeline
+from trace_handler.trace_cache import TraceCache
 from file_handlers import data_loader
 from file_handlers import gps_reader
+from file_handlers.file_handlers import TRAJECTORY_FILE
 from plot import plot_generator
 from utils.utils import Utils
+from utils.profiler import Profiler
+from utils.checkpoint import CheckpointStore
+from utils.run_record import RunRecord
 from map.map import Map
 from trace_handler.trace_comparator import CompareTraces
+from trace_handler.can_columns import select_messages
 
 
 config = Utils.get_config()
 DEBUG = config.getboolean("Macrotracking", "debug")
 MAP_BASED_CORRECTION = config.getboolean("Macrotracking", "map_based_correction")
+BULK_PARSING = config.getboolean("Macrotracking", "bulk_parsing", fallback=False)
+TRACE_CACHE = config.getboolean("Macrotracking", "trace_cache", fallback=False)
+LOCATION_LOG = config.getboolean("Macrotracking", "location_log", fallback=True)
+CHECKPOINT_INTERVAL = config.getint("Checkpoint", "interval_messages", fallback=0)
+PIPELINE = config.getboolean("Pipeline", "enabled", fallback=False)
+PIPELINE_SLOTS = config.getint("Pipeline", "slots", fallback=4)
+PIPELINE_MAP_WORKER = config.getboolean("Pipeline", "map_worker", fallback=False)
+INCREMENTAL = config.getboolean("Catalog", "incremental", fallback=False)
 logger = Utils.get_logger()
-
-traces = [ data_loader.TraceIds.SAMPLE_TRACE ]
-
-
-for trace_to_analyse in traces:
-
-    logger.info(f"Running macrotracking on {trace_to_analyse.name}")
+Profiler.configure()
+
+def save_checkpoint(checkpoints:CheckpointStore, message_index:int, car, local_map:Map, resume_point:tuple = None):
+    # the resume point lets a resumed run seek in the trace instead of reading it from the start
+    checkpoints.save(message_index, {"vehicle": car.get_state(), "map": local_map.get_state() if MAP_BASED_CORRECTION else None,
+                                     "resume_point": resume_point})
+
+
+def run_trace(trace_to_analyse:str, resume:bool = False, resume_from:int = None, force:bool = False) -> dict:
+    '''Run the complete macrotracking sequence on one trace (name of the catalog), returns the summary of the results'''
+    start_time = time.perf_counter()
+    entry = data_loader.get_entry(trace_to_analyse)
+    logger.info(f"Running macrotracking on {entry.name}")
+    Profiler.reset()
+
+    car, start_index, offset, gps_file, output_folder, ground_truth = data_loader.get_data(entry)
+
+    # a trace with the same inputs, config and model parameters as in its last run is not processed again
+    run_record = RunRecord(output_folder)
+    if INCREMENTAL:
+        fingerprint = run_record.fingerprint((car.trace_file, ground_truth, gps_file),
+                                             {"entry": entry._asdict(), "parameters": car.get_parameters(), "profile": Profiler.enabled})
+        previous = run_record.previous(fingerprint, (TRAJECTORY_FILE, "distance_measured.log"))
+        if previous is not None and not force and not resume and resume_from is None:
+            logger.info(f"Inputs of {entry.name} are unchanged, the outputs of the previous run are reused.")
+            return dict(previous, skipped=True, runtime=time.perf_counter() - start_time)
+    run_record.invalidate()
 
     local_map = Map()
-    car, start_index, offset, gps_file, output_folder, ground_truth = data_loader.get_data(trace_to_analyse)
-
     car.map = local_map
-    if MAP_BASED_CORRECTION:
-        local_map.update_map(car.position)
-
-    if gps_file:
-        gps_reader.process_gps_file(gps_file)
 
-    tr_reader = trace_reader.TraceFileReader(car.trace_file, DEBUG)
+    # the state after every CHECKPOINT_INTERVAL messages is saved, a run can continue from there
+    identity = CheckpointStore.trace_identity(car.trace_file, start_index, offset)
+    identity["map_based_correction"] = MAP_BASED_CORRECTION
+    checkpoints = CheckpointStore(output_folder + "checkpoints/", identity)
+    first_message = start_index
     MESSAGE_COUNTER = 0
+    resume_point = None
+
+    checkpoint = checkpoints.latest(resume_from) if resume or resume_from is not None else None
+    if checkpoint is not None:
+        MESSAGE_COUNTER, state = checkpoint
+        first_message = MESSAGE_COUNTER + 1
+        car.set_state(state["vehicle"])
+        resume_point = state.get("resume_point")
+        if MAP_BASED_CORRECTION:
+            with Profiler.stage("map_initial"):
+                local_map.set_state(state["map"], car.position)
+        logger.info(f"Resuming from the checkpoint after message {MESSAGE_COUNTER}.")
+    else:
+        if resume or resume_from is not None:
+            logger.warning("No checkpoint to resume from, the trace is processed from the start.")
+        if MAP_BASED_CORRECTION:
+            with Profiler.stage("map_initial"):
+                local_map.update_map(car.position)
 
-    # Read messages by line
-    for msg in tr_reader.read_line():
-
-        MESSAGE_COUNTER = MESSAGE_COUNTER + 1
-        if MESSAGE_COUNTER < start_index:
-            continue
-
-        car.process_can_message(msg)
-
-        if offset == -1:
-            continue
+    if gps_file:
+        gps_reader.process_gps_file(gps_file)
 
-        if MESSAGE_COUNTER > (start_index + offset):
-            break
+    tr_reader = trace_reader.TraceFileReader(car.trace_file, DEBUG, use_cache=TRACE_CACHE)
+    if not tr_reader.seekable():
+        resume_point = None
+
+    last_message = None if offset == -1 else start_index + offset + 1
+    if BULK_PARSING and PIPELINE and not TraceCache(car.trace_file).is_fresh():
+        # a parser process reads the chunks ahead while the model processes the current one
+        if PIPELINE_MAP_WORKER:
+            local_map.background_loading = True
+            local_map.loader_process = True
+        model_frames = 0
+        progress = {}
+        try:
+            with Profiler.stage("parsing_and_vehicle_model"):
+                for chunk in pipeline.iter_column_chunks(car.trace_file, tr_reader.log_format, car.used_arbitration_ids,
+                                                         first_message, last_message, slots=PIPELINE_SLOTS,
+                                                         resume_point=resume_point, progress=progress):
+                    car.process_can_columns(chunk)
+                    model_frames += len(chunk.index)
+                    if len(chunk.index) == 0:
+                        continue
+                    if CHECKPOINT_INTERVAL > 0 and int(chunk.index[-1]) // CHECKPOINT_INTERVAL > MESSAGE_COUNTER // CHECKPOINT_INTERVAL:
+                        save_checkpoint(checkpoints, int(chunk.index[-1]), car, local_map,
+                                        trace_reader.latest_resume_point(progress["resume_points"], int(chunk.index[-1])))
+                    MESSAGE_COUNTER = int(chunk.index[-1])
+        finally:
+            local_map.close()
+        # messages read, like the line mode counts them (not only the used frames)
+        MESSAGE_COUNTER = progress["message_count"]
+        Profiler.count("model_frames", model_frames)
+
+    elif BULK_PARSING:
+        # Read only the used frames as column arrays (from the binary trace cache if it exists)
+        with Profiler.stage("parsing"):
+            columns = tr_reader.read_columns(car.used_arbitration_ids, first_message, last_message, resume_point=resume_point)
+        with Profiler.stage("vehicle_model"):
+            if CHECKPOINT_INTERVAL > 0 and len(columns.index):
+                # the columns are processed in parts ending at the checkpoint messages
+                part_start = first_message
+                for checkpoint_message in range((first_message // CHECKPOINT_INTERVAL + 1) * CHECKPOINT_INTERVAL, int(columns.index[-1]), CHECKPOINT_INTERVAL):
+                    car.process_can_columns(select_messages(columns, part_start, checkpoint_message))
+                    save_checkpoint(checkpoints, checkpoint_message, car, local_map,
+                                    trace_reader.latest_resume_point(tr_reader.resume_points, checkpoint_message))
+                    part_start = checkpoint_message + 1
+                car.process_can_columns(select_messages(columns, part_start, None))
+            else:
+                car.process_can_columns(columns)
+        MESSAGE_COUNTER = tr_reader.message_count
+        Profiler.count("model_frames", len(columns.index))
+
+    else:
+        # Read messages by line
+        with Profiler.stage("parsing_and_vehicle_model"):
+            # a resumed run starts reading after the checkpoint message
+            MESSAGE_COUNTER = resume_point[0] if resume_point else 0
+            for msg in tr_reader.read_line(resume_point):
+
+                MESSAGE_COUNTER = MESSAGE_COUNTER + 1
+                if MESSAGE_COUNTER < first_message:
+                    continue
+
+                car.process_can_message(msg)
+                if CHECKPOINT_INTERVAL > 0 and MESSAGE_COUNTER % CHECKPOINT_INTERVAL == 0:
+                    line_offset = tr_reader.tell()
+                    save_checkpoint(checkpoints, MESSAGE_COUNTER, car, local_map,
+                                    None if line_offset is None else (MESSAGE_COUNTER, line_offset))
+
+                if offset == -1:
+                    continue
+
+                if MESSAGE_COUNTER > (start_index + offset):
+                    break
 
     logger.debug(f"Number of messages: {MESSAGE_COUNTER}.")
+    Profiler.count("messages", MESSAGE_COUNTER)
 
-    car.dump_states_to_files(output_folder + "location.log")
-    if MAP_BASED_CORRECTION:
-        local_map.dump_nodes_to_files(output_folder + "node.log")
+    with Profiler.stage("output"):
+        car.save_trajectory(output_folder + TRAJECTORY_FILE)
+        if LOCATION_LOG:
+            car.dump_states_to_files(output_folder + "location.log")
+        if MAP_BASED_CORRECTION:
+            local_map.dump_nodes_to_files(output_folder + "node.log")
+        if local_map.snap_cache is not None:
+            local_map.snap_cache.save()
+            logger.info(f"Snap cache statistics: {local_map.snap_cache.stats()}")
 
 
     # calculate total distance
-    i = 0
-    total_distance = 0.0
-    while i + 1 < len(car.previus_states):
-        total_distance += car.previus_states[i].position.distance_from(car.previus_states[i+1].position)
-        i += 1
+    total_distance = car.trajectory.total_distance()
     logger.info(f"Car travelled a total distance of: {total_distance} meters.")
 
 
     # calculate distance between start and finish
-    end_distance = car.start_position.distance_from(car.previus_states[-1].position)
+    end_distance = car.trajectory.end_distance(car.start_position)
     logger.info(f"Car trajectory end is {end_distance} meters away from the start.")
 
 
     # trace comparison
     logger.debug("Starting trace comparison...")
 
-    distance, std_dev_of_distance, distance_array = CompareTraces(trace_name=trace_to_analyse).compare_traces()
+    comparator = CompareTraces(trace_name=entry.name)
+    with Profiler.stage("comparison"):
+        distance, std_dev_of_distance, distance_array = comparator.compare_traces()
     logger.info(f"Measured distance to ground throuth is: {distance} meters.")
     logger.info(f"Std deviation of the distance to ground throuth is: {std_dev_of_distance} meters.")
 
@@ -81,9 +199,52 @@ for trace_to_analyse in traces:
         distance_file.write(f"Car trajectory end is {end_distance} meters away from the start.\n")
         distance_file.write(f"Measured distance to ground throuth is: {distance} meters.\n")
         distance_file.write(f"Std deviation of the distance to ground throuth is: {std_dev_of_distance} meters.\n")
+        if comparator.metrics:
+            closest = comparator.metrics["closest_point"]
+            polyline = comparator.metrics["point_to_polyline"]
+            distance_file.write(f"Distance percentiles (median / p90 / p95 / p99 / max): {closest['median']} / {closest['p90']} / {closest['p95']} / {closest['p99']} / {closest['max']} meters.\n")
+            distance_file.write(f"Mean distance of ground throuth to the trajectory polyline: {polyline['mean']} meters (max: {polyline['max']}).\n")
+            distance_file.write(f"Discrete Frechet distance to ground throuth: {comparator.metrics['frechet']} meters.\n")
         distance_file.write(f"Distance values: \n {distance_array}")
 
     logger.info("Generating plot for trace...")
-    plot_generator.generate_plot(output_folder)
+    with Profiler.stage("plot"):
+        plot_generator.generate_plot(output_folder, ground_truth)
+
+    if Profiler.enabled:
+        Profiler.count("map_cache_hits", local_map.graph_cache.hits)
+        Profiler.count("map_cache_misses", local_map.graph_cache.misses)
+        Profiler.write_report(output_folder + "profile.json")
 
     logger.info("Macrotracking sequence for trace completed.")
+
+    summary = {
+        "trace": entry.name,
+        "output_folder": output_folder,
+        "messages": MESSAGE_COUNTER,
+        "states": len(car.trajectory),
+        "total_distance": total_distance,
+        "end_distance": end_distance,
+        "distance": distance,
+        "std_dev_of_distance": std_dev_of_distance,
+        "metrics": comparator.metrics,
+        "runtime": time.perf_counter() - start_time,
+    }
+    if INCREMENTAL:
+        run_record.save(fingerprint, summary)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run macrotracking on the traces.")
+    parser.add_argument("traces", nargs="*", help="trace names of the catalog (default: every trace)")
+    parser.add_argument("--profile", action="store_true", help="write a profile.json report of the stages next to distance_measured.log")
+    parser.add_argument("--resume", action="store_true", help="continue from the latest checkpoint of the trace")
+    parser.add_argument("--resume-from", type=int, help="continue from the latest checkpoint at or before this message")
+    parser.add_argument("--force", action="store_true", help="process the traces even if their inputs are unchanged")
+    args = parser.parse_args()
+    if args.profile:
+        Profiler.configure(True)
+
+    for trace_to_analyse in args.traces if args.traces else data_loader.trace_names():
+        run_trace(trace_to_analyse, args.resume, args.resume_from, args.force)
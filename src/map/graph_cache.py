@@ -0,0 +1,227 @@
+'''Local cache of projected road graphs'''
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+import networkx
+import osmnx
+from map.projection import Projection
+from utils.utils import Utils
+from utils.profiler import Profiler
+
+
+class GraphCache:
+    """
+    Persistent cache of projected OSM graphs with LRU eviction.
+
+    Graphs are keyed by the quantized center, radius, network type and simplification,
+    the graph is always downloaded around the quantized center, so a cache entry is exactly
+    what a new download would return. The most recently used graphs are also kept in memory.
+    Objects derived from a graph, like its spatial index, are cached the same way.
+    """
+
+    def __init__(self, cache_folder:str = None, max_size_mb:float = None, offline:bool = None,
+                 quantization:float = None, memory_entries:int = None) -> None:
+        config = Utils.get_config()
+        self.logger = Utils.get_logger()
+
+        self.cache_folder = cache_folder if cache_folder is not None else config.get("Map", "cache_folder", fallback="../map_cache/")
+        self.max_size = (max_size_mb if max_size_mb is not None else config.getfloat("Map", "cache_size_mb", fallback=2048)) * 1024 * 1024
+        self.offline = offline if offline is not None else config.getboolean("Map", "offline", fallback=False)
+        self.quantization = quantization if quantization is not None else config.getfloat("Map", "center_quantization", fallback=0.0005)  # degrees
+        self.memory_entries = memory_entries if memory_entries is not None else config.getint("Map", "memory_entries", fallback=8)
+
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_folder:
+            os.makedirs(self.cache_folder, exist_ok=True)
+
+
+    def __getstate__(self):
+        # a copy sent to another process (e.g. the map loader) gets the settings only, the graphs in memory stay here
+        state = self.__dict__.copy()
+        state["_memory"] = OrderedDict()
+        return state
+
+
+    def quantize(self, latitude:float, longitude:float):
+        '''Snap a coordinate to the cache grid'''
+        return (round(round(latitude / self.quantization) * self.quantization, 7),
+                round(round(longitude / self.quantization) * self.quantization, 7))
+
+
+    def key(self, latitude:float, longitude:float, radius:float, network_type:str, simplify:bool, dist_type:str) -> str:
+        latitude, longitude = self.quantize(latitude, longitude)
+        return f"{latitude:.7f}_{longitude:.7f}_{radius:g}_{network_type}_{dist_type}_{'simple' if simplify else 'full'}"
+
+
+    def get_graph(self, latitude:float, longitude:float, radius:float, network_type:str = 'drive',
+                  simplify:bool = False, dist_type:str = 'network'):
+        '''Projected graph around the quantized center, from the cache or from OSM'''
+        key = self.key(latitude, longitude, radius, network_type, simplify, dist_type)
+        center = self.quantize(latitude, longitude)
+
+        def download():
+            return osmnx.graph_from_point(
+                center,
+                dist=radius,
+                dist_type=dist_type,
+                simplify=simplify,
+                network_type=network_type,
+                retain_all=False)
+
+        return self._get(key, download)
+
+
+    def get_tile(self, column:int, row:int, tile_size:float, network_type:str = 'drive'):
+        '''Projected, unsimplified graph of a square epsg:3857 tile, edges crossing the border are kept'''
+        key = f"tile_{tile_size:g}_{column}_{row}_{network_type}"
+
+        def download():
+            south, west = Projection.to_latlon(column * tile_size, row * tile_size)
+            north, east = Projection.to_latlon((column + 1) * tile_size, (row + 1) * tile_size)
+            try:
+                return osmnx.graph_from_bbox(
+                    (west, south, east, north),
+                    network_type=network_type,
+                    simplify=False,
+                    retain_all=True,
+                    truncate_by_edge=True)
+            except ValueError:
+                # no roads in the tile
+                return networkx.MultiDiGraph(crs='epsg:4326')
+
+        return self._get(key, download)
+
+
+    def _get(self, key:str, download):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            Profiler.count("map_cache_memory_hits")
+            return self._memory[key]
+
+        with Profiler.stage("map_cache_load"):
+            graph = self._load(key)
+        if graph is not None:
+            self.hits += 1
+            Profiler.count("map_cache_disk_hits")
+        else:
+            self.misses += 1
+            Profiler.count("map_downloads")
+            if self.offline:
+                raise Exception(f"Error: Map window {key} is not cached and offline mode is on!")
+
+            self.logger.debug(f"Downloading map window: {key}")
+            with Profiler.stage("osm_download"):
+                graph = download()
+                if graph.number_of_nodes() > 0 and graph.graph.get('crs') != 'epsg:3857':
+                    graph = osmnx.project_graph(graph, to_crs='epsg:3857')
+                else:
+                    graph.graph['crs'] = 'epsg:3857'
+            graph.graph['cache_key'] = key
+            self._store(key, graph)
+
+        self._remember(key, graph)
+        return graph
+
+
+    def get_derived(self, graph, name:str, builder):
+        '''Object built from a cached graph (e.g. a spatial index), built once and cached next to the graph'''
+        key = graph.graph.get('cache_key')
+        if key is None:
+            return builder(graph)
+
+        key = f"{key}.{name}"
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        derived = self._load(key)
+        if derived is None:
+            with Profiler.stage("index_build"):
+                derived = builder(graph)
+            self._store(key, derived)
+
+        self._remember(key, derived)
+        return derived
+
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_folder, key + ".pickle")
+
+
+    def _load(self, key:str):
+        if not self.cache_folder or not os.path.isfile(self._path(key)):
+            return None
+
+        try:
+            with open(self._path(key), "rb") as graph_file:
+                graph = pickle.load(graph_file)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as exception:
+            self.logger.warning(f"Corrupt map cache entry {key} removed: {exception}")
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            return None
+
+        # file modification time is the LRU clock
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+        return graph
+
+
+    def _store(self, key:str, graph):
+        if not self.cache_folder:
+            return
+
+        # unique temporary file, several processes (batch workers) may store the same key at once
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_folder, prefix=key, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as graph_file:
+                pickle.dump(graph, graph_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+
+    def _remember(self, key:str, graph):
+        self._memory[key] = graph
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+
+    def evict(self):
+        '''Remove the least recently used graphs until the cache fits into the size limit'''
+        # other processes may remove the same entries at the same time
+        entries = []
+        for file_name in os.listdir(self.cache_folder):
+            if file_name.endswith(".pickle"):
+                path = os.path.join(self.cache_folder, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.logger.debug(f"Map cache entry evicted: {path}")
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -1,22 +1,56 @@
-import copy
 import math
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy
 import osmnx
 from map.postition import Position
+from map.graph_cache import GraphCache
+from map.spatial_index import EdgeIndex, NodeIndex, build_intersection_index
+from map.tile_store import TileStore
+from map.snap_cache import SnapCache
 from utils.utils import Utils
+from utils.profiler import Profiler
 
 
 class Map:
     '''Position on the map'''
 
-    def __init__(self):
+    def __init__(self, graph_cache:GraphCache = None):
         self.map_radius = 600
         self.max_allowed_distance = 550
         self.map_center = None
         self.map = None
         self.intersection_map = None
+        self.edge_index:EdgeIndex = None
+        self.intersection_index:NodeIndex = None
+        self.network_type = 'drive'
+        self.graph_cache = graph_cache if graph_cache is not None else GraphCache()
+
+        # window: one map around the car, refetched at the edge; tiles: sliding window of tiles
+        self.map_mode = Utils.get_config().get("Map", "mode", fallback="window")
+        self.tile_store:TileStore = TileStore(self.graph_cache, network_type=self.network_type) if self.map_mode == "tiles" else None
+
+        # load the next window on a background thread and use the current one until it is ready (live mode)
+        self.background_loading = False
+        self.loader_process = False  # load in a worker process that keeps its own graph cache warm (pipeline mode)
+        self._loader:ThreadPoolExecutor = None
+        self._pending_window = None
 
         self.max_heading_difference = 60
 
+        # distances to the intersections are looked up in a grid computed once per window (0: KD-tree queries),
+        # the limit has to be above the max_intersection_distance of the vehicle
+        self.raster_cell_size = Utils.get_config().getfloat("Map", "intersection_raster_cell_size", fallback=0)
+        self.raster_limit = Utils.get_config().getfloat("Map", "intersection_raster_limit", fallback=300)
+
+        # global: nearest edge of the whole map; continuity: the previous edge and its neighbours first
+        self.matching_mode = Utils.get_config().get("Map", "matching", fallback="global")
+        self.continuity_radius = Utils.get_config().getfloat("Map", "continuity_radius", fallback=30.0)
+        self.previous_edge = None
+
+        # matched edges of the quantized positions, reused when the car passes there again
+        snap_cache_size = Utils.get_config().getint("Map", "snap_cache_size", fallback=0)
+        self.snap_cache:SnapCache = SnapCache(snap_cache_size) if snap_cache_size > 0 else None
+
         self.nodes = []  # save the nodes used
 
         self.logger = Utils.get_logger()
@@ -24,36 +58,118 @@ class Map:
 
     def update_map(self, position: Position):
         '''Update map based on new center'''
+
+        if self.tile_store is not None:
+            with Profiler.stage("map_update"):
+                changed = self.tile_store.update(position)
+            if changed:
+                self.map = self.tile_store.graph
+                self.edge_index = self.tile_store
+                self.intersection_index = self.tile_store.intersection_index
+                if self.snap_cache is not None:
+                    self.snap_cache.set_version(self.tile_store.key())
+            return
         
+        if self._pending_window is not None and self._pending_window.done():
+            self._apply_pending_window()
+
         if self.map_center is not None:
             current_distance = self.map_center.distance_from(position)
 
         if self.map_center is not None and current_distance < self.max_allowed_distance:
             return
 
+        if self.background_loading and self.map_center is not None:
+            if self._pending_window is None:
+                self.logger.debug("Map edge reached! Loading next map in the background... ")
+                Profiler.count("map_refetches")
+                if self._loader is None:
+                    self._loader = self._start_loader()
+                if self.loader_process:
+                    self._pending_window = self._loader.submit(_load_window_in_worker, position.latitude, position.longitude)
+                else:
+                    self._pending_window = self._loader.submit(self._load_window, position.latitude, position.longitude)
+            # the car left the loaded area, the correction has to wait for the new window
+            if current_distance >= self.map_radius:
+                self._apply_pending_window()
+            return
+
         self.logger.debug("Map edge reached! Updating map... ")
+        Profiler.count("map_refetches")
+        with Profiler.stage("map_update"):
+            self._set_window(self._load_window(position.latitude, position.longitude))
+
+
+    def _start_loader(self):
+        if not self.loader_process:
+            return ThreadPoolExecutor(max_workers=1, thread_name_prefix="map_loader")
+
+        # the graph cache is pickled without its graphs in memory
+        settings = {"map_radius": self.map_radius, "network_type": self.network_type,
+                    "raster_cell_size": self.raster_cell_size, "raster_limit": self.raster_limit}
+        return ProcessPoolExecutor(max_workers=1, initializer=_init_loader, initargs=(self.graph_cache, settings))
+
 
-        self.map_center = copy.deepcopy(position)
+    def close(self):
+        '''Stop the background loader'''
+        if self._loader is not None:
+            self._loader.shutdown(wait=True, cancel_futures=True)
+            self._loader = None
+            self._pending_window = None
 
-        self.map = osmnx.graph_from_point(
-            (position.latitude, position.longitude), 
-            dist=self.map_radius, 
-            dist_type='network', 
-            simplify=False, 
-            network_type='drive', 
-            retain_all=False)
 
-        self.intersection_map = osmnx.graph_from_point(
-            (position.latitude, position.longitude), 
-            dist=self.map_radius, 
-            dist_type='network', 
-            simplify=True, 
-            network_type='drive', 
-            retain_all=False)
+    def _load_window(self, latitude:float, longitude:float):
+        '''Graphs and spatial indexes of the window around a position'''
+        # the windows are downloaded around the quantized center of the cache grid
+        latitude, longitude = self.graph_cache.quantize(latitude, longitude)
 
         # projected map
-        self.map = osmnx.project_graph(self.map, to_crs='epsg:3857')
-        self.intersection_map = osmnx.project_graph(self.intersection_map, to_crs='epsg:3857')
+        graph = self.graph_cache.get_graph(latitude, longitude, self.map_radius, self.network_type, simplify=False)
+
+        # spatial indexes are built once per window and reused for every query,
+        # the intersections are the nodes osmnx would keep in a simplified graph (v2: border nodes by street_count)
+        edge_index = self.graph_cache.get_derived(graph, "edge_index", EdgeIndex)
+        intersection_index = self.graph_cache.get_derived(graph, f"intersection_index_v2_{self.raster_cell_size:g}_{self.raster_limit:g}",
+                                                          lambda graph: build_intersection_index(graph, self.raster_cell_size, self.raster_limit))
+        return Position(longitude=longitude, latitude=latitude), graph, edge_index, intersection_index
+
+
+    def _set_window(self, window):
+        self.map_center, self.map, self.edge_index, self.intersection_index = window
+        self.intersection_map = None
+        if self.snap_cache is not None:
+            self.snap_cache.set_version(self.map.graph.get('cache_key', f"window_{self.map_center.latitude:.7f}_{self.map_center.longitude:.7f}_{self.map_radius:g}"))
+
+
+    def _apply_pending_window(self):
+        pending, self._pending_window = self._pending_window, None
+        try:
+            self._set_window(pending.result())
+        except Exception as exception:
+            # the current window stays in use, the load is retried on the next update
+            self.logger.error(f"Loading the map in the background failed: {exception}")
+
+
+    def get_state(self) -> dict:
+        '''Identity of the loaded map and the matching state for a checkpoint'''
+        return {
+            "mode": self.map_mode,
+            "center": (self.map_center.latitude, self.map_center.longitude) if self.map_center is not None else None,
+            "previous_edge": self.previous_edge,
+            "nodes": list(self.nodes),
+        }
+
+
+    def set_state(self, state:dict, position: Position):
+        '''Load the map of a checkpoint (from the graph cache) around the position of the vehicle'''
+        if state["mode"] != self.map_mode:
+            raise Exception(f"Error: The checkpoint was made in {state['mode']} map mode!")
+        if state["center"] is not None:
+            self._set_window(self._load_window(*state["center"]))
+        elif self.tile_store is not None:
+            self.update_map(position)
+        self.previous_edge = state["previous_edge"]
+        self.nodes = list(state["nodes"])
 
 
     def get_nearest_road_position(self, position: Position, heading: float):
@@ -63,12 +179,27 @@ class Map:
         self.update_map(position)
 
         # closest edge
-        (start_id, end_id, _) = osmnx.distance.nearest_edges(self.map, position.x, position.y)
+        Profiler.count("corrections")
+        with Profiler.stage("nearest_edge"):
+            snapped = self.snap_cache.get(position.x, position.y, heading) if self.snap_cache is not None else None
+            if snapped is not None and not self.map.has_edge(*snapped[:3]):
+                # the map changed under the same version (e.g. a new download of the window)
+                self.snap_cache.discard(position.x, position.y, heading)
+                snapped = None
+
+            if snapped is not None:
+                (start_id, end_id, _, edge_bearing) = snapped
+                self.previous_edge = snapped[:3]
+            else:
+                (start_id, end_id, _) = self.match_edge(position, heading)
 
         # calculate bearing of the edge
         delta_x = self.map.nodes[end_id]['x'] - self.map.nodes[start_id]['x']
         delta_y = self.map.nodes[end_id]['y'] - self.map.nodes[start_id]['y']
-        edge_bearing = math.degrees(math.atan2(delta_y, delta_x)) % 360
+        if snapped is None:
+            edge_bearing = math.degrees(math.atan2(delta_y, delta_x)) % 360
+            if self.snap_cache is not None:
+                self.snap_cache.put(position.x, position.y, heading, (start_id, end_id, _, edge_bearing))
         
         # correct bearing if neccessary
         if math.fabs(heading - edge_bearing) > 90:
@@ -94,13 +225,92 @@ class Map:
         return Position(longitude, latitude), edge_bearing, start_id, end_id
 
 
+    def match_edge(self, position: Position, heading: float):
+        """
+        (u, v, key) of the road the position is matched to.
+
+        In continuity mode the edge of the previous match and the edges connected to its nodes
+        are checked first, the closest one within continuity_radius whose direction differs from
+        the heading by at most max_heading_difference is used. The global edge index is only
+        queried if none of them fits, so the match does not jump to a close parallel road.
+        """
+        if self.matching_mode == "continuity" and self.previous_edge is not None:
+            edge = self._continuing_edge(position, heading)
+            if edge is not None:
+                Profiler.count("continuity_matches")
+                self.previous_edge = edge
+                return edge
+
+        Profiler.count("global_matches")
+        self.previous_edge = self.edge_index.nearest_edge(position.x, position.y)
+        return self.previous_edge
+
+
+    def _continuing_edge(self, position: Position, heading: float):
+        '''Closest fitting edge among the previous edge and its neighbours, None if none of them fits'''
+        start_id, end_id, key = self.previous_edge
+        if not self.map.has_edge(start_id, end_id, key):
+            return None
+
+        candidates = {(start_id, end_id, key)}
+        for node in (start_id, end_id):
+            candidates.update(self.map.out_edges(node, keys=True))
+            candidates.update(self.map.in_edges(node, keys=True))
+
+        best_edge, best_distance = None, self.continuity_radius
+        for edge in candidates:
+            distance = self._edge_distance(edge, position.x, position.y)
+            if distance > best_distance:
+                continue
+            u, v, _ = edge
+            bearing = math.degrees(math.atan2(self.map.nodes[v]['y'] - self.map.nodes[u]['y'], self.map.nodes[v]['x'] - self.map.nodes[u]['x']))
+            # roads can be driven both ways, only the direction of the line counts
+            if math.fabs((heading - bearing + 90) % 180 - 90) > self.max_heading_difference:
+                continue
+            best_edge, best_distance = edge, distance
+        return best_edge
+
+
+    def _edge_distance(self, edge, x: float, y: float) -> float:
+        '''Distance of a projected point from the geometry of an edge'''
+        u, v, key = edge
+        data = self.map.edges[u, v, key]
+        if 'geometry' in data:
+            coordinates = list(data['geometry'].coords)
+        else:
+            coordinates = [(self.map.nodes[u]['x'], self.map.nodes[u]['y']), (self.map.nodes[v]['x'], self.map.nodes[v]['y'])]
+
+        distance = math.inf
+        for (x1, y1), (x2, y2) in zip(coordinates[:-1], coordinates[1:]):
+            dx, dy = x2 - x1, y2 - y1
+            length_square = dx * dx + dy * dy
+            ratio = min(1.0, max(0.0, ((x - x1) * dx + (y - y1) * dy) / length_square)) if length_square > 0 else 0.0
+            distance = min(distance, math.hypot(x - x1 - ratio * dx, y - y1 - ratio * dy))
+        return distance
+
+
     def distance_to_intersection(self, position: Position):
         """Calculates the distance to the nearest node to determine the map data reliability"""
-        (neares_node_id, distance_to_node) = osmnx.distance.nearest_nodes(self.intersection_map, position.x, position.y, return_dist=True)
-        #self.logger.debug(f"Nearest node is: {neares_node_id} with a distance: {distance_to_node}")
+        if self.intersection_index is None:
+            # no intersection in the map, the map data is reliable everywhere
+            return self.raster_limit
+        with Profiler.stage("nearest_node"):
+            distance_to_node = self.intersection_index.distance(position.x, position.y)
         return distance_to_node
 
 
+    def get_nearest_edges(self, xs, ys):
+        '''Nearest (start_id, end_id, key) edges and their distances for many projected points'''
+        return self.edge_index.nearest_edges(xs, ys, return_dist=True)
+
+
+    def distances_to_intersection(self, xs, ys):
+        '''Distance to the nearest intersection for many projected points'''
+        if self.intersection_index is None:
+            return numpy.full(len(xs), self.raster_limit)
+        return self.intersection_index.distances(xs, ys)
+
+
     @staticmethod
     def correct_heading(heading):
         '''Helper function to corrects heading value'''
@@ -112,6 +322,8 @@ class Map:
         if self.map is None:
             self.update_map(Position(longitude=19.0594, latitude=47.4723))
         
+        if self.intersection_map is None:
+            self.intersection_map = osmnx.simplify_graph(self.map.copy())
         osmnx.save_graphml(self.map, "/workspaces/macrotracking/maps/infopark_map.osm")
         osmnx.save_graphml(self.intersection_map, "/workspaces/macrotracking/maps/infopark_intersection_map.osm")
 
@@ -127,3 +339,19 @@ class Map:
         node_log = open(file_name, "w")
         for (id, node) in self.nodes:
             node_log.write(f"{node['lat']}\t{node['lon']}\t{id}\n")
+
+
+# map of the loader process, its graph cache keeps the recent windows and indexes in memory
+_loader_map:Map = None
+
+
+def _init_loader(graph_cache:GraphCache, settings:dict):
+    global _loader_map
+    _loader_map = Map(graph_cache)
+    _loader_map.snap_cache = None
+    for name, value in settings.items():
+        setattr(_loader_map, name, value)
+
+
+def _load_window_in_worker(latitude:float, longitude:float):
+    return _loader_map._load_window(latitude, longitude)
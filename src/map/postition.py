@@ -1,6 +1,6 @@
 import math
-from pyproj import Transformer
-#from pyproj import CRS
+from typing import List
+from map.projection import Projection
 
 
 class Position:
@@ -27,6 +27,15 @@ class Position:
         delta_y = other_position.y - self.y
         return math.degrees(math.atan2(delta_y, delta_x)) % 360
 
+    def copy(self) -> 'Position':
+        '''Copy of the position without projecting the coordinates again'''
+        position = Position.__new__(Position)
+        position.longitude = self.longitude
+        position.latitude = self.latitude
+        position.x = self.x
+        position.y = self.y
+        return position
+
     def update_latlong_in_postion(self):
         self.latitude, self.longitude = self.convert_coordinates_back(self.x, self.y)
 
@@ -40,14 +49,30 @@ class Position:
         """Create a position object from a node"""
         return Position(longitude=node['lon'], latitude=node['lat'])
 
+    @staticmethod
+    def positions_from_coordinates(longitudes, latitudes) -> List['Position']:
+        """Create position objects from coordinate lists, projected in one batch"""
+        xs, ys = Projection.to_xy_array(latitudes, longitudes)
+        positions = []
+        for longitude, latitude, x, y in zip(longitudes, latitudes, xs.tolist(), ys.tolist()):
+            position = Position.__new__(Position)
+            position.longitude = longitude
+            position.latitude = latitude
+            position.x = x
+            position.y = y
+            positions.append(position)
+        return positions
+
+    @staticmethod
+    def positions_from_nodes(nodes) -> List['Position']:
+        """Create position objects from a list of nodes, projected in one batch"""
+        return Position.positions_from_coordinates([node['lon'] for node in nodes], [node['lat'] for node in nodes])
+
     @staticmethod
     def project_coodrinate(longitude_x: float, latitude_y: float):
         '''Convert to a projected coordinate system'''
-        #crs = CRS.from_epsg(4237)
-        #crs = CRS.from_epsg(3857)
-        #proj = Transformer.from_crs(crs.geodetic_crs, crs)
-        transformer = Transformer.from_crs("epsg:4326", "epsg:3857")
-        return transformer.transform(longitude_x, latitude_y)
+        # the first argument is the latitude, see Projection.to_xy
+        return Projection.to_xy(longitude_x, latitude_y)
 
     @staticmethod
     def convert_coordinates_back(x: float, y: float):
@@ -57,6 +82,5 @@ class Position:
         x2,y2 = transform(inProj,outProj,x1,y1)
         print x2,y2
         """
-        proj = Transformer.from_crs("epsg:3857", "epsg:4326")
         # 0: latitude, 1: longitude
-        return proj.transform(x, y)
+        return Projection.to_latlon(x, y)
@@ -0,0 +1,98 @@
+'''Coordinate projection between WGS84 (epsg:4326) and web mercator (epsg:3857)'''
+import math
+import threading
+import numpy
+from pyproj import Transformer
+from utils.utils import Utils
+from utils.profiler import Profiler
+
+
+class Projection:
+    """
+    Reusable projection engine for the whole project, the maps are projected to epsg:3857 as well.
+
+    Modes (config: [Projection] mode):
+    - pyproj: cached pyproj transformers, one pair per thread (transformers are not thread safe)
+    - fast: closed form spherical mercator, the definition of epsg:3857, no pyproj call at all
+    """
+
+    EARTH_RADIUS = 6378137.0  # sphere radius of epsg:3857 in meters
+    _MAX_LATITUDE = 85.0511287798066  # latitude limit of web mercator
+
+    mode: str = None
+    _local = threading.local()
+
+    @classmethod
+    def get_mode(cls) -> str:
+        if cls.mode is None:
+            cls.mode = Utils.get_config().get("Projection", "mode", fallback="pyproj")
+            if cls.mode not in ("pyproj", "fast"):
+                raise Exception(f"Error: Unknown projection mode: {cls.mode}")
+        return cls.mode
+
+    @classmethod
+    def set_mode(cls, mode: str):
+        if mode not in ("pyproj", "fast"):
+            raise Exception(f"Error: Unknown projection mode: {mode}")
+        cls.mode = mode
+
+    @classmethod
+    def _transformers(cls):
+        if getattr(cls._local, "forward", None) is None:
+            cls._local.forward = Transformer.from_crs("epsg:4326", "epsg:3857")
+            cls._local.backward = Transformer.from_crs("epsg:3857", "epsg:4326")
+        return cls._local.forward, cls._local.backward
+
+    @classmethod
+    def to_xy(cls, latitude: float, longitude: float):
+        '''Project a single coordinate, returns (x, y) in meters'''
+        if Profiler.enabled:
+            Profiler.count("projection_calls")
+        if cls.get_mode() == "fast":
+            latitude = min(max(latitude, -cls._MAX_LATITUDE), cls._MAX_LATITUDE)
+            x = cls.EARTH_RADIUS * math.radians(longitude)
+            y = cls.EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))
+            return x, y
+        return cls._transformers()[0].transform(latitude, longitude)
+
+    @classmethod
+    def to_latlon(cls, x: float, y: float):
+        '''Convert a single projected coordinate back, returns (latitude, longitude)'''
+        if Profiler.enabled:
+            Profiler.count("projection_calls")
+        if cls.get_mode() == "fast":
+            longitude = math.degrees(x / cls.EARTH_RADIUS)
+            latitude = math.degrees(2 * math.atan(math.exp(y / cls.EARTH_RADIUS)) - math.pi / 2)
+            return latitude, longitude
+        return cls._transformers()[1].transform(x, y)
+
+    @classmethod
+    def to_xy_array(cls, latitudes, longitudes):
+        '''Project whole arrays of coordinates at once, returns (x, y) arrays'''
+        latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        if Profiler.enabled:
+            Profiler.count("projection_calls")
+            Profiler.count("projected_points", latitudes.size)
+        if cls.get_mode() == "fast":
+            latitudes = numpy.clip(latitudes, -cls._MAX_LATITUDE, cls._MAX_LATITUDE)
+            x = cls.EARTH_RADIUS * numpy.radians(longitudes)
+            y = cls.EARTH_RADIUS * numpy.log(numpy.tan(numpy.pi / 4 + numpy.radians(latitudes) / 2))
+            return x, y
+        x, y = cls._transformers()[0].transform(latitudes, longitudes)
+        return numpy.asarray(x), numpy.asarray(y)
+
+    @classmethod
+    def to_latlon_array(cls, xs, ys):
+        '''Convert whole arrays of projected coordinates back, returns (latitude, longitude) arrays'''
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        if Profiler.enabled:
+            Profiler.count("projection_calls")
+            Profiler.count("projected_points", xs.size)
+        if cls.get_mode() == "fast":
+            longitudes = numpy.degrees(xs / cls.EARTH_RADIUS)
+            latitudes = numpy.degrees(2 * numpy.arctan(numpy.exp(ys / cls.EARTH_RADIUS)) - numpy.pi / 2)
+            return latitudes, longitudes
+        latitudes, longitudes = cls._transformers()[1].transform(xs, ys)
+        return numpy.asarray(latitudes), numpy.asarray(longitudes)
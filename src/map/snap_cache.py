@@ -0,0 +1,128 @@
+'''Memoized road snapping of repeated positions'''
+import os
+import math
+import pickle
+import tempfile
+from collections import OrderedDict
+from utils.utils import Utils
+from utils.profiler import Profiler
+
+
+class SnapCache:
+    """
+    LRU cache of the matched edges, keyed by the map version and the quantized position and heading.
+
+    Positions are quantized to cell_size meters and the heading to heading_bucket degrees, the first
+    match in a cell is reused for every later visit with a similar heading. The map version (the
+    cache key of the window or the set of active tiles) is part of the key, so the entries of an
+    earlier map are never returned after the map changes. With a cache file the entries are kept
+    across runs, the windows of the graph cache have stable versions.
+    """
+
+    def __init__(self, max_entries:int = None, cell_size:float = None, heading_bucket:float = None, cache_file:str = None) -> None:
+        config = Utils.get_config()
+        self.logger = Utils.get_logger()
+
+        self.max_entries = max_entries if max_entries is not None else config.getint("Map", "snap_cache_size", fallback=100000)
+        self.cell_size = cell_size if cell_size is not None else config.getfloat("Map", "snap_cache_cell_size", fallback=5.0)
+        self.heading_bucket = heading_bucket if heading_bucket is not None else config.getfloat("Map", "snap_cache_heading_bucket", fallback=45.0)
+        self.cache_file = cache_file if cache_file is not None else config.get("Map", "snap_cache_file", fallback="")
+
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self.invalidations = 0
+
+        if self.cache_file:
+            self.load()
+
+
+    def key(self, x:float, y:float, heading:float):
+        return (self.version, math.floor(x / self.cell_size), math.floor(y / self.cell_size),
+                math.floor((heading % 360) / self.heading_bucket))
+
+
+    def set_version(self, version:str):
+        '''Map version of the next lookups, the entries of other versions are not used any more'''
+        if version != self.version:
+            self.version = version
+            self.invalidations += 1
+
+
+    def get(self, x:float, y:float, heading:float):
+        '''(start_id, end_id, key, edge bearing) of the snapped edge, None if it is not cached'''
+        key = self.key(x, y, heading)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            Profiler.count("snap_cache_misses")
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        Profiler.count("snap_cache_hits")
+        return entry
+
+
+    def put(self, x:float, y:float, heading:float, entry):
+        self._entries[self.key(x, y, heading)] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+    def discard(self, x:float, y:float, heading:float):
+        '''Remove an entry that does not fit the current map'''
+        self._entries.pop(self.key(x, y, heading), None)
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "map_versions": self.invalidations,
+        }
+
+
+    def load(self):
+        if not os.path.isfile(self.cache_file):
+            return
+
+        try:
+            with open(self.cache_file, "rb") as snap_file:
+                cached = pickle.load(snap_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as exception:
+            self.logger.warning(f"Corrupt snap cache {self.cache_file} ignored: {exception}")
+            return
+
+        # the quantization is part of the keys
+        if cached.get("cell_size") != self.cell_size or cached.get("heading_bucket") != self.heading_bucket:
+            self.logger.debug("Snap cache quantization changed, cached entries dropped.")
+            return
+        self._entries = cached["entries"]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self.logger.debug(f"Snap cache loaded with {len(self._entries)} entries.")
+
+
+    def save(self):
+        '''Write the entries to the cache file (if there is one)'''
+        if not self.cache_file:
+            return
+
+        folder = os.path.dirname(self.cache_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # unique temporary file, batch workers may save the same cache file at once
+        handle, temp_path = tempfile.mkstemp(dir=folder or ".", prefix=os.path.basename(self.cache_file), suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as snap_file:
+                pickle.dump({"cell_size": self.cell_size, "heading_bucket": self.heading_bucket, "entries": self._entries},
+                            snap_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.cache_file)
+        except BaseException:
+            os.remove(temp_path)
+            raise
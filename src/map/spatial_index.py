@@ -0,0 +1,288 @@
+'''Spatial indexes of projected road graphs'''
+import math
+import numpy
+import networkx
+import osmnx
+from scipy.spatial import cKDTree
+
+
+class SegmentIndex:
+    """
+    Nearest segment search over a set of straight segments.
+
+    A KD-tree holds the segment midpoints. Any segment closer than d to a point has its
+    midpoint within d + (half segment length), so the candidates of the exact
+    point-segment distance come from one ball query around the closest midpoints.
+    """
+
+    def __init__(self, start, end, candidates:int = 8) -> None:
+        self.candidates = candidates
+        self.start = numpy.asarray(start, dtype=numpy.float64).reshape(-1, 2)
+        self.end = numpy.asarray(end, dtype=numpy.float64).reshape(-1, 2)
+        if len(self.start) == 0:
+            raise Exception("Error: Spatial index can not be built without segments!")
+
+        self.max_half_length = float(numpy.hypot(*(self.end - self.start).T).max()) / 2
+        self.tree = cKDTree((self.start + self.end) / 2)
+
+
+    @staticmethod
+    def from_polyline(xs, ys, candidates:int = 8) -> 'SegmentIndex':
+        '''Index of the consecutive segments of a polyline (a single point is a zero length segment)'''
+        points = numpy.column_stack((xs, ys))
+        if len(points) == 1:
+            return SegmentIndex(points, points, candidates)
+        return SegmentIndex(points[:-1], points[1:], candidates)
+
+
+    def __len__(self):
+        return len(self.start)
+
+
+    def segment_distances(self, x:float, y:float, segments) -> numpy.ndarray:
+        '''Distances of a point from the given segments'''
+        start = self.start[segments]
+        direction = self.end[segments] - start
+        length_square = numpy.einsum('ij,ij->i', direction, direction)
+        offset = numpy.column_stack((x - start[:, 0], y - start[:, 1]))
+        ratio = numpy.divide(numpy.einsum('ij,ij->i', offset, direction), length_square,
+                             out=numpy.zeros_like(length_square), where=length_square > 0)
+        ratio = numpy.clip(ratio, 0.0, 1.0)
+        return numpy.hypot(offset[:, 0] - ratio * direction[:, 0], offset[:, 1] - ratio * direction[:, 1])
+
+
+    def nearest_segments(self, xs, ys):
+        '''Numbers of the nearest segments and their distances for many points'''
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        points = numpy.column_stack((xs, ys))
+        count = min(self.candidates, len(self.start))
+
+        # upper bound of the distance from the closest midpoints
+        _, closest = self.tree.query(points, k=count)
+        closest = closest.reshape(len(points), count)
+        start = self.start[closest]
+        direction = self.end[closest] - start
+        length_square = (direction ** 2).sum(axis=2)
+        offset = points[:, None, :] - start
+        ratio = numpy.divide((offset * direction).sum(axis=2), length_square,
+                             out=numpy.zeros_like(length_square), where=length_square > 0)
+        ratio = numpy.clip(ratio, 0.0, 1.0)
+        upper = numpy.hypot(offset[..., 0] - ratio * direction[..., 0], offset[..., 1] - ratio * direction[..., 1]).min(axis=1)
+
+        # exact search inside the bound
+        segments = numpy.empty(len(points), dtype=numpy.int64)
+        distances = numpy.empty(len(points))
+        for i, candidates in enumerate(self.tree.query_ball_point(points, upper + self.max_half_length + 1e-9)):
+            candidates = numpy.sort(numpy.asarray(candidates, dtype=numpy.int64))
+            candidate_distances = self.segment_distances(xs[i], ys[i], candidates)
+            best = int(numpy.argmin(candidate_distances))
+            segments[i] = candidates[best]
+            distances[i] = candidate_distances[best]
+
+        return segments, distances
+
+
+    def nearest_segment(self, x:float, y:float):
+        '''Number of the nearest segment and its distance'''
+        count = min(self.candidates, len(self.start))
+        midpoint_distances, closest = self.tree.query((x, y), k=count)
+        closest = numpy.atleast_1d(closest)
+        distances = self.segment_distances(x, y, closest)
+        best = int(numpy.argmin(distances))
+
+        # every other segment is at least (k-th midpoint distance - half segment length) away
+        if count == len(self.start) or distances[best] <= numpy.max(midpoint_distances) - self.max_half_length:
+            return int(closest[best]), float(distances[best])
+
+        upper = distances[best]
+        candidates = numpy.sort(numpy.asarray(self.tree.query_ball_point((x, y), upper + self.max_half_length + 1e-9), dtype=numpy.int64))
+        distances = self.segment_distances(x, y, candidates)
+        best = int(numpy.argmin(distances))
+        return int(candidates[best]), float(distances[best])
+
+
+class EdgeIndex(SegmentIndex):
+    '''Nearest edge search over the segments of a projected graph'''
+
+    def __init__(self, graph, candidates:int = 8) -> None:
+        edges = []
+        start = []
+        end = []
+        segment_edges = []
+        nodes = graph.nodes
+        for edge_number, (u, v, key, data) in enumerate(graph.edges(keys=True, data=True)):
+            edges.append((u, v, key))
+            if 'geometry' in data:
+                coordinates = list(data['geometry'].coords)
+            else:
+                coordinates = [(nodes[u]['x'], nodes[u]['y']), (nodes[v]['x'], nodes[v]['y'])]
+            start.extend(coordinates[:-1])
+            end.extend(coordinates[1:])
+            segment_edges.extend([edge_number] * (len(coordinates) - 1))
+
+        if not segment_edges:
+            raise Exception("Error: Spatial index can not be built for a graph without edges!")
+
+        super().__init__(start, end, candidates)
+        self.edges = edges
+        self.segment_edges = numpy.asarray(segment_edges, dtype=numpy.int64)
+
+
+    def __len__(self):
+        return len(self.edges)
+
+
+    def nearest_edge(self, x:float, y:float, return_dist:bool = False):
+        '''(u, v, key) of the nearest edge, optionally with its distance'''
+        segment, distance = self.nearest_segment(x, y)
+        edge = self.edges[self.segment_edges[segment]]
+        return (edge, distance) if return_dist else edge
+
+
+    def nearest_edges(self, xs, ys, return_dist:bool = False):
+        '''Batch version of nearest_edge'''
+        segments, distances = self.nearest_segments(xs, ys)
+        edges = [self.edges[edge_number] for edge_number in self.segment_edges[segments]]
+        return (edges, distances) if return_dist else edges
+
+
+class NodeIndex:
+    '''Nearest node search over the nodes of a projected graph'''
+
+    def __init__(self, graph, node_ids = None) -> None:
+        node_ids = list(graph.nodes) if node_ids is None else list(node_ids)
+        if not node_ids:
+            raise Exception("Error: Spatial index can not be built without nodes!")
+
+        self.node_ids = node_ids
+        self.coordinates = numpy.array([(graph.nodes[node]['x'], graph.nodes[node]['y']) for node in node_ids], dtype=numpy.float64)
+        self.tree = cKDTree(self.coordinates)
+
+
+    def __len__(self):
+        return len(self.node_ids)
+
+
+    def nearest_node(self, x:float, y:float, return_dist:bool = False):
+        '''Id of the nearest node, optionally with its distance'''
+        distance, position = self.tree.query((x, y))
+        node = self.node_ids[int(position)]
+        return (node, float(distance)) if return_dist else node
+
+
+    def nearest_nodes(self, xs, ys, return_dist:bool = False):
+        '''Batch version of nearest_node'''
+        distances, positions = self.tree.query(numpy.column_stack((xs, ys)))
+        nodes = [self.node_ids[position] for position in positions.tolist()]
+        return (nodes, distances) if return_dist else nodes
+
+
+    def distance(self, x:float, y:float) -> float:
+        '''Distance of the nearest node'''
+        return float(self.tree.query((x, y))[0])
+
+
+    def distances(self, xs, ys) -> numpy.ndarray:
+        '''Batch version of distance'''
+        return self.tree.query(numpy.column_stack((xs, ys)))[0]
+
+
+class DistanceRaster(NodeIndex):
+    """
+    Node index with a precomputed grid of the distances to the nearest node.
+
+    The grid covers the bounding box of the graph (or the given bounds) with cell_size spacing, the values are clamped
+    to limit. distance() interpolates bilinearly between the four grid points around the point
+    (the distance field changes at most one meter per meter, so the error is below cell_size),
+    points outside the grid are answered exactly by the KD-tree.
+    """
+
+    def __init__(self, graph, node_ids = None, cell_size:float = 5.0, limit:float = 300.0, bounds = None) -> None:
+        super().__init__(graph, node_ids)
+        self.cell_size = cell_size
+        self.limit = limit
+
+        if bounds is None:
+            coordinates = numpy.array([(data['x'], data['y']) for _, data in graph.nodes(data=True)], dtype=numpy.float64)
+            bounds = (*coordinates.min(axis=0), *coordinates.max(axis=0))
+        west, south, east, north = bounds
+        self.west, self.south = west - cell_size, south - cell_size
+        east, north = east + cell_size, north + cell_size
+        self.columns = int(math.ceil((east - self.west) / cell_size)) + 1
+        self.rows = int(math.ceil((north - self.south) / cell_size)) + 1
+
+        grid_x, grid_y = numpy.meshgrid(self.west + numpy.arange(self.columns) * cell_size,
+                                        self.south + numpy.arange(self.rows) * cell_size, indexing='ij')
+        distances, _ = self.tree.query(numpy.column_stack((grid_x.ravel(), grid_y.ravel())), distance_upper_bound=limit)
+        self.values = numpy.minimum(distances, limit).astype(numpy.float32).reshape(self.columns, self.rows)
+        # nested lists are faster to index from python than the array
+        self._values = self.values.tolist()
+
+
+    def distance(self, x:float, y:float) -> float:
+        '''Distance of the nearest node, clamped to limit'''
+        column = (x - self.west) / self.cell_size
+        row = (y - self.south) / self.cell_size
+        i = int(column)
+        j = int(row)
+        if column < 0 or row < 0 or i >= self.columns - 1 or j >= self.rows - 1:
+            return min(float(self.tree.query((x, y))[0]), self.limit)
+
+        u = column - i
+        v = row - j
+        values = self._values
+        return ((values[i][j] * (1 - v) + values[i][j + 1] * v) * (1 - u) +
+                (values[i + 1][j] * (1 - v) + values[i + 1][j + 1] * v) * u)
+
+
+    def distances(self, xs, ys) -> numpy.ndarray:
+        '''Batch version of distance'''
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        columns = (xs - self.west) / self.cell_size
+        rows = (ys - self.south) / self.cell_size
+        inside = (columns >= 0) & (rows >= 0) & (columns < self.columns - 1) & (rows < self.rows - 1)
+
+        result = numpy.empty(len(xs), dtype=numpy.float64)
+        i = columns[inside].astype(numpy.int64)
+        j = rows[inside].astype(numpy.int64)
+        u = columns[inside] - i
+        v = rows[inside] - j
+        values = self.values
+        result[inside] = ((values[i, j] * (1 - v) + values[i, j + 1] * v) * (1 - u) +
+                          (values[i + 1, j] * (1 - v) + values[i + 1, j + 1] * v) * u)
+        if not inside.all():
+            result[~inside] = numpy.minimum(self.tree.query(numpy.column_stack((xs[~inside], ys[~inside])))[0], self.limit)
+        return result
+
+
+def intersection_nodes(graph):
+    """
+    Nodes kept by osmnx graph simplification: intersections, dead ends and one-way changes.
+
+    The streets of the nodes at the border of a truncated graph (map window, tile) are cut, these
+    nodes are judged by the street_count osmnx stores before the truncation, not as dead ends.
+    """
+    street_counts = networkx.get_node_attributes(graph, "street_count")
+    local_counts = osmnx.stats.count_streets_per_node(graph) if street_counts else {}
+    endpoints = []
+    for node in graph.nodes:
+        if node in street_counts and local_counts[node] < street_counts[node]:
+            if street_counts[node] != 2:
+                endpoints.append(node)
+            continue
+        neighbors = set(graph.predecessors(node)) | set(graph.successors(node))
+        if node in neighbors or graph.out_degree(node) == 0 or graph.in_degree(node) == 0:
+            endpoints.append(node)
+        elif not (len(neighbors) == 2 and graph.degree(node) in (2, 4)):
+            endpoints.append(node)
+    return endpoints
+
+
+def build_intersection_index(graph, cell_size:float = 0, limit:float = 300.0):
+    '''Index of the intersection nodes of a graph, a DistanceRaster if cell_size is set, None without intersections'''
+    nodes = intersection_nodes(graph)
+    if not nodes:
+        return None
+    return DistanceRaster(graph, nodes, cell_size, limit) if cell_size > 0 else NodeIndex(graph, nodes)
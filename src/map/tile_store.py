@@ -0,0 +1,170 @@
+'''Sliding window map built from square tiles'''
+import math
+import hashlib
+import networkx
+from map.graph_cache import GraphCache
+from map.postition import Position
+from map.spatial_index import EdgeIndex, NodeIndex, DistanceRaster, intersection_nodes
+from utils.utils import Utils
+from utils.profiler import Profiler
+
+
+class TileStore:
+    """
+    Road graph around the vehicle assembled from square epsg:3857 tiles.
+
+    Tiles within load_distance of the tile of the vehicle are loaded, tiles farther than
+    drop_distance are released, so crossing a tile border only loads the missing row or column.
+    Every tile has its own edge index, nearest edge queries start in the tile of the
+    point and visit neighbouring tiles only if they can hold a closer edge. The intersections
+    are found once per tile, a change of the tiles only rebuilds the index of their union.
+    """
+
+    def __init__(self, graph_cache:GraphCache, tile_size:float = None, load_distance:float = None,
+                 drop_distance:float = None, network_type:str = 'drive') -> None:
+        config = Utils.get_config()
+        self.logger = Utils.get_logger()
+
+        self.graph_cache = graph_cache
+        self.network_type = network_type
+        self.tile_size = tile_size if tile_size is not None else config.getfloat("Map", "tile_size", fallback=500)
+        self.load_distance = load_distance if load_distance is not None else config.getfloat("Map", "tile_load_distance", fallback=250)
+        self.drop_distance = drop_distance if drop_distance is not None else self.load_distance + self.tile_size
+        self.raster_cell_size = config.getfloat("Map", "intersection_raster_cell_size", fallback=0)
+        self.raster_limit = config.getfloat("Map", "intersection_raster_limit", fallback=300)
+
+        self.graph = networkx.MultiDiGraph(crs='epsg:3857')
+        self.tiles = {}  # (column, row) -> (tile graph, edge index or None)
+        self._node_references = {}  # node id -> number of active tiles containing it
+        self._tile_intersections = {}  # (column, row) -> intersection node ids of the tile
+        self._intersection_references = {}  # intersection node id -> number of active tiles marking it
+        self.intersection_index:NodeIndex = None
+        self.current_tile = None
+        self.version = 0  # increased on every change of the active tiles
+
+
+    def key(self) -> str:
+        '''Identifier of the set of active tiles, the same tiles give the same key in every run'''
+        tiles = ",".join(f"{column}_{row}" for column, row in sorted(self.tiles))
+        return f"tiles_{self.tile_size:g}_{self.network_type}_{hashlib.sha1(tiles.encode()).hexdigest()}"
+
+
+    def tile_of(self, x:float, y:float):
+        return (math.floor(x / self.tile_size), math.floor(y / self.tile_size))
+
+
+    def update(self, position:Position) -> bool:
+        '''Load the missing tiles around the position and drop the far ones, returns True if anything changed'''
+        tile = self.tile_of(position.x, position.y)
+        if tile == self.current_tile:
+            return False
+        self.current_tile = tile
+
+        # distances are measured from the area of the current tile, the car can be anywhere inside it
+        reach = math.ceil(self.load_distance / self.tile_size) + 1
+        wanted = [(tile[0] + i, tile[1] + j) for i in range(-reach, reach + 1) for j in range(-reach, reach + 1)
+                  if self._tile_gap(tile, (tile[0] + i, tile[1] + j)) <= self.load_distance]
+        dropped = [key for key in self.tiles if self._tile_gap(tile, key) > self.drop_distance]
+        added = [key for key in wanted if key not in self.tiles]
+
+        for key in dropped:
+            self._remove_tile(key)
+        for key in added:
+            self._add_tile(key)
+
+        if not dropped and not added:
+            return False
+
+        self.logger.debug(f"Map tiles updated: {len(added)} loaded, {len(dropped)} dropped, {len(self.tiles)} active.")
+        self.intersection_index = self._build_intersection_index()
+        self.version += 1
+        return True
+
+
+    def nearest_edge(self, x:float, y:float, return_dist:bool = False):
+        '''(u, v, key) of the nearest edge over all active tiles'''
+        tile = self.tile_of(x, y)
+        best_edge, best_distance = None, math.inf
+
+        # own tile first, then the others ordered by their distance from the point
+        candidates = sorted(((self._tile_distance(key, x, y), key) for key, (_, index) in self.tiles.items() if index is not None),
+                            key=lambda item: (item[1] != tile, item[0]))
+        for tile_distance, key in candidates:
+            # edges are truncated at the tile border with at most one segment overhang
+            if tile_distance - self.tiles[key][1].max_half_length * 2 > best_distance:
+                continue
+            edge, distance = self.tiles[key][1].nearest_edge(x, y, return_dist=True)
+            if distance < best_distance:
+                best_edge, best_distance = edge, distance
+
+        if best_edge is None:
+            raise Exception("Error: No road found in the loaded map tiles!")
+        return (best_edge, best_distance) if return_dist else best_edge
+
+
+    def nearest_edges(self, xs, ys, return_dist:bool = False):
+        '''Batch version of nearest_edge'''
+        results = [self.nearest_edge(x, y, return_dist=True) for x, y in zip(xs, ys)]
+        edges = [edge for edge, _ in results]
+        return (edges, [distance for _, distance in results]) if return_dist else edges
+
+
+    def _tile_gap(self, tile, key) -> float:
+        '''Smallest distance between the areas of two tiles'''
+        return self.tile_size * math.hypot(max(abs(tile[0] - key[0]) - 1, 0), max(abs(tile[1] - key[1]) - 1, 0))
+
+
+    def _tile_distance(self, key, x:float, y:float) -> float:
+        '''Distance of a point from the area of a tile'''
+        delta_x = max(key[0] * self.tile_size - x, 0, x - (key[0] + 1) * self.tile_size)
+        delta_y = max(key[1] * self.tile_size - y, 0, y - (key[1] + 1) * self.tile_size)
+        return math.hypot(delta_x, delta_y)
+
+
+    def _build_intersection_index(self):
+        '''Index of the intersections of the active tiles (the raster covers their area), None without intersections'''
+        nodes = list(self._intersection_references)
+        if not nodes:
+            return None
+        if self.raster_cell_size <= 0:
+            return NodeIndex(self.graph, nodes)
+
+        columns = [column for column, _ in self.tiles]
+        rows = [row for _, row in self.tiles]
+        bounds = (min(columns) * self.tile_size, min(rows) * self.tile_size,
+                  (max(columns) + 1) * self.tile_size, (max(rows) + 1) * self.tile_size)
+        return DistanceRaster(self.graph, nodes, self.raster_cell_size, self.raster_limit, bounds)
+
+
+    def _add_tile(self, key):
+        Profiler.count("map_tiles_loaded")
+        tile_graph = self.graph_cache.get_tile(key[0], key[1], self.tile_size, self.network_type)
+        index = self.graph_cache.get_derived(tile_graph, "edge_index", EdgeIndex) if tile_graph.number_of_edges() else None
+        self.tiles[key] = (tile_graph, index)
+
+        self.graph.add_nodes_from(tile_graph.nodes(data=True))
+        self.graph.add_edges_from(tile_graph.edges(keys=True, data=True))
+        for node in tile_graph.nodes:
+            self._node_references[node] = self._node_references.get(node, 0) + 1
+
+        # border nodes are judged by their street_count, so the intersections of a tile do not depend on its neighbours
+        intersections = self.graph_cache.get_derived(tile_graph, "intersections_v2", intersection_nodes)
+        self._tile_intersections[key] = intersections
+        for node in intersections:
+            self._intersection_references[node] = self._intersection_references.get(node, 0) + 1
+
+
+    def _remove_tile(self, key):
+        tile_graph, _ = self.tiles.pop(key)
+        for node in self._tile_intersections.pop(key):
+            self._intersection_references[node] -= 1
+            if self._intersection_references[node] == 0:
+                del self._intersection_references[node]
+        unused = []
+        for node in tile_graph.nodes:
+            self._node_references[node] -= 1
+            if self._node_references[node] == 0:
+                del self._node_references[node]
+                unused.append(node)
+        # edges of the removed nodes go with them, shared border edges stay with the neighbour tile
+        self.graph.remove_nodes_from(unused)
@@ -1,43 +1,125 @@
+import os
 import folium
+import numpy
+from file_handlers.file_handlers import LocationFileHandler, NodeListHandler, TrajectoryFileHandler, TRAJECTORY_FILE
+from map.projection import Projection
+from plot.simplification import simplify_to_limit
 from utils.utils import Utils
 
 
-def generate_plot(folder:str):
+def generate_plot(folder:str, ground_truth:str = None):
+    '''Plot of the trajectory in the folder, the mode is set in the [Plot] config section'''
+    config = Utils.get_config()
+    if config.get("Plot", "mode", fallback="simplified") == "markers":
+        generate_marker_plot(folder)
+    else:
+        generate_simplified_plot(folder, ground_truth)
 
+
+def generate_simplified_plot(folder:str, ground_truth:str = None):
+    """
+    Plot of the complete trajectory, simplified to a bounded number of points.
+
+    The trajectory, the ground truth and the matched nodes of node.log are single GeoJSON
+    layers. The lines are simplified with Douglas-Peucker to the configured error in meters,
+    the error is doubled until at most max_points points remain, so the size of the HTML
+    file does not depend on the length of the trace.
+    """
     logger = Utils.get_logger()
-  
-    printed_target = 100
+    config = Utils.get_config()
+    tolerance = config.getfloat("Plot", "tolerance", fallback=1.0)
+    max_points = config.getint("Plot", "max_points", fallback=20000)
+
+    trajectory = TrajectoryFileHandler(folder + TRAJECTORY_FILE).read_columns(("time", "x", "y", "latitude", "longitude", "speed"))
+    latitudes = trajectory["latitude"]
+    longitudes = trajectory["longitude"]
+
+    m = folium.Map(location=[float(latitudes[0]), float(longitudes[0])], zoom_start=17)
+
+    kept, used_tolerance = simplify_to_limit(trajectory["x"], trajectory["y"], tolerance, max_points)
+    _line_layer(latitudes[kept], longitudes[kept], "Trajectory", 'orange').add_to(m)
+    logger.debug(f"Trajectory of {len(latitudes)} states plotted with {len(kept)} points (error: {used_tolerance} m).")
+
+    if ground_truth and os.path.isfile(ground_truth):
+        truth_latitudes, truth_longitudes = LocationFileHandler(ground_truth).read_coordinates()
+        if len(truth_latitudes) > 0:
+            kept, used_tolerance = simplify_to_limit(*Projection.to_xy_array(truth_latitudes, truth_longitudes), tolerance, max_points)
+            _line_layer(truth_latitudes[kept], truth_longitudes[kept], "Ground truth", 'blue').add_to(m)
+            logger.debug(f"Ground truth of {len(truth_latitudes)} points plotted with {len(kept)} points (error: {used_tolerance} m).")
+
+    if os.path.isfile(folder + "node.log"):
+        node_latitudes, node_longitudes = NodeListHandler(folder + "node.log").read_node_coordinates()
+        if len(node_latitudes) > 0:
+            # evenly sampled above the limit
+            step = -(-len(node_latitudes) // max_points)
+            _point_layer(node_latitudes[::step], node_longitudes[::step], "Matched nodes", 'green').add_to(m)
+
+    for i, label in ((0, "Start"), (-1, "End")):
+        folium.Marker(
+            [float(latitudes[i]), float(longitudes[i])],
+            icon=folium.Icon(color='orange'),
+            tooltip=f"{label}: Time: {trajectory['time'][i]:.6f} Lat: {latitudes[i]:.5f} Long: {longitudes[i]:.5f} Speed: {trajectory['speed'][i]:2.5f}"
+        ).add_to(m)
 
-    log_lines = []
-    coordinates = []
+    m.fit_bounds([[float(latitudes.min()), float(longitudes.min())], [float(latitudes.max()), float(longitudes.max())]])
+    folium.LayerControl().add_to(m)
 
-    location_file = folder + "location.log"
+    m.save(folder + "trace.html")
+    logger.debug(f"Plot saved to: {folder + 'trace.html'}.")
+
+
+def _coordinates(latitudes, longitudes):
+    '''GeoJSON [lon, lat] pairs, 6 decimals are about 0.1 m'''
+    return numpy.round(numpy.column_stack((longitudes, latitudes)), 6).tolist()
+
+
+def _line_layer(latitudes, longitudes, name:str, color:str) -> folium.GeoJson:
+    feature = {
+        "type": "Feature",
+        "properties": {"name": name},
+        "geometry": {"type": "LineString", "coordinates": _coordinates(latitudes, longitudes)},
+    }
+    return folium.GeoJson(feature, name=name, style_function=lambda _: {'color': color, 'weight': 4.5, 'opacity': .7})
 
 
-    with open(location_file) as f:
-        for line in f:
-            log_lines.append(line.split('\t'))
+def _point_layer(latitudes, longitudes, name:str, color:str) -> folium.GeoJson:
+    feature = {
+        "type": "Feature",
+        "properties": {"name": name},
+        "geometry": {"type": "MultiPoint", "coordinates": _coordinates(latitudes, longitudes)},
+    }
+    return folium.GeoJson(feature, name=name, marker=folium.CircleMarker(radius=3, fill=True),
+                          style_function=lambda _: {'color': color, 'fillColor': color, 'weight': 1, 'fillOpacity': .8})
+
+
+def generate_marker_plot(folder:str):
+
+    logger = Utils.get_logger()
+
+    printed_target = 100
 
-    coordinates = [[log[1].split(':')[1], log[2].split(':')[1]] for log in log_lines]
+    trajectory = TrajectoryFileHandler(folder + TRAJECTORY_FILE).read_columns(("time", "latitude", "longitude", "heading", "speed"))
+    latitudes = trajectory["latitude"].tolist()
+    longitudes = trajectory["longitude"].tolist()
 
-    m = folium.Map(location=[coordinates[0][0], coordinates[0][1]], zoom_start=17)
+    m = folium.Map(location=[latitudes[0], longitudes[0]], zoom_start=17)
 
     counter = 0
-    step = int(len(coordinates) / printed_target) if int(len(coordinates) / printed_target) != 0 else 1
+    step = int(len(latitudes) / printed_target) if int(len(latitudes) / printed_target) != 0 else 1
     points = []
 
-    while counter * step < len(coordinates):
-        state = coordinates[counter*step]
-        points.append([float(state[0]), float(state[1])])    
+    while counter * step < len(latitudes):
+        i = counter * step
+        points.append([latitudes[i], longitudes[i]])
         folium.Marker(
-            [state[0], state[1]],
+            [latitudes[i], longitudes[i]],
             icon=folium.Icon(color='orange'),
-            tooltip="Position(" + str(counter) + "): " + str(log_lines[counter*step])
+            tooltip="Position(" + str(counter) + "): " + f"Time: {trajectory['time'][i]:.6f} Lat: {latitudes[i]:.5f} Long: {longitudes[i]:.5f} Heading: {trajectory['heading'][i]:3.5f} Speed: {trajectory['speed'][i]:2.5f}"
         ).add_to(m)
         counter += 1
 
     folium.PolyLine(points, color='orange', weight=4.5, opacity=.7).add_to(m)
-    logger.debug(f"Number of log lines during plotting: {len(log_lines)}")
+    logger.debug(f"Number of states during plotting: {len(latitudes)}")
 
     m.save(folder + "trace.html")
     logger.debug(f"Plot saved to: {folder + 'trace.html'}.")
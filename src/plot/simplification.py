@@ -0,0 +1,56 @@
+'''Shape preserving simplification of projected polylines'''
+import numpy
+
+
+def douglas_peucker(xs, ys, tolerance:float) -> numpy.ndarray:
+    """
+    Indexes of the points kept by the Douglas-Peucker algorithm.
+
+    Every removed point is closer than tolerance (in the unit of the coordinates) to the
+    segment of the kept points around it. The ranges are processed from a stack and the
+    distances of a range are computed in one vectorized step.
+    """
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    count = len(xs)
+    if count < 3:
+        return numpy.arange(count)
+
+    keep = numpy.zeros(count, dtype=numpy.bool_)
+    keep[0] = keep[-1] = True
+    ranges = [(0, count - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+
+        dx = xs[last] - xs[first]
+        dy = ys[last] - ys[first]
+        px = xs[first + 1:last] - xs[first]
+        py = ys[first + 1:last] - ys[first]
+        length_squared = dx * dx + dy * dy
+        if length_squared > 0:
+            # distance from the segment (not the line), closed loops stay intact
+            t = numpy.clip((px * dx + py * dy) / length_squared, 0.0, 1.0)
+            distances = numpy.hypot(px - t * dx, py - t * dy)
+        else:
+            distances = numpy.hypot(px, py)
+
+        farthest = int(numpy.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            ranges.append((first, split))
+            ranges.append((split, last))
+
+    return numpy.flatnonzero(keep)
+
+
+def simplify_to_limit(xs, ys, tolerance:float, max_points:int):
+    '''Douglas-Peucker indexes with at most max_points points, the tolerance is doubled until they fit. Returns the indexes and the used tolerance'''
+    max_points = max(max_points, 2)  # the two ends are always kept
+    kept = douglas_peucker(xs, ys, tolerance)
+    while len(kept) > max_points:
+        tolerance = tolerance * 2 if tolerance > 0 else 0.01
+        kept = douglas_peucker(xs, ys, tolerance)
+    return kept, tolerance
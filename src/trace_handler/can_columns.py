@@ -0,0 +1,44 @@
+'''Column representation of parsed CAN frames'''
+from typing import List, NamedTuple, Optional
+import numpy
+
+
+class CanColumns(NamedTuple):
+    '''Column arrays of the frames kept by the bulk parser'''
+    timestamp: numpy.ndarray       # float64
+    arbitration_id: numpy.ndarray  # uint32
+    dlc: numpy.ndarray             # uint8
+    data: numpy.ndarray            # uint8, (n, 8) zero padded payload
+    index: numpy.ndarray           # int64, message counter of the frame in the log (1 based)
+    first_timestamp: Optional[float]  # timestamp of the first message in the range, regardless of its ID
+
+
+def select_messages(columns: CanColumns, first_message: int, last_message: Optional[int]) -> CanColumns:
+    '''Restricts the columns to an inclusive message counter range'''
+    start = numpy.searchsorted(columns.index, first_message, side='left')
+    stop = len(columns.index) if last_message is None else numpy.searchsorted(columns.index, last_message, side='right')
+    return CanColumns(timestamp=columns.timestamp[start:stop],
+                      arbitration_id=columns.arbitration_id[start:stop],
+                      dlc=columns.dlc[start:stop],
+                      data=columns.data[start:stop],
+                      index=columns.index[start:stop],
+                      first_timestamp=columns.first_timestamp)
+
+
+def concatenate_columns(chunks: List[CanColumns]) -> CanColumns:
+    '''Joins column chunks into one set of arrays'''
+    if not chunks:
+        return CanColumns(timestamp=numpy.empty(0, dtype=numpy.float64),
+                          arbitration_id=numpy.empty(0, dtype=numpy.uint32),
+                          dlc=numpy.empty(0, dtype=numpy.uint8),
+                          data=numpy.empty((0, 8), dtype=numpy.uint8),
+                          index=numpy.empty(0, dtype=numpy.int64),
+                          first_timestamp=None)
+
+    first_timestamps = [chunk.first_timestamp for chunk in chunks if chunk.first_timestamp is not None]
+    return CanColumns(timestamp=numpy.concatenate([chunk.timestamp for chunk in chunks]),
+                      arbitration_id=numpy.concatenate([chunk.arbitration_id for chunk in chunks]),
+                      dlc=numpy.concatenate([chunk.dlc for chunk in chunks]),
+                      data=numpy.concatenate([chunk.data for chunk in chunks]),
+                      index=numpy.concatenate([chunk.index for chunk in chunks]),
+                      first_timestamp=first_timestamps[0] if first_timestamps else None)
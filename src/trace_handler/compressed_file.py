@@ -0,0 +1,147 @@
+'''Reading of compressed trace files, the decompression runs on a background thread'''
+import io
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:  # zstd traces are optional
+    zstandard = None
+
+
+# codec -> (file name extensions, magic bytes at the start of the file)
+CODECS = {
+    "gzip": ((".gz", ".gzip"), b"\x1f\x8b"),
+    "bz2": ((".bz2",), b"BZh"),
+    "xz": ((".xz", ".lzma"), b"\xfd7zXZ\x00"),
+    "zstd": ((".zst", ".zstd"), b"\x28\xb5\x2f\xfd"),
+}
+
+
+def detect_codec(file_name:str):
+    '''Compression of a file from its magic bytes or its extension, None for plain files'''
+    with open(file_name, "rb") as file:
+        head = file.read(8)
+    for codec, (_, magic) in CODECS.items():
+        if head.startswith(magic):
+            return codec
+    for codec, (extensions, _) in CODECS.items():
+        if file_name.lower().endswith(extensions):
+            return codec
+    return None
+
+
+def _open_binary(file_name:str, codec:str):
+    if codec == "gzip":
+        return gzip.open(file_name, "rb")
+    if codec == "bz2":
+        return bz2.open(file_name, "rb")
+    if codec == "xz":
+        return lzma.open(file_name, "rb")
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception(f"Error: {file_name} is zstd compressed, the zstandard package is required to read it!")
+        # pzstd and concatenated files have several frames, the reader stops after the first one by default
+        return zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), read_across_frames=True, closefd=True)
+    raise Exception(f"Error: Unknown compression: {codec}")
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    Raw binary stream of the decompressed content of a file.
+
+    A background thread decompresses the file block by block into a bounded queue, the codecs
+    release the GIL while decompressing, so it runs in parallel with the parsing of the blocks.
+    """
+
+    def __init__(self, file_name:str, codec:str, block_size:int = 1 << 20, queued_blocks:int = 8) -> None:
+        super().__init__()
+        self.file_name = file_name
+        self.codec = codec
+        self.block_size = block_size
+        self._blocks = queue.Queue(maxsize=queued_blocks)
+        self._block = memoryview(b"")
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._decompress, name="trace_decompression", daemon=True)
+        self._thread.start()
+
+
+    def readable(self) -> bool:
+        return True
+
+
+    def readinto(self, buffer) -> int:
+        while not self._block:
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if block is None:
+                self._eof = True
+                return 0
+            if isinstance(block, BaseException):
+                self._eof = True
+                raise block
+            self._block = memoryview(block)
+
+        count = min(len(buffer), len(self._block))
+        buffer[:count] = self._block[:count]
+        self._block = self._block[count:]
+        return count
+
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            # unblock the decompression thread if the queue is full
+            while self._thread.is_alive():
+                try:
+                    self._blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread.join()
+        super().close()
+
+
+    def _decompress(self):
+        try:
+            with _open_binary(self.file_name, self.codec) as file:
+                while not self._stop.is_set():
+                    block = file.read(self.block_size)
+                    if not block:
+                        break
+                    self._put(block)
+        except Exception as exception:
+            self._put(exception)
+        self._put(None)
+
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def open_trace(file_name:str, encoding:str = "ascii", binary:bool = False):
+    '''Open a plain or compressed trace as text (or binary), the codec is detected automatically'''
+    codec = detect_codec(file_name)
+    if codec is None:
+        return open(file_name, "rb") if binary else open(file_name, encoding=encoding)
+
+    stream = io.BufferedReader(DecompressingReader(file_name, codec), buffer_size=1 << 20)
+    return stream if binary else io.TextIOWrapper(stream, encoding=encoding)
+
+
+def strip_codec_extension(file_name:str) -> str:
+    '''File name without the extension of the compression (trace.asc.gz -> trace.asc)'''
+    for extensions, _ in CODECS.values():
+        for extension in extensions:
+            if file_name.lower().endswith(extension):
+                return file_name[:-len(extension)]
+    return file_name
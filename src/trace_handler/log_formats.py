@@ -0,0 +1,366 @@
+'''Readers of the standard CAN log formats (candump, Vector ASC/BLF, PCAN TRC)'''
+import os
+from typing import Iterable, Optional
+import can
+import numpy
+from can.io.asc import ASC_MESSAGE_REGEX
+from utils.utils import Utils
+from utils.profiler import Profiler
+from trace_handler.can_columns import CanColumns
+from trace_handler.compressed_file import open_trace, strip_codec_extension
+
+# example candump -L line
+# (1483093132.130010) can0 180#64A07FFF4400
+# (timestamp) interface arb_id#data, arb_id#R for remote frames, arb_id##<flags><data> for CAN FD
+
+CAN_ERR_FLAG = 0x20000000
+
+NATIVE = "native"  # the whitespace separated format of TraceFileReader
+
+# format -> (python-can reader, binary file)
+PYTHON_CAN_READERS = {
+    "asc": (lambda file: can.ASCReader(file, relative_timestamp=False), False),
+    "blf": (can.BLFReader, True),
+    "trc": (can.TRCReader, False),
+}
+
+EXTENSIONS = {".asc": "asc", ".blf": "blf", ".trc": "trc"}
+
+FORMATS = (NATIVE, "candump") + tuple(PYTHON_CAN_READERS)
+
+
+def detect_format(file_name:str) -> str:
+    '''Format of a (possibly compressed) log from its extension, or from its first line for .log files'''
+    extension = os.path.splitext(strip_codec_extension(file_name))[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+
+    with open_trace(file_name, binary=True) as file:
+        head = file.read(4096)
+    if head.startswith(b"LOGG"):
+        return "blf"
+    for line in head.splitlines():
+        if line.strip():
+            return "candump" if line.lstrip().startswith(b"(") else NATIVE
+    return NATIVE
+
+
+def read_messages(file_name:str, log_format:str):
+    '''Messages of a log in a standard format'''
+    if log_format == "candump":
+        yield from _read_candump(file_name)
+        return
+
+    reader, binary = PYTHON_CAN_READERS[log_format]
+    with open_trace(file_name, binary=binary) as file:
+        yield from reader(file)
+
+
+def iter_column_chunks(file_name:str, log_format:str, wanted_ids: Optional[Iterable[int]] = None, first_message: int = 0,
+                       last_message: Optional[int] = None, chunk_size: int = 1 << 22):
+    '''
+    Column chunks of a log in a standard format, with the message numbering of read_messages.
+    Returns the number of messages read (at most last_message).
+
+    candump lines are filtered on the id token before anything else is parsed. ASC and TRC frame
+    lines of unwanted ids are dropped by their id token before python-can decodes them (from the
+    first message of the range on). BLF is binary, every frame is decoded and filtered afterwards.
+    '''
+    wanted = None if wanted_ids is None else set(wanted_ids)
+    if log_format == "candump":
+        return (yield from _candump_column_chunks(file_name, wanted, first_message, last_message, chunk_size))
+
+    builder = _ChunkBuilder()
+    rows = max(1, chunk_size // 64)
+    msg_counter = 0
+    message_count = None
+    reader, binary = PYTHON_CAN_READERS[log_format]
+    with open_trace(file_name, binary=binary) as file:
+        lines = _PrefilteredLines(file, _FRAME_IDS[log_format](), wanted) if wanted is not None and log_format in _FRAME_IDS else None
+        for msg in reader(lines if lines is not None else file):
+            msg_counter += 1
+            if msg_counter < first_message:
+                continue
+            # the frames dropped by the line filter so far are counted too
+            number = msg_counter + lines.dropped if lines is not None else msg_counter
+            if last_message is not None and number > last_message:
+                message_count = last_message
+                break
+            if not builder.started:
+                builder.start(msg.timestamp)
+                if lines is not None:
+                    lines.active = True
+            if msg.is_error_frame or (wanted is not None and msg.arbitration_id not in wanted):
+                continue
+
+            builder.add(msg.timestamp, msg.arbitration_id, msg.dlc, bytes(msg.data), number)
+            if len(builder) >= rows:
+                yield builder.flush()
+
+    yield builder.flush()
+    if message_count is None:
+        message_count = msg_counter + lines.dropped if lines is not None else msg_counter
+    return message_count
+
+
+class _PrefilteredLines:
+    """
+    Lines of a text log for a python-can reader, the frame lines of unwanted ids are dropped.
+
+    The readers consume one line per yielded message, so when a message is yielded dropped holds
+    the number of frames dropped before it. Lines are only dropped once active is set, the first
+    message of the range is always decoded (its timestamp starts the trace).
+    """
+
+    def __init__(self, file, frame_id, wanted) -> None:
+        self.file = file
+        self.frame_id = frame_id
+        self.wanted = wanted
+        self.dropped = 0
+        self.active = False
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self) -> str:
+        while True:
+            line = next(self.file)
+            # the header lines are seen by frame_id too (file version, columns, number base)
+            arbitration_id = self.frame_id(line)
+            if self.active and arbitration_id is not None and arbitration_id not in self.wanted:
+                self.dropped += 1
+                continue
+            return line
+
+
+    def close(self):
+        self.file.close()
+
+
+class _AscFrameIds:
+    '''Arbitration id of the ASC lines python-can decodes into CAN frames, None for every other line (and error frames)'''
+
+    def __init__(self) -> None:
+        self.base = 16
+
+
+    def __call__(self, line:str):
+        line = line.strip()
+        if line[:4].lower() == "base":
+            self.base = 10 if line.split()[1:2] == ["dec"] else 16
+            return None
+        if not ASC_MESSAGE_REGEX.match(line):
+            return None
+
+        tokens = line.split(None, 5)
+        # classic: time channel id dir ..., CAN FD: time CANFD channel dir id ...
+        id_token = tokens[4] if tokens[1] == "CANFD" else tokens[2] if tokens[1].isdigit() else None
+        if id_token is None or id_token.lower() == "errorframe":
+            return None
+        try:
+            return int(id_token[:-1] if id_token[-1:].lower() == "x" else id_token, self.base)
+        except ValueError:
+            return None
+
+
+# TRC 2.x message types python-can decodes
+_TRC_FRAME_TYPES = {"DT", "FD", "FB", "FE", "BI", "RR"}
+
+
+class _TrcFrameIds:
+    '''Arbitration id of the TRC lines python-can decodes into CAN frames, None for every other line'''
+
+    def __init__(self) -> None:
+        self.version = None
+        self.columns = {}
+
+
+    def __call__(self, line:str):
+        line = line.strip()
+        if line.startswith(";$FILEVERSION"):
+            self.version = line.partition("=")[2].strip()
+        elif line.startswith(";$COLUMNS"):
+            self.columns = {column: position for position, column in enumerate(line.partition("=")[2].split(","))}
+        if not line or line.startswith(";"):
+            return None
+
+        cols = line.split()
+        try:
+            if self.version in (None, "1.0"):
+                id_token = cols[2] if cols[2] != "FFFFFFFF" else None
+            elif self.version == "1.1":
+                id_token = cols[3] if cols[2] in ("Tx", "Rx") else None
+            elif self.version == "1.3":
+                id_token = cols[4] if cols[3] in ("Tx", "Rx") else None
+            elif self.version in ("2.0", "2.1"):
+                id_token = cols[self.columns["I"]] if cols[self.columns["T"]] in _TRC_FRAME_TYPES else None
+            else:
+                id_token = None
+            return int(id_token, 16) if id_token is not None else None
+        except (IndexError, KeyError, ValueError):
+            return None
+
+
+# line filters of the text formats
+_FRAME_IDS = {"asc": _AscFrameIds, "trc": _TrcFrameIds}
+
+
+class _ChunkBuilder:
+    '''Collects the frames of one column chunk'''
+
+    def __init__(self) -> None:
+        self.started = False
+        self._reset()
+
+
+    def _reset(self):
+        self.first_timestamp = None
+        self.timestamps = []
+        self.arbitration_ids = []
+        self.dlcs = []
+        self.indexes = []
+        self.payload = bytearray()
+
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+    def start(self, timestamp:float):
+        '''Timestamp of the first message of the range, the chunk containing it carries it'''
+        self.started = True
+        self.first_timestamp = timestamp
+
+
+    def add(self, timestamp:float, arbitration_id:int, dlc:int, data:bytes, index:int):
+        self.timestamps.append(timestamp)
+        self.arbitration_ids.append(arbitration_id)
+        self.dlcs.append(dlc)
+        self.indexes.append(index)
+        self.payload += data[:8].ljust(8, b'\x00')
+
+
+    def flush(self) -> CanColumns:
+        chunk = CanColumns(timestamp=numpy.array(self.timestamps, dtype=numpy.float64),
+                           arbitration_id=numpy.array(self.arbitration_ids, dtype=numpy.uint32),
+                           dlc=numpy.array(self.dlcs, dtype=numpy.uint8),
+                           data=numpy.frombuffer(bytes(self.payload), dtype=numpy.uint8).reshape(-1, 8),
+                           index=numpy.array(self.indexes, dtype=numpy.int64),
+                           first_timestamp=self.first_timestamp)
+        self._reset()
+        return chunk
+
+
+def _parse_candump_id(id_token:str):
+    '''(arbitration id, extended id, error frame) of a candump id token'''
+    can_id = int(id_token, 16)
+    return can_id & 0x1FFFFFFF, len(id_token) > 3, bool(can_id & CAN_ERR_FLAG)
+
+
+def _parse_candump_data(data_token:str):
+    '''(data, dlc, remote frame, CAN FD) of the part of a candump frame after the first #'''
+    is_fd = data_token.startswith('#')
+    if is_fd:
+        data_token = data_token[2:]  # the flags nibble is skipped
+    if data_token[:1] in ('R', 'r'):
+        return b'', int(data_token[1:]) if len(data_token) > 1 else 0, True, is_fd
+    data = bytes.fromhex(data_token)
+    return data, len(data), False, is_fd
+
+
+def _read_candump(file_name:str):
+    logger = Utils.get_logger()
+    cnt = 0
+    error_counter = 0
+    with open_trace(file_name) as file:
+        for line in file:
+            cnt += 1
+            split_line = line.split()
+            if not split_line:
+                continue
+            try:
+                id_token, _, data_token = split_line[2].partition('#')
+                arbitration_id, is_extended_id, is_error_frame = _parse_candump_id(id_token)
+                data, dlc, is_remote_frame, is_fd = _parse_candump_data(data_token)
+                msg = can.Message(timestamp=float(split_line[0][1:-1]),
+                                  arbitration_id=arbitration_id,
+                                  is_extended_id=is_extended_id,
+                                  is_error_frame=is_error_frame,
+                                  is_remote_frame=is_remote_frame,
+                                  is_fd=is_fd,
+                                  channel=split_line[1],
+                                  dlc=dlc,
+                                  data=data)
+            except (ValueError, IndexError):
+                error_counter += 1
+                logger.debug("Error, unable to parse line #%d (skipping): '%s'", cnt, line)
+                continue
+            yield msg
+
+    if error_counter > 0:
+        Profiler.count("parse_errors", error_counter)
+        logger.error(f"Number of read errors: {error_counter} ")
+
+
+def _candump_column_chunks(file_name:str, wanted, first_message:int, last_message:Optional[int], chunk_size:int):
+    logger = Utils.get_logger()
+    id_tokens = {}  # raw id token -> (arbitration id, wanted)
+    builder = _ChunkBuilder()
+
+    cnt = 0
+    msg_counter = 0
+    error_counter = 0
+    with open_trace(file_name) as file:
+        while True:
+            lines = file.readlines(chunk_size)
+            if not lines:
+                break
+
+            for line in lines:
+                cnt += 1
+                split_line = line.split()
+                if not split_line:
+                    continue
+                try:
+                    id_token, _, data_token = split_line[2].partition('#')
+                    id_entry = id_tokens.get(id_token)
+                    if id_entry is None:
+                        arbitration_id, _, is_error_frame = _parse_candump_id(id_token)
+                        id_entry = (arbitration_id, not is_error_frame and (wanted is None or arbitration_id in wanted))
+                        id_tokens[id_token] = id_entry
+
+                    # lines of other ids are checked as well, a line _read_candump skips is not counted
+                    timestamp = float(split_line[0][1:-1])
+                    data, dlc, _, _ = _parse_candump_data(data_token)
+
+                    if not id_entry[1]:
+                        if not builder.started and msg_counter + 1 >= first_message:
+                            builder.start(timestamp)
+                        msg_counter += 1
+                        if last_message is not None and msg_counter >= last_message:
+                            break
+                        continue
+                except (ValueError, IndexError):
+                    error_counter += 1
+                    logger.debug("Error, unable to parse line #%d (skipping): '%s'", cnt, line)
+                    continue
+
+                msg_counter += 1
+                if msg_counter < first_message:
+                    continue
+                if not builder.started:
+                    builder.start(timestamp)
+                builder.add(timestamp, id_entry[0], dlc, data, msg_counter)
+                if last_message is not None and msg_counter >= last_message:
+                    break
+
+            yield builder.flush()
+            if last_message is not None and msg_counter >= last_message:
+                break
+
+    if error_counter > 0:
+        Profiler.count("parse_errors", error_counter)
+        logger.error(f"Number of read errors: {error_counter} ")
+    return msg_counter
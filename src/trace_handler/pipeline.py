@@ -0,0 +1,131 @@
+'''Trace parsing in a separate process, the column chunks are passed through shared memory'''
+import queue
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Iterable, Optional
+import numpy
+from trace_handler.can_columns import CanColumns
+from trace_handler.log_formats import detect_format
+from trace_handler.trace_reader import TraceFileReader
+from utils.utils import Utils
+
+# bytes of one frame in a slot: timestamp, arbitration id, dlc, payload, message counter
+_ROW_BYTES = 8 + 4 + 1 + 8 + 8
+
+
+def _slot_columns(buffer, capacity:int, rows:int, first_timestamp) -> CanColumns:
+    '''Column views of the first rows of a slot'''
+    offset = 0
+    views = []
+    for dtype, width in ((numpy.float64, 1), (numpy.uint32, 1), (numpy.uint8, 1), (numpy.uint8, 8), (numpy.int64, 1)):
+        item_size = numpy.dtype(dtype).itemsize * width
+        view = numpy.ndarray((capacity, width), dtype=dtype, buffer=buffer, offset=offset)
+        views.append(view[:rows] if width > 1 else view[:rows, 0])
+        offset += item_size * capacity
+    timestamp, arbitration_id, dlc, data, index = views
+    return CanColumns(timestamp=timestamp, arbitration_id=arbitration_id, dlc=dlc, data=data, index=index,
+                      first_timestamp=first_timestamp)
+
+
+def _write_slot(buffer, capacity:int, chunk:CanColumns, start:int, rows:int):
+    for target, source in zip(_slot_columns(buffer, capacity, rows, None)[:5], chunk[:5]):
+        target[:] = source[start:start + rows]
+
+
+def _read_slot(buffer, capacity:int, rows:int, first_timestamp) -> CanColumns:
+    '''Copy of a slot, the slot can be refilled right away'''
+    columns = _slot_columns(buffer, capacity, rows, first_timestamp)
+    return CanColumns(*(column.copy() for column in columns[:5]), first_timestamp=first_timestamp)
+
+
+def _parse_into_slots(file_name:str, log_format:str, wanted_ids, first_message:int, last_message,
+                      chunk_size:int, resume_point, slot_names:list, capacity:int, free_slots, filled_slots):
+    '''Parser process: fills free slots with column chunks, ("end", message count) marks the end of the trace'''
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    try:
+        reader = TraceFileReader(file_name, log_format=log_format)
+        for chunk in reader.iter_column_chunks(wanted_ids, first_message, last_message, chunk_size, resume_point):
+            first_timestamp = chunk.first_timestamp
+            # resume point of the start of the chunk, sent with its first slot
+            chunk_resume_point = reader.resume_points[-1] if reader.resume_points else None
+            # chunks larger than a slot are split
+            for start in range(0, max(len(chunk.index), 1), capacity):
+                rows = min(capacity, len(chunk.index) - start)
+                if rows <= 0 and first_timestamp is None:
+                    break
+                slot = free_slots.get()
+                _write_slot(slots[slot].buf, capacity, chunk, start, rows)
+                filled_slots.put((slot, rows, first_timestamp, chunk_resume_point))
+                first_timestamp = None
+                chunk_resume_point = None
+        filled_slots.put(("end", reader.message_count))
+    except Exception:
+        filled_slots.put(("error", traceback.format_exc()))
+    finally:
+        for slot in slots:
+            slot.close()
+
+
+def iter_column_chunks(file_name:str, log_format:str = None, wanted_ids: Optional[Iterable[int]] = None, first_message:int = 0,
+                       last_message:Optional[int] = None, chunk_size:int = 1 << 22, slots:int = 4, capacity:int = 1 << 18,
+                       resume_point:Optional[tuple] = None, progress:Optional[dict] = None):
+    """
+    Column chunks of a trace parsed by a separate process, like TraceFileReader.iter_column_chunks.
+
+    The parser writes the chunks into a ring of shared memory slots, at most slots chunks are
+    ahead of the consumer. A slot is copied out (one memcpy per column) and handed back to the
+    parser before its chunk is yielded, so parsing continues while the chunk is processed.
+    Reading starts at resume_point if given. progress receives the resume points of the chunk
+    starts ("resume_points", as they arrive) and the message_count of the reader at the end.
+    """
+    logger = Utils.get_logger()
+    progress = progress if progress is not None else {}
+    progress["resume_points"] = []
+    if log_format is None:
+        log_format = detect_format(file_name)
+
+    blocks = [shared_memory.SharedMemory(create=True, size=_ROW_BYTES * capacity) for _ in range(slots)]
+    context = multiprocessing.get_context()
+    free_slots = context.Queue()
+    filled_slots = context.Queue()
+    for slot in range(slots):
+        free_slots.put(slot)
+
+    parser = context.Process(target=_parse_into_slots, name="trace_parser", daemon=True,
+                             args=(file_name, log_format, None if wanted_ids is None else list(wanted_ids), first_message,
+                                   last_message, chunk_size, resume_point, [block.name for block in blocks], capacity, free_slots, filled_slots))
+    parser.start()
+    try:
+        while True:
+            try:
+                item = filled_slots.get(timeout=1.0)
+            except queue.Empty:
+                if parser.is_alive():
+                    continue
+                # a killed parser never sends its end marker (the last items may still be in the pipe)
+                try:
+                    item = filled_slots.get(timeout=1.0)
+                except queue.Empty:
+                    raise Exception(f"Error: Trace parser process failed (exit code {parser.exitcode})")
+            if item[0] == "end":
+                progress["message_count"] = item[1]
+                break
+            if item[0] == "error":
+                raise Exception(f"Error: Trace parser process failed:\n{item[1]}")
+
+            slot, rows, first_timestamp, chunk_resume_point = item
+            if chunk_resume_point is not None:
+                progress["resume_points"].append(chunk_resume_point)
+            chunk = _read_slot(blocks[slot].buf, capacity, rows, first_timestamp)
+            free_slots.put(slot)
+            yield chunk
+        parser.join()
+    finally:
+        if parser.is_alive():
+            logger.debug("Stopping the trace parser process.")
+            parser.terminate()
+            parser.join()
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,266 @@
+'''Binary cache of text CAN traces'''
+import os
+import json
+import shutil
+import tempfile
+import numpy
+from typing import Iterable, Optional
+from trace_handler.can_columns import CanColumns
+from utils.utils import Utils
+
+# cache folder layout (next to the trace, e.g. trace.log.cache/)
+# meta.json              number of frames, source size and format version
+# timestamp.bin          float64, one value per parsed frame in log order
+# arbitration_id.bin     uint32
+# dlc.bin                uint8
+# data.bin               uint8, 8 bytes per frame (zero padded)
+# id_values.bin          uint32, distinct arbitration ids (sorted)
+# id_offsets.bin         int64, id_order[id_offsets[k]:id_offsets[k+1]] are the rows of id_values[k]
+# id_order.bin           int64, row numbers grouped by arbitration id, ascending inside a group
+# time_order.bin         int64, row numbers sorted by timestamp (only if the log is not in time order)
+#
+# Row r holds message #r+1 of the log, the same counter read_line and read_columns use.
+# The files are written to a unique temporary folder next to it, which is moved into place when complete.
+
+
+class TraceCache:
+    '''Memory-mappable binary copy of a trace with arbitration id and timestamp index'''
+
+    version = 1
+    _columns = {
+        "timestamp": (numpy.float64, ()),
+        "arbitration_id": (numpy.uint32, ()),
+        "dlc": (numpy.uint8, ()),
+        "data": (numpy.uint8, (8,)),
+    }
+
+    def __init__(self, trace_file:str, cache_folder:str = None) -> None:
+        self.trace_file = trace_file
+        self.cache_folder = cache_folder if cache_folder else trace_file + ".cache/"
+        self.meta_file = os.path.join(self.cache_folder, "meta.json")
+        self.logger = Utils.get_logger()
+        self._arrays = None
+        self._meta = None
+
+
+    def is_fresh(self) -> bool:
+        '''The cache exists, has the current format and is newer than the source log'''
+        if not os.path.isfile(self.meta_file) or not os.path.isfile(self.trace_file):
+            return False
+
+        if os.path.getmtime(self.meta_file) < os.path.getmtime(self.trace_file):
+            return False
+
+        self._meta = None
+        meta = self._read_meta()
+        return meta.get("version") == self.version and meta.get("source_size") == os.path.getsize(self.trace_file)
+
+
+    def build(self, chunks:Iterable[CanColumns]):
+        '''Writes the cache from the column chunks of the complete (unfiltered) trace'''
+        self.logger.info(f"Building binary trace cache: {self.cache_folder}")
+        source_size = os.path.getsize(self.trace_file)
+
+        # concurrent builds of the same trace (e.g. batch workers) never see each other's files
+        cache_folder = os.path.normpath(self.cache_folder)
+        temp_folder = tempfile.mkdtemp(dir=os.path.dirname(cache_folder) or ".", prefix=os.path.basename(cache_folder) + ".", suffix=".tmp")
+        try:
+            meta = self._write(chunks, temp_folder, source_size)
+            self._publish(temp_folder, cache_folder)
+        except BaseException:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            raise
+
+        self._arrays = None
+        self._meta = None
+        self.logger.info(f"Trace cache built with {meta['count']} frames and {meta['distinct_ids']} arbitration ids.")
+
+
+    def _write(self, chunks:Iterable[CanColumns], folder:str, source_size:int) -> dict:
+        files = {name: open(self._path(name, folder), "wb") for name in self._columns}
+        count = 0
+        try:
+            for chunk in chunks:
+                for name, file in files.items():
+                    numpy.ascontiguousarray(getattr(chunk, name), dtype=self._columns[name][0]).tofile(file)
+                count += len(chunk.timestamp)
+        finally:
+            for file in files.values():
+                file.close()
+
+        # arbitration id index
+        arbitration_ids = self._map("arbitration_id", count, folder=folder)
+        id_order = numpy.argsort(arbitration_ids, kind="stable").astype(numpy.int64)
+        id_values, id_starts = numpy.unique(arbitration_ids[id_order], return_index=True)
+        id_offsets = numpy.append(id_starts, count).astype(numpy.int64)
+        id_order.tofile(self._path("id_order", folder))
+        id_values.astype(numpy.uint32).tofile(self._path("id_values", folder))
+        id_offsets.tofile(self._path("id_offsets", folder))
+        del arbitration_ids
+
+        # timestamp index, only needed if the log is not in time order
+        timestamps = self._map("timestamp", count, folder=folder)
+        time_sorted = bool(numpy.all(timestamps[1:] >= timestamps[:-1]))
+        if not time_sorted:
+            numpy.argsort(timestamps, kind="stable").astype(numpy.int64).tofile(self._path("time_order", folder))
+        del timestamps
+
+        meta = {"version": self.version,
+                "count": count,
+                "distinct_ids": len(id_values),
+                "time_sorted": time_sorted,
+                "source_size": source_size}
+        with open(os.path.join(folder, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file)
+        return meta
+
+
+    def _publish(self, temp_folder:str, cache_folder:str):
+        '''Moves a complete cache into place, a fresh cache of another build is kept'''
+        if os.path.isdir(cache_folder):
+            if self.is_fresh():
+                shutil.rmtree(temp_folder, ignore_errors=True)
+                return
+            try:
+                os.replace(cache_folder, temp_folder + ".old")
+            except FileNotFoundError:
+                pass  # removed by another build
+            else:
+                shutil.rmtree(temp_folder + ".old", ignore_errors=True)
+        try:
+            os.replace(temp_folder, cache_folder)
+        except OSError:
+            # another build was moved into place first
+            if not os.path.isdir(cache_folder):
+                raise
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+    def open(self):
+        '''Memory-maps the cache files, nothing is copied into memory'''
+        if self._arrays is not None:
+            return self._arrays
+
+        meta = self._read_meta()
+        if not meta:
+            raise Exception(f"Error: Trace cache not found or incomplete: {self.cache_folder}")
+        count = meta["count"]
+        self._arrays = {name: self._map(name, count) for name in self._columns}
+        self._arrays["id_values"] = self._map("id_values", meta["distinct_ids"], numpy.uint32)
+        self._arrays["id_offsets"] = self._map("id_offsets", meta["distinct_ids"] + 1, numpy.int64)
+        self._arrays["id_order"] = self._map("id_order", count, numpy.int64)
+        if not meta["time_sorted"]:
+            self._arrays["time_order"] = self._map("time_order", count, numpy.int64)
+        return self._arrays
+
+
+    def __len__(self):
+        return self._read_meta()["count"]
+
+
+    def select(self, wanted_ids:Optional[Iterable[int]] = None, first_message:int = 0,
+               last_message:Optional[int] = None) -> CanColumns:
+        '''Returns the frames of an inclusive message counter range, optionally filtered by arbitration id'''
+        count = len(self)
+        start = min(max(first_message, 1) - 1, count)
+        stop = count if last_message is None else min(max(last_message, start), count)
+        return self._select_rows(wanted_ids, start, stop)
+
+
+    def select_time_window(self, start_time:float, end_time:float,
+                           wanted_ids:Optional[Iterable[int]] = None) -> CanColumns:
+        '''Returns the frames with start_time <= timestamp <= end_time'''
+        arrays = self.open()
+        timestamps = arrays["timestamp"]
+
+        if "time_order" not in arrays:
+            start = int(numpy.searchsorted(timestamps, start_time, side="left"))
+            stop = int(numpy.searchsorted(timestamps, end_time, side="right"))
+            return self._select_rows(wanted_ids, start, stop)
+
+        # unordered log: binary search over the time sorted view
+        time_order = arrays["time_order"]
+        low, high = 0, len(time_order)
+        while low < high:
+            middle = (low + high) // 2
+            if timestamps[time_order[middle]] < start_time:
+                low = middle + 1
+            else:
+                high = middle
+        first = low
+        low, high = first, len(time_order)
+        while low < high:
+            middle = (low + high) // 2
+            if timestamps[time_order[middle]] <= end_time:
+                low = middle + 1
+            else:
+                high = middle
+
+        rows = numpy.sort(time_order[first:low])
+        if wanted_ids is not None:
+            rows = rows[numpy.isin(arrays["arbitration_id"][rows], list(wanted_ids))]
+        return self._take(rows, None)
+
+
+    def _select_rows(self, wanted_ids, start:int, stop:int) -> CanColumns:
+        arrays = self.open()
+        first_timestamp = float(arrays["timestamp"][start]) if start < stop else None
+
+        if wanted_ids is None:
+            return CanColumns(timestamp=arrays["timestamp"][start:stop],
+                              arbitration_id=arrays["arbitration_id"][start:stop],
+                              dlc=arrays["dlc"][start:stop],
+                              data=arrays["data"][start:stop],
+                              index=numpy.arange(start + 1, stop + 1, dtype=numpy.int64),
+                              first_timestamp=first_timestamp)
+
+        # collect the rows of every wanted id inside the range from the id index
+        id_values = arrays["id_values"]
+        id_offsets = arrays["id_offsets"]
+        id_order = arrays["id_order"]
+        row_groups = []
+        for arbitration_id in wanted_ids:
+            position = int(numpy.searchsorted(id_values, arbitration_id))
+            if position == len(id_values) or id_values[position] != arbitration_id:
+                continue
+            group = id_order[id_offsets[position]:id_offsets[position + 1]]
+            row_groups.append(group[numpy.searchsorted(group, start):numpy.searchsorted(group, stop)])
+
+        rows = numpy.sort(numpy.concatenate(row_groups)) if row_groups else numpy.empty(0, dtype=numpy.int64)
+        return self._take(rows, first_timestamp)
+
+
+    def _take(self, rows, first_timestamp) -> CanColumns:
+        arrays = self.open()
+        return CanColumns(timestamp=arrays["timestamp"][rows],
+                          arbitration_id=arrays["arbitration_id"][rows],
+                          dlc=arrays["dlc"][rows],
+                          data=arrays["data"][rows],
+                          index=rows + 1,
+                          first_timestamp=first_timestamp)
+
+
+    def _read_meta(self) -> dict:
+        '''Content of the meta file, empty if it is missing or can not be parsed (the cache counts as missing)'''
+        if self._meta is None:
+            try:
+                with open(self.meta_file, encoding="ascii") as meta_file:
+                    self._meta = json.load(meta_file)
+            except (OSError, ValueError) as exception:
+                self.logger.warning(f"Trace cache meta file {self.meta_file} ignored: {exception}")
+                return {}
+        return self._meta
+
+
+    def _path(self, name:str, folder:str = None) -> str:
+        return os.path.join(folder if folder else self.cache_folder, name + ".bin")
+
+
+    def _map(self, name:str, count:int, dtype=None, folder:str = None):
+        if dtype is None:
+            dtype, shape = self._columns[name]
+        else:
+            shape = ()
+        if count == 0:
+            return numpy.empty((0,) + shape, dtype=dtype)
+        return numpy.memmap(self._path(name, folder), dtype=dtype, mode="r", shape=(count,) + shape)
@@ -1,8 +1,12 @@
 import statistics
 from typing import List
+import numpy
+from scipy.spatial import cKDTree
 import file_handlers.data_loader as data_loader
-from file_handlers.file_handlers import LocationFileHandler
+from file_handlers.file_handlers import LocationFileHandler, TrajectoryFileHandler, TRAJECTORY_FILE
 from map.postition import Position
+from map.projection import Projection
+from map.spatial_index import SegmentIndex
 from utils.utils import Utils
 
 
@@ -12,17 +16,20 @@ class CompareTraces():
         self.logger = Utils.get_logger()
         self.compare_target = 100
         _, _, _, _, self.trace_folder, self.ground_truth_nodes  = data_loader.get_data(trace_name)
-        self.location_trace=self.trace_folder + "location.log"
+        self.trajectory_file = self.trace_folder + TRAJECTORY_FILE
+        self.frechet_max_points = 2000
+        self.metrics = {}
         
 
     def compare_traces(self):
-        return self.compare_traces_based_on_closest_node()
+        return self.compare_traces_based_on_kdtree()
+        #return self.compare_traces_based_on_closest_node()
         #return self.compare_traces_based_on_fix_number_of_nodes()
 
 
     def compare_traces_based_on_fix_number_of_nodes(self):
         ground_truth_nodes = LocationFileHandler(self.ground_truth_nodes).read_location_file()
-        locations:List[Position] = LocationFileHandler(self.location_trace).read_position_from_location_file()
+        locations:List[Position] = TrajectoryFileHandler(self.trajectory_file).read_positions()
         chosen_ground_throuth_nodes = []
         chosen_locations = []
             
@@ -49,9 +56,10 @@ class CompareTraces():
 
         # calculate distances between chosen locations
         distances = []
+        chosen_ground_throuth_positions = Position.positions_from_nodes(chosen_ground_throuth_nodes)
         counter = 0
-        while counter < len(chosen_ground_throuth_nodes) and counter < len(chosen_locations):
-            distances.append(chosen_locations[counter].distance_from(Position.position_from_node(chosen_ground_throuth_nodes[counter])))
+        while counter < len(chosen_ground_throuth_positions) and counter < len(chosen_locations):
+            distances.append(chosen_locations[counter].distance_from(chosen_ground_throuth_positions[counter]))
             counter +=1
 
         return statistics.mean(distances), statistics.stdev(distances), distances
@@ -60,7 +68,7 @@ class CompareTraces():
     def compare_traces_based_on_closest_node(self):
         ground_truth_nodes = LocationFileHandler(self.ground_truth_nodes).read_location_file()
         chosen_ground_throuth_nodes = []
-        locations:List[Position] = LocationFileHandler(self.location_trace).read_position_from_location_file()
+        locations:List[Position] = TrajectoryFileHandler(self.trajectory_file).read_positions()
             
         # finding 100 points from the ground truth
         ground_truth_step = int(len(ground_truth_nodes) / self.compare_target)
@@ -76,8 +84,7 @@ class CompareTraces():
         chosen_locations = []
 
         # find closest location to every node of the ground truth in the trajectory
-        for node in chosen_ground_throuth_nodes:
-            node_postion = Position.position_from_node(node)
+        for node_postion in Position.positions_from_nodes(chosen_ground_throuth_nodes):
             closest_location = locations[0]
             closest_distance = locations[0].distance_from(node_postion)
 
@@ -93,3 +100,100 @@ class CompareTraces():
         LocationFileHandler(self.trace_folder + "distance_chosen_locations_from_trace.log").write_positions_to_location_file(chosen_locations)
 
         return statistics.mean(distances), statistics.stdev(distances), distances
+
+
+    def compare_traces_based_on_kdtree(self):
+        """
+        Closest trajectory point for every ground truth point, using a KD-tree.
+        Also fills self.metrics with the error distribution, the point to polyline
+        distances and the discrete Frechet distance of the two traces.
+        """
+        ground_truth_x, ground_truth_y = Projection.to_xy_array(*LocationFileHandler(self.ground_truth_nodes).read_coordinates())
+        trajectory = TrajectoryFileHandler(self.trajectory_file).read_columns(("latitude", "longitude", "x", "y"))
+        latitudes, longitudes = trajectory["latitude"], trajectory["longitude"]
+        location_x, location_y = trajectory["x"], trajectory["y"]
+
+        self.metrics, distances, closest = compare_trajectories(ground_truth_x, ground_truth_y, location_x, location_y, self.frechet_max_points)
+        self.logger.debug(f"Ground thruth locations compared. Number of points: {len(distances)}")
+
+        # print the list of chosen points for distance calculation
+        chosen_locations = Position.positions_from_coordinates(longitudes[closest].tolist(), latitudes[closest].tolist())
+        LocationFileHandler(self.trace_folder + "distance_chosen_locations_from_trace.log").write_positions_to_location_file(chosen_locations)
+
+        return self.metrics["closest_point"]["mean"], self.metrics["closest_point"]["std"], distances.tolist()
+
+
+def compare_trajectories(ground_truth_x, ground_truth_y, location_x, location_y, frechet_max_points:int = 2000):
+    """
+    Compare a projected trajectory to the projected ground truth.
+    Returns the metrics, the distance of every ground truth point from its closest location and the index of that location.
+    """
+    distances, closest = cKDTree(numpy.column_stack((location_x, location_y))).query(numpy.column_stack((ground_truth_x, ground_truth_y)))
+    metrics = {
+        "closest_point": error_statistics(distances),
+        "point_to_polyline": error_statistics(point_to_polyline_distances(ground_truth_x, ground_truth_y, location_x, location_y)),
+        "frechet": discrete_frechet_distance(ground_truth_x, ground_truth_y, location_x, location_y, frechet_max_points),
+    }
+    return metrics, distances, closest
+
+
+def error_statistics(distances) -> dict:
+    '''Summary of an error distribution in meters'''
+    distances = numpy.asarray(distances, dtype=numpy.float64)
+    if len(distances) == 0:
+        return {"count": 0}
+
+    percentiles = numpy.percentile(distances, [50, 90, 95, 99])
+    return {
+        "count": int(len(distances)),
+        "mean": float(distances.mean()),
+        "std": float(distances.std(ddof=1)) if len(distances) > 1 else 0.0,
+        "median": float(percentiles[0]),
+        "p90": float(percentiles[1]),
+        "p95": float(percentiles[2]),
+        "p99": float(percentiles[3]),
+        "max": float(distances.max()),
+    }
+
+
+def point_to_polyline_distances(xs, ys, polyline_x, polyline_y):
+    '''Distance of every point from the closest segment of a polyline'''
+    _, distances = SegmentIndex.from_polyline(polyline_x, polyline_y).nearest_segments(xs, ys)
+    return distances
+
+
+def discrete_frechet_distance(first_x, first_y, second_x, second_y, max_points:int = 2000) -> float:
+    """
+    Discrete Frechet distance of two polylines.
+
+    The dynamic programming table is O(N*M), longer polylines are evenly resampled to max_points
+    vertices first. The table is filled by anti-diagonals: a cell depends only on the two previous
+    diagonals, so every diagonal is one vectorized step and only those two are kept in memory.
+    """
+    first = _resample(numpy.column_stack((first_x, first_y)), max_points)
+    second = _resample(numpy.column_stack((second_x, second_y)), max_points)
+    if len(first) == 0 or len(second) == 0:
+        return float('nan')
+
+    # diagonal arrays hold cell (i, s - i) at position i + 1, position 0 and the cells outside the table are inf
+    rows, columns = len(first), len(second)
+    previous = numpy.full(rows + 1, numpy.inf)
+    before_previous = numpy.full(rows + 1, numpy.inf)
+    for diagonal in range(rows + columns - 1):
+        i = numpy.arange(max(0, diagonal - columns + 1), min(diagonal, rows - 1) + 1)
+        j = diagonal - i
+        distances = numpy.hypot(first[i, 0] - second[j, 0], first[i, 1] - second[j, 1])
+        current = numpy.full(rows + 1, numpy.inf)
+        if diagonal == 0:
+            current[1] = distances[0]
+        else:
+            # cell = max(d, min(upper (i - 1, j), left (i, j - 1), diagonal (i - 1, j - 1)))
+            current[i + 1] = numpy.maximum(distances, numpy.minimum(numpy.minimum(previous[i], previous[i + 1]), before_previous[i]))
+        before_previous, previous = previous, current
+    return float(previous[rows])
+
+
+def _resample(points, max_points:int):
+    if len(points) <= max_points:
+        return points
+    return points[numpy.linspace(0, len(points) - 1, max_points).round().astype(numpy.int64)]
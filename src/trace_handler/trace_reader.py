@@ -1,7 +1,14 @@
 '''Trace reader module'''
+import bisect
 import can  # http://skpang.co.uk/blog/archives/1220
+import numpy
 from utils.utils import Utils
-from typing import List
+from utils.profiler import Profiler
+from typing import Iterable, List, Optional
+from trace_handler.can_columns import CanColumns, concatenate_columns, select_messages
+from trace_handler.trace_cache import TraceCache
+from trace_handler.compressed_file import open_trace, detect_codec
+from trace_handler import log_formats
 
 # example lines
 # 1483093132.049669        0380    000    8    30 bb 82 00 9d 53 00 81
@@ -10,21 +17,58 @@ from typing import List
 # timestamp                arb_id  flag   dlc  data
 # arb_id = arbitration_id
 # flag = remote_frame|id_type|error_frame
+#
+# A resume point (message counter, byte offset) means the lines before the byte offset hold exactly
+# that many messages, a run can continue reading there (plain native traces only, see seekable).
+
+
+def latest_resume_point(resume_points, message_index: int):
+    '''The resume point closest before a message (points in file order), None if there is none'''
+    position = bisect.bisect_right([counter for counter, _ in resume_points], message_index)
+    return tuple(resume_points[position - 1]) if position else None
 
 
 class TraceFileReader:
     '''Reades trace data from file'''
-    def __init__(self, file, debug=False):
+    def __init__(self, file, debug=False, use_cache=False, log_format=None):
         self.file_name = file
         self.debug = debug
+        self.use_cache = use_cache  # build the binary cache of the trace if it is missing or outdated
         self.logger = Utils.get_logger()
 
-    def read_line(self):
-        '''Reads one line from file'''
+        # native, candump, asc, blf or trc, detected from the file if not given
+        self.log_format = log_format if log_format is not None else log_formats.detect_format(file)
+        if self.log_format not in log_formats.FORMATS:
+            raise Exception(f"Error: Unknown log format: {self.log_format}")
+
+        self.resume_points = []  # resume points at the chunk starts of the last iter_column_chunks
+        self.message_count = 0  # message counter where the last read_columns / iter_column_chunks stopped
+        self._line_file = None  # file of the running read_line
+
+    def seekable(self) -> bool:
+        '''Reading can start at a resume point (plain native traces)'''
+        return self.log_format == log_formats.NATIVE and detect_codec(self.file_name) is None
+
+    def tell(self) -> Optional[int]:
+        '''Byte offset after the last message of the running read_line, None if the trace is not seekable'''
+        if self._line_file is None or self._line_file.closed or not self.seekable():
+            return None
+        return self._line_file.tell()
+
+    def read_line(self, resume_point: Optional[tuple] = None):
+        '''Reads one line from file, from the byte offset of the resume point if given'''
+        if self.log_format != log_formats.NATIVE:
+            yield from log_formats.read_messages(self.file_name, self.log_format)
+            return
+
         cnt = 0
         error_counter = 0
-        with open(self.file_name, encoding="ascii") as file:
-            for line in file:
+        with open_trace(self.file_name) as file:
+            if resume_point is not None:
+                file.seek(resume_point[1])
+            self._line_file = file
+            # readline keeps tell() usable, iterating the file does not
+            for line in iter(file.readline, ''):
                 cnt += 1
                 try:
                     split_line = line.split()
@@ -45,40 +89,170 @@ class TraceFileReader:
                 
                 except (ValueError, IndexError):
                     error_counter = error_counter + 1
-                    self.logger.debug("Error, unable to parse line #%d (skipping): '%s'" % (cnt, line))
+                    self.logger.debug("Error, unable to parse line #%d (skipping): '%s'", cnt, line)
+
+            self._line_file = None
 
         if error_counter > 0:
+            Profiler.count("parse_errors", error_counter)
             self.logger.error(f"Number of read errors: {error_counter} ")
 
     
-    def read_complete_file(self) -> List[can.Message]:
+    def read_columns(self, wanted_ids: Optional[Iterable[int]] = None, first_message: int = 0,
+                     last_message: Optional[int] = None, chunk_size: int = 1 << 22,
+                     resume_point: Optional[tuple] = None) -> CanColumns:
+        '''
+        Bulk parser: reads the log in large chunks and returns column arrays.
+
+        Only frames with an arbitration id in wanted_ids are kept (all frames if None),
+        other lines are only checked, so the lines read_line skips are not counted. first_message and last_message
+        are inclusive message counters, with the same numbering as read_line.
+        A fresh binary cache of the trace is used instead of the text log when available,
+        otherwise the log is read from the resume point (before first_message) if given.
+        '''
+        cache = TraceCache(self.file_name)
+        if cache.is_fresh() or self.use_cache:
+            if not cache.is_fresh():
+                cache.build(self.iter_column_chunks(chunk_size=chunk_size))
+            self.message_count = len(cache) if last_message is None else min(len(cache), last_message)
+            return cache.select(wanted_ids, first_message, last_message)
+
+        return concatenate_columns(list(self.iter_column_chunks(wanted_ids, first_message, last_message, chunk_size, resume_point)))
+
+
+    def read_time_window(self, start_time: float, end_time: float,
+                         wanted_ids: Optional[Iterable[int]] = None) -> CanColumns:
+        '''Returns the frames in the [start_time, end_time] window using the binary cache'''
+        cache = TraceCache(self.file_name)
+        if not cache.is_fresh():
+            cache.build(self.iter_column_chunks())
+        return cache.select_time_window(start_time, end_time, wanted_ids)
+
+
+    def iter_column_chunks(self, wanted_ids: Optional[Iterable[int]] = None, first_message: int = 0,
+                           last_message: Optional[int] = None, chunk_size: int = 1 << 22,
+                           resume_point: Optional[tuple] = None):
+        '''
+        Parses the log chunk by chunk (from the resume point if given), yields the column arrays of every chunk.
+
+        message_count is the number of messages read when the generator is exhausted, counted like
+        read_line does (at most last_message), whatever the wanted ids.
+        '''
+        self.resume_points = []
+        if self.log_format != log_formats.NATIVE:
+            self.message_count = yield from log_formats.iter_column_chunks(self.file_name, self.log_format, wanted_ids, first_message, last_message, chunk_size)
+            return
+
+        wanted = None if wanted_ids is None else set(wanted_ids)
+        id_tokens = {}  # raw id token -> (arbitration id, wanted)
+        flag_tokens = set()  # flag tokens that parse
+        first_timestamp = None
 
         cnt = 0
-        can_messages = []
+        msg_counter = 0
+        error_counter = 0
+        seekable = self.seekable()
+        position = 0  # byte offset of the next block
+        # blocks of whole lines are read as bytes, the offsets of a text file are not known after readlines
+        with open_trace(self.file_name, binary=True) as file:
+            if resume_point is not None:
+                msg_counter, position = resume_point
+                file.seek(position)
+            while True:
+                if seekable:
+                    self.resume_points.append((msg_counter, position))
+                block = file.read(chunk_size)
+                if not block:
+                    break
+                block += file.readline()
+                position += len(block)
+                text = block.decode("ascii")
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n").replace("\r", "\n")
+                lines = text.split("\n")
+                if not lines[-1]:
+                    lines.pop()
 
-        with open(self.file_name) as f:
-            for line in f:
-                cnt += 1
-                try:
+                timestamps = []
+                arbitration_ids = []
+                dlcs = []
+                indexes = []
+                payload = bytearray()
+                chunk_first_timestamp = None
+
+                for line in lines:
+                    cnt += 1
+                    split_line = line.split()
+                    try:
+                        if len(split_line) < 4:
+                            raise IndexError("Missing columns")
+
+                        id_token = split_line[1]
+                        id_entry = id_tokens.get(id_token)
+                        if id_entry is None:
+                            arbitration_id = int(id_token, 16)
+                            id_entry = (arbitration_id, wanted is None or arbitration_id in wanted)
+                            id_tokens[id_token] = id_entry
 
-                    if line == '\n':
+                        flag_token = split_line[2]
+                        if flag_token not in flag_tokens:
+                            # remote, extended and error flag digits, checked like read_line does
+                            int(flag_token[0]), int(flag_token[1]), int(flag_token[2])
+                            flag_tokens.add(flag_token)
+
+                        # lines of other ids are checked as well, a line read_line skips is not counted
+                        timestamp = float(split_line[0])
+                        dlc = int(split_line[3])
+                        data_tokens = split_line[4:4+dlc]
+                        try:
+                            data = bytes.fromhex(' '.join(data_tokens))
+                        except ValueError:
+                            data = None
+                        if data is None or len(data) != len(data_tokens):
+                            # not only two digit tokens, parsed one by one like read_line does (e.g. '1' or '0x1f')
+                            data = bytes([int(x, 16) for x in data_tokens])
+
+                        if not id_entry[1]:
+                            if first_timestamp is None and msg_counter + 1 >= first_message:
+                                first_timestamp = chunk_first_timestamp = timestamp
+                            msg_counter += 1
+                            continue
+                    except (ValueError, IndexError):
+                        error_counter += 1
+                        self.logger.debug("Error, unable to parse line #%d (skipping): '%s'", cnt, line)
                         continue
 
-                    split_line = line.split(' ')
-                    split_line = [x for x in split_line if x != '']
+                    msg_counter += 1
+                    if msg_counter < first_message:
+                        continue
+                    if first_timestamp is None:
+                        first_timestamp = chunk_first_timestamp = timestamp
 
-                    can_messages.append(can.Message(
-                        msg_id=int(split_line[1], 16),
-                        data=Message.data_str_list_2_int_list(split_line[4:]),
-                        timestamp=float(split_line[0]),
-                        dlc=int(split_line[3]),
-                        is_error_frame=bool(int(split_line[2][2])),
-                        is_remote_frame=bool(int(split_line[2][0])),
-                        is_extended_id=bool(int(split_line[2][1]))
-                    ))
-
-                except IndexError:
-                    self.logger.debug(f"Error, unable to parse line #{cnt} (skipping): '{line}'")
-                    continue
-
-        return can_messages
+                    timestamps.append(timestamp)
+                    arbitration_ids.append(id_entry[0])
+                    dlcs.append(dlc)
+                    indexes.append(msg_counter)
+                    payload += data[:8].ljust(8, b'\x00')
+
+                chunk = CanColumns(timestamp=numpy.array(timestamps, dtype=numpy.float64),
+                                   arbitration_id=numpy.array(arbitration_ids, dtype=numpy.uint32),
+                                   dlc=numpy.array(dlcs, dtype=numpy.uint8),
+                                   data=numpy.frombuffer(bytes(payload), dtype=numpy.uint8).reshape(-1, 8),
+                                   index=numpy.array(indexes, dtype=numpy.int64),
+                                   first_timestamp=chunk_first_timestamp)
+
+                self.message_count = msg_counter if last_message is None else min(msg_counter, last_message)
+                if last_message is not None and msg_counter >= last_message:
+                    yield select_messages(chunk, first_message, last_message)
+                    break
+                yield chunk
+
+        self.message_count = msg_counter if last_message is None else min(msg_counter, last_message)
+        if error_counter > 0:
+            Profiler.count("parse_errors", error_counter)
+            self.logger.error(f"Number of read errors: {error_counter} ")
+
+
+    def read_complete_file(self) -> List[can.Message]:
+        '''Reads every message of the file into a list'''
+        return list(self.read_line())
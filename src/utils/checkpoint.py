@@ -0,0 +1,86 @@
+'''Checkpoints of long runs, resumed without replaying the processed frames'''
+import os
+import re
+import pickle
+from utils.utils import Utils
+from utils.profiler import Profiler
+
+
+class CheckpointStore:
+    """
+    Numbered checkpoints of a run in a folder, one pickle file per checkpoint.
+
+    A checkpoint holds the state after the given message counter of the trace, with the
+    identity of the run (trace file, its size and modification time, message range) so a
+    checkpoint of another trace or of a changed file is never resumed, so the byte offsets of
+    the trace reader in the state stay valid. The newest keep checkpoints are kept, older ones
+    are removed.
+    """
+
+    _pattern = re.compile(r"checkpoint_(\d+)\.pickle$")
+
+    def __init__(self, folder:str, run_identity:dict, keep:int = None) -> None:
+        config = Utils.get_config()
+        self.logger = Utils.get_logger()
+        self.folder = folder
+        self.keep = keep if keep is not None else config.getint("Checkpoint", "keep", fallback=2)
+        self.run_identity = run_identity
+
+
+    @staticmethod
+    def trace_identity(trace_file:str, start_index:int, offset:int) -> dict:
+        '''Identity of a run on a trace, checkpoints are only resumed on the same one'''
+        stat = os.stat(trace_file)
+        return {"trace": os.path.abspath(trace_file), "size": stat.st_size, "mtime": stat.st_mtime,
+                "start_index": start_index, "offset": offset}
+
+
+    def _path(self, message_index:int) -> str:
+        return os.path.join(self.folder, f"checkpoint_{message_index:012d}.pickle")
+
+
+    def indexes(self):
+        '''Message counters of the stored checkpoints in increasing order'''
+        if not os.path.isdir(self.folder):
+            return []
+        matches = (self._pattern.match(file_name) for file_name in os.listdir(self.folder))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+
+    def save(self, message_index:int, state:dict):
+        '''Store the state after the given message, then remove the old checkpoints'''
+        with Profiler.stage("checkpoint"):
+            os.makedirs(self.folder, exist_ok=True)
+            temp_path = self._path(message_index) + ".tmp"
+            with open(temp_path, "wb") as checkpoint_file:
+                pickle.dump({"identity": self.run_identity, "message_index": message_index, "state": state},
+                            checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(message_index))
+
+            for index in self.indexes()[:-self.keep] if self.keep > 0 else []:
+                os.remove(self._path(index))
+        self.logger.debug(f"Checkpoint saved after message {message_index}.")
+
+
+    def latest(self, max_message:int = None):
+        '''(message counter, state) of the newest usable checkpoint at or before max_message, None if there is none'''
+        for index in reversed(self.indexes()):
+            if max_message is not None and index > max_message:
+                continue
+            try:
+                with open(self._path(index), "rb") as checkpoint_file:
+                    checkpoint = pickle.load(checkpoint_file)
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as exception:
+                self.logger.warning(f"Corrupt checkpoint {self._path(index)} skipped: {exception}")
+                continue
+
+            if checkpoint["identity"] != self.run_identity:
+                self.logger.warning(f"Checkpoint {self._path(index)} belongs to another run, skipped.")
+                continue
+            return checkpoint["message_index"], checkpoint["state"]
+        return None
+
+
+    def clear(self):
+        for index in self.indexes():
+            os.remove(self._path(index))
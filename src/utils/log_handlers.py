@@ -0,0 +1,73 @@
+'''Logging building blocks: asynchronous queue handler, sampling of repeated debug records, JSON records'''
+import json
+import copy
+import logging
+import logging.handlers
+
+
+class PreparedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that only merges the message with its arguments in the logging thread.
+
+    The arguments are rendered right away (they may change later, e.g. the position of the car),
+    timestamps and the formatting of the record are left to the handlers of the listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback objects are not kept until the listener formats the record
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through the first and then every n-th debug record of a call site.
+
+    Records of other levels always pass. The number of records dropped since the last one
+    that passed is stored in the suppressed attribute of the record.
+    """
+
+    def __init__(self, every:int) -> None:
+        super().__init__()
+        self.every = max(every, 1)
+        self._counts = {}
+
+
+    def filter(self, record) -> bool:
+        if record.levelno != logging.DEBUG or self.every == 1:
+            return True
+
+        site = (record.pathname, record.lineno)
+        count = self._counts.get(site, 0)
+        self._counts[site] = count + 1
+        if count % self.every:
+            return False
+        record.suppressed = self.every - 1 if count else 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record (time, level, source, message and the extra attributes)'''
+
+    _standard = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+    def format(self, record) -> str:
+        structured = {
+            "time": record.created,
+            "level": record.levelname,
+            "module": record.module,
+            "line": record.lineno,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        structured.update({key: value for key, value in record.__dict__.items() if key not in self._standard})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            structured["exception"] = record.exc_text
+        return json.dumps(structured, default=str)
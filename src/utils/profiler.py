@@ -0,0 +1,99 @@
+'''Stage timers, counters and peak memory of a run'''
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+from utils.utils import Utils
+
+
+class _Stage:
+    '''Timer of one stage, the times are added to the totals of the stage on exit'''
+
+    __slots__ = ("totals", "wall", "cpu")
+
+    def __init__(self, totals:list) -> None:
+        self.totals = totals
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *_):
+        self.totals[0] += 1
+        self.totals[1] += time.perf_counter() - self.wall
+        self.totals[2] += time.process_time() - self.cpu
+        return False
+
+
+class Profiler:
+    """
+    Stage timers and counters of a run, collected in class level state like the config and the logger.
+
+    When disabled stage() returns a shared no-op context and count() returns at once,
+    hot paths check Profiler.enabled before counting.
+    """
+
+    enabled: bool = False
+    stages = {}  # stage name -> [calls, wall time, cpu time]
+    counters = {}
+    start_time: float = time.perf_counter()
+    start_cpu_time: float = time.process_time()
+
+    _disabled_stage = contextlib.nullcontext()
+
+    @classmethod
+    def configure(cls, enabled:bool = None):
+        '''Switch profiling on or off, from the [Profiling] config section if not given'''
+        if enabled is None:
+            enabled = Utils.get_config().getboolean("Profiling", "enabled", fallback=False)
+        cls.enabled = enabled
+        cls.reset()
+
+    @classmethod
+    def reset(cls):
+        cls.stages = {}
+        cls.counters = {}
+        cls.start_time = time.perf_counter()
+        cls.start_cpu_time = time.process_time()
+
+    @classmethod
+    def stage(cls, name:str):
+        '''Context manager timing a stage, nested stages are counted in both'''
+        if not cls.enabled:
+            return cls._disabled_stage
+        totals = cls.stages.get(name)
+        if totals is None:
+            totals = cls.stages[name] = [0, 0.0, 0.0]
+        return _Stage(totals)
+
+    @classmethod
+    def count(cls, name:str, amount:int = 1):
+        if not cls.enabled:
+            return
+        cls.counters[name] = cls.counters.get(name, 0) + amount
+
+    @classmethod
+    def report(cls) -> dict:
+        '''Machine readable summary of the collected values'''
+        report = {
+            "wall_time": time.perf_counter() - cls.start_time,
+            "cpu_time": time.process_time() - cls.start_cpu_time,
+            "stages": {name: {"calls": calls, "wall_time": wall, "cpu_time": cpu}
+                       for name, (calls, wall, cpu) in cls.stages.items()},
+            "counters": dict(cls.counters),
+        }
+        if resource is not None:
+            # peak of the whole process in kilobytes on linux
+            report["peak_memory_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return report
+
+    @classmethod
+    def write_report(cls, file_name:str):
+        with open(file_name, "w") as report_file:
+            json.dump(cls.report(), report_file, indent=2)
@@ -0,0 +1,112 @@
+'''Record of the last run of a trace, an unchanged trace is not processed again'''
+import os
+import json
+import hashlib
+from utils.utils import Utils
+
+# sections of the config that do not change the outputs of a trace
+_IGNORED_SECTIONS = ("Log", "Batch", "Live", "Calibration", "Benchmark", "Catalog", "Checkpoint", "Pipeline", "Profiling")
+
+
+class RunRecord:
+    """
+    Content hash of the inputs of a trace run and the summary of the run, stored in the output folder.
+
+    The fingerprint covers the content of the input files, the config sections that change the
+    outputs, the python sources and the run settings (catalog entry, vehicle parameters). The
+    digest of a file is only computed again if its size or modification time changed since the
+    recorded run.
+    """
+
+    file_name = "run_record.json"
+
+    def __init__(self, output_folder:str) -> None:
+        self.logger = Utils.get_logger()
+        self.path = os.path.join(output_folder, self.file_name)
+        self.output_folder = output_folder
+        self._record = self._load()
+
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as record_file:
+                return json.load(record_file)
+        except (OSError, ValueError) as exception:
+            self.logger.warning(f"Corrupt run record {self.path} ignored: {exception}")
+            return {}
+
+
+    def file_digest(self, file_name:str) -> str:
+        '''sha256 of the content of a file, reused from the record while the file is not modified'''
+        stat = os.stat(file_name)
+        known = self._record.get("files", {}).get(os.path.abspath(file_name))
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+
+        digest = hashlib.sha256()
+        with open(file_name, "rb") as input_file:
+            for block in iter(lambda: input_file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def code_digest() -> str:
+        '''sha256 of the python sources, a run of other code is never reused'''
+        source_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        digest = hashlib.sha256()
+        for folder, folders, files in os.walk(source_root):
+            folders[:] = sorted(name for name in folders if name != "__pycache__")
+            for file_name in sorted(name for name in files if name.endswith(".py")):
+                path = os.path.join(folder, file_name)
+                digest.update(os.path.relpath(path, source_root).encode())
+                with open(path, "rb") as source_file:
+                    digest.update(source_file.read())
+        return digest.hexdigest()
+
+
+    def fingerprint(self, input_files, settings:dict) -> dict:
+        '''Digests of the input files, the config, the code and the settings of a run'''
+        config = Utils.get_config()
+        sections = {name: dict(config[name]) for name in config.sections() if name not in _IGNORED_SECTIONS}
+        files = {}
+        for file_name in input_files:
+            if file_name:
+                stat = os.stat(file_name)
+                files[os.path.abspath(file_name)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                                      "sha256": self.file_digest(file_name)}
+
+        settings_digest = hashlib.sha256(json.dumps({"config": sections, "settings": settings, "code": self.code_digest()}, sort_keys=True, default=str).encode())
+        return {"files": files, "settings": settings_digest.hexdigest()}
+
+
+    @staticmethod
+    def _same(first:dict, second:dict) -> bool:
+        # the modification times do not matter, only the content
+        digests = lambda fingerprint: {name: file["sha256"] for name, file in fingerprint.get("files", {}).items()}
+        return first.get("settings") == second.get("settings") and digests(first) == digests(second)
+
+
+    def previous(self, fingerprint:dict, outputs) -> dict:
+        '''Summary of the recorded run if it had the same fingerprint and its outputs still exist, else None'''
+        if not self._record or not self._same(self._record, fingerprint):
+            return None
+        if not all(os.path.isfile(os.path.join(self.output_folder, output)) for output in outputs):
+            return None
+        return self._record.get("summary")
+
+
+    def invalidate(self):
+        '''Remove the record before the outputs are overwritten, an interrupted run is never reused'''
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+    def save(self, fingerprint:dict, summary:dict):
+        self._record = dict(fingerprint, summary=summary)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as record_file:
+            json.dump(self._record, record_file, indent=2, default=float)
+        os.replace(temp_path, self.path)
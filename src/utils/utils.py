@@ -1,10 +1,15 @@
 import os
 import sys
+import queue
+import atexit
 import logging
+import logging.handlers
+import multiprocessing.util
 import shutil
 import configparser
 
 from typing import  List
+from utils.log_handlers import PreparedQueueHandler, SamplingFilter, JsonFormatter
 
 
 class Utils:
@@ -13,6 +18,7 @@ class Utils:
     """
 
     logger = None
+    log_listener = None
     config = configparser.ConfigParser()
     is_config_loaded: bool = False
 
@@ -22,36 +28,96 @@ class Utils:
             raise Exception("Error: Config not loaded. Logger initialization failed!")
 
         if not cls.logger: 
+            log_config = cls.config['Log']
+            level = logging.getLevelName(log_config.get('level', fallback='DEBUG').upper())
+            if not isinstance(level, int):
+                raise Exception(f"Error: Unknown log level: {log_config.get('level')}")
+
             # create logger with 'can_compressor_logger'
+            # records below the level are dropped before their message is formatted
             cls.logger = logging.getLogger()
-            cls.logger.setLevel(logging.DEBUG)
+            cls.logger.setLevel(level)
 
-            # create file handler which logs even debug messages and separately info messages
-            fh_debug = logging.FileHandler(cls.config['Log']['folder'] + cls.config['Log']['debuglogfilename'], mode='w')
-            fh_debug.setLevel(logging.DEBUG)
+            # create file handler which logs even debug messages (if they are logged at all) and separately info messages
+            handlers = []
+            if level <= logging.DEBUG:
+                fh_debug = logging.FileHandler(log_config['folder'] + log_config['debuglogfilename'], mode='w')
+                fh_debug.setLevel(logging.DEBUG)
+                handlers.append(fh_debug)
             
-            fh_info = logging.FileHandler(cls.config['Log']['folder'] + cls.config['Log']['filename'], mode='w')
+            fh_info = logging.FileHandler(log_config['folder'] + log_config['filename'], mode='w')
             fh_info.setLevel(logging.INFO)
+            handlers.append(fh_info)
+
+            # create formatter and add it to the handlers
+            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+            file_formatter = JsonFormatter() if log_config.get('format', fallback='text') == 'json' else formatter
+            for handler in handlers:
+                handler.setFormatter(file_formatter)
 
             # create console handler with a higher log level
             ch = logging.StreamHandler(sys.stdout)
             ch.setLevel(logging.INFO)
-
-            # create formatter and add it to the handlers
-            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-            fh_debug.setFormatter(formatter)
-            fh_info.setFormatter(formatter)
             ch.setFormatter(formatter)
+            handlers.append(ch)
+
+            debug_sample = log_config.getint('debug_sample', fallback=1)
+            if debug_sample > 1:
+                cls.logger.addFilter(SamplingFilter(debug_sample))
 
-            # add the handlers to the logger
-            cls.logger.addHandler(fh_debug)
-            cls.logger.addHandler(fh_info)
-            cls.logger.addHandler(ch)
+            # add the handlers to the logger, in async mode a listener thread writes the records
+            if log_config.get('mode', fallback='sync') == 'async':
+                records = queue.SimpleQueue()
+                cls.log_listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+                cls.log_listener.start()
+                cls.logger.addHandler(PreparedQueueHandler(records))
+            else:
+                for handler in handlers:
+                    cls.logger.addHandler(handler)
 
             logging.getLogger('matplotlib.font_manager').disabled = True
             
         return cls.logger
 
+    @classmethod
+    def stop_log_listener(cls):
+        """
+        Write the queued records and stop the listener thread of the async mode.
+        """
+        if cls.log_listener:
+            cls.log_listener.stop()
+            for handler in cls.log_listener.handlers:
+                handler.close()
+            cls.log_listener = None
+
+    @classmethod
+    def _restart_log_listener(cls):
+        # a forked process has no listener thread, it gets its own one on a new queue
+        if cls.log_listener:
+            records = queue.SimpleQueue()
+            for handler in cls.logger.handlers:
+                if isinstance(handler, PreparedQueueHandler):
+                    handler.queue = records
+            cls.log_listener = logging.handlers.QueueListener(records, *cls.log_listener.handlers, respect_handler_level=True)
+            cls.log_listener.start()
+
+    @classmethod
+    def redirect_log(cls, folder):
+        """
+        Send the log files to another folder, e.g. one log per trace in the batch worker processes.
+        """
+        if cls.logger:
+            cls.stop_log_listener()
+            for handler in list(cls.logger.handlers):
+                cls.logger.removeHandler(handler)
+                handler.close()
+            for log_filter in list(cls.logger.filters):
+                cls.logger.removeFilter(log_filter)
+            cls.logger = None
+
+        cls.get_config()['Log']['folder'] = folder
+        return cls.get_logger()
+
     @classmethod
     def get_config(cls) -> List:
         if not cls.is_config_loaded:
@@ -83,3 +149,8 @@ class Utils:
                 print("Logger failed. Here is your message:")
                 print(exception)
 
+
+atexit.register(Utils.stop_log_listener)
+os.register_at_fork(after_in_child=Utils._restart_log_listener)
+# worker processes do not run the atexit functions, their queued records are written by a finalizer
+multiprocessing.util.register_after_fork(Utils, lambda _: multiprocessing.util.Finalize(None, Utils.stop_log_listener, exitpriority=100))
@@ -0,0 +1,135 @@
+'''Vectorized dead reckoning of the vehicle model, used when there is no map based correction'''
+import math
+import numpy
+from trace_handler.can_columns import CanColumns
+from map.projection import Projection
+from utils.profiler import Profiler
+
+
+def decode_speeds(data:numpy.ndarray, speed_constant:float) -> numpy.ndarray:
+    '''Speeds in m/s of the speed frames, see Vehicle.update_speed'''
+    speed = (data[:, 1].astype(numpy.int64) << 8) | data[:, 2]
+    return speed / 3.6 / 100 * speed_constant
+
+
+def decode_turn_radiuses(data:numpy.ndarray, stearing_constant:float) -> numpy.ndarray:
+    '''Turn radiuses of the steering frames, see Vehicle.update_heading'''
+    st_pos = (data[:, 2].astype(numpy.int64) << 8) | data[:, 3]
+    st_pos = -numpy.where(data[:, 2] >= 2 ** 7, st_pos - 2 ** 16, st_pos)
+
+    # at most 65536 different positions, math.tan keeps the values of the per message path
+    positions, inverse = numpy.unique(st_pos, return_inverse=True)
+    radiuses = numpy.array([2.7 * math.tan(stearing_constant * position + math.pi/2) for position in positions.tolist()])
+    return radiuses[inverse].reshape(-1)
+
+
+def update_events(timestamps:numpy.ndarray, last_update_time:float, minimum_update_time:float) -> numpy.ndarray:
+    """
+    Frame numbers of the vehicle state updates.
+
+    A frame triggers an update if more than minimum_update_time passed since the previous update,
+    so every update depends on the previous one. With ordered timestamps the next update is found
+    by a binary search, the loop runs once per update instead of once per frame.
+    """
+    count = len(timestamps)
+    events = []
+    last = last_update_time
+
+    if count and numpy.all(timestamps[1:] >= timestamps[:-1]):
+        previous = -1
+        while True:
+            i = int(numpy.searchsorted(timestamps, last + minimum_update_time, side='right'))
+            # the search uses the sum, the model the difference of the times, they can differ in the last bit
+            while i - 1 > previous and timestamps[i - 1] - last > minimum_update_time:
+                i -= 1
+            while i < count and not timestamps[i] - last > minimum_update_time:
+                i += 1
+            if i == count:
+                break
+            events.append(i)
+            previous, last = i, timestamps[i]
+    else:
+        for i, timestamp in enumerate(timestamps.tolist()):
+            if timestamp - last > minimum_update_time:
+                events.append(i)
+                last = timestamp
+
+    return numpy.asarray(events, dtype=numpy.int64)
+
+
+def latest_values(frames:numpy.ndarray, values:numpy.ndarray, events:numpy.ndarray, initial:float) -> numpy.ndarray:
+    '''Value of the last frame at or before every event (initial before the first frame)'''
+    latest = numpy.searchsorted(frames, events, side='right') - 1
+    if len(values) == 0:
+        return numpy.full(len(events), initial, dtype=numpy.float64)
+    return numpy.where(latest >= 0, values[numpy.maximum(latest, 0)], initial)
+
+
+def process_can_columns(car, columns:CanColumns):
+    """
+    Run the vehicle model without map based correction on column arrays.
+
+    Same states as Vehicle.process_can_columns: the signals are sampled at the update frames,
+    the heading and the position are integrated with cumulative sums and the coordinates are
+    converted back in one batch. The vehicle is left in the state of the per message path.
+    """
+    timestamps = numpy.asarray(columns.timestamp, dtype=numpy.float64)
+    arbitration_ids = columns.arbitration_id
+    data = columns.data
+
+    # the first message of the range starts the clock, even if its ID is filtered out
+    if car.last_update_time == 0:
+        if columns.first_timestamp is not None:
+            car.last_update_time = columns.first_timestamp
+        elif len(timestamps):
+            car.last_update_time = float(timestamps[0])
+
+    steering_mask = arbitration_ids == car._steering_pos_id
+    speed_mask = arbitration_ids == car._speed_id
+    used = numpy.flatnonzero(steering_mask | speed_mask)
+
+    steering_frames = numpy.flatnonzero(steering_mask)
+    speed_frames = numpy.flatnonzero(speed_mask)
+    radiuses = decode_turn_radiuses(data[steering_frames], car._vehicle_stearing_constant)
+    speeds = decode_speeds(data[speed_frames], car._vehicle_speed_constant)
+
+    # only the frames of the model can trigger an update
+    events = used[update_events(timestamps[used], car.last_update_time, car.minimum_update_time)]
+    event_times = timestamps[events]
+    previous_times = numpy.concatenate(([car.last_update_time], event_times[:-1]))
+    event_speeds = latest_values(speed_frames, speeds, events, car.speed)
+    event_radiuses = latest_values(steering_frames, radiuses, events, car._turn_radius)
+
+    # standing updates are skipped, the first moving one only sets the reference of the correction
+    moving = event_speeds != 0
+    if car.last_correction_location is None and moving.any():
+        moving[numpy.argmax(moving)] = False
+        car.last_correction_location = car.position.copy()
+
+    delta_distance = event_speeds[moving] * (event_times[moving] - previous_times[moving])
+    delta_heading = (delta_distance * 360) / (2 * event_radiuses[moving] * math.pi)
+    delta_heading[numpy.abs(delta_heading) < car.minimum_heading_correction] = 0
+
+    # the start values are summed first like in the per message path
+    headings = numpy.cumsum(numpy.concatenate(([car.heading], delta_heading)))[1:] % 360
+    radians = numpy.radians(headings)
+    xs = numpy.cumsum(numpy.concatenate(([car.position.x], delta_distance * numpy.cos(radians))))[1:]
+    ys = numpy.cumsum(numpy.concatenate(([car.position.y], delta_distance * numpy.sin(radians))))[1:]
+    latitudes, longitudes = Projection.to_latlon_array(xs, ys)
+
+    car.trajectory.extend(time=event_times[moving], x=xs, y=ys, latitude=latitudes, longitude=longitudes,
+                          heading=headings, speed=event_speeds[moving], map_weight=car.map_position_weight,
+                          start_id=0, end_id=0, state_modified=False)
+    Profiler.count("states", len(xs))
+
+    # final state of the vehicle
+    if len(radiuses):
+        car._turn_radius = float(radiuses[-1])
+    if len(speeds):
+        car.speed = float(speeds[-1])
+    if len(events):
+        car.last_update_time = float(event_times[-1])
+    if len(headings):
+        car.heading = float(headings[-1])
+        car.position.x, car.position.y = float(xs[-1]), float(ys[-1])
+        car.position.latitude, car.position.longitude = float(latitudes[-1]), float(longitudes[-1])
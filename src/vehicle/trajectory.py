@@ -0,0 +1,129 @@
+'''Array backed store of the vehicle states'''
+import numpy
+from map.postition import Position
+
+
+class Trajectory():
+    """
+    Preallocated, growable column store of the vehicle states.
+
+    One row per state update, the capacity is doubled when the arrays are full.
+    """
+
+    columns = {
+        "time": numpy.float64,
+        "x": numpy.float64,
+        "y": numpy.float64,
+        "latitude": numpy.float64,
+        "longitude": numpy.float64,
+        "heading": numpy.float64,
+        "speed": numpy.float64,
+        "map_weight": numpy.float64,
+        "start_id": numpy.int64,
+        "end_id": numpy.int64,
+        "state_modified": numpy.bool_,
+    }
+
+    def __init__(self, capacity:int = 4096):
+        self._size = 0
+        self._capacity = max(capacity, 1)
+        self._data = {name: numpy.zeros(self._capacity, dtype=dtype) for name, dtype in self.columns.items()}
+
+
+    def __len__(self):
+        return self._size
+
+
+    def append(self, time:float, position:Position, heading:float, speed:float, map_weight:float,
+               start_id, end_id, state_modified:bool=False):
+        '''Archive a vehicle state'''
+        if self._size == self._capacity:
+            self._grow(2 * self._capacity)
+
+        i = self._size
+        data = self._data
+        data["time"][i] = time
+        data["x"][i] = position.x
+        data["y"][i] = position.y
+        data["latitude"][i] = position.latitude
+        data["longitude"][i] = position.longitude
+        data["heading"][i] = heading
+        data["speed"][i] = speed
+        data["map_weight"][i] = map_weight
+        data["start_id"][i] = start_id
+        data["end_id"][i] = end_id
+        data["state_modified"][i] = state_modified
+        self._size += 1
+
+
+    def extend(self, **columns):
+        '''Archive many states at once, every column has to be given as an array of the same length'''
+        count = len(columns["time"])
+        if self._size + count > self._capacity:
+            self._grow(max(2 * self._capacity, self._size + count))
+
+        for name in self.columns:
+            self._data[name][self._size:self._size + count] = columns.get(name, 0)
+        self._size += count
+
+
+    def column(self, name:str) -> numpy.ndarray:
+        '''View of the used part of a column'''
+        return self._data[name][:self._size]
+
+
+    def position(self, i:int) -> Position:
+        '''Position of the i-th state'''
+        i = range(self._size)[i]
+        position = Position.__new__(Position)
+        position.x = float(self._data["x"][i])
+        position.y = float(self._data["y"][i])
+        position.latitude = float(self._data["latitude"][i])
+        position.longitude = float(self._data["longitude"][i])
+        return position
+
+
+    def state(self, i:int) -> dict:
+        '''Values of the i-th state'''
+        i = range(self._size)[i]
+        return {name: self._data[name][i].item() for name in self.columns}
+
+
+    def total_distance(self) -> float:
+        '''Length of the trajectory in meters'''
+        if self._size < 2:
+            return 0.0
+        return float(numpy.hypot(numpy.diff(self.column("x")), numpy.diff(self.column("y"))).sum())
+
+
+    def end_distance(self, position:Position) -> float:
+        '''Distance between the last state and a position in meters'''
+        if self._size == 0:
+            return 0.0
+        return float(numpy.hypot(self._data["x"][self._size - 1] - position.x,
+                                 self._data["y"][self._size - 1] - position.y))
+
+
+    def state_line(self, i:int) -> str:
+        '''One line of the location log'''
+        data = self._data
+        return f"Time: {data['time'][i]:.6f} \t Lat:{data['latitude'][i]:.5f} \t Long:{data['longitude'][i]:.5f} \t Heading: {data['heading'][i]:3.5f} \t Speed:{data['speed'][i]:2.5f}\n"
+
+
+    def map_line(self, i:int) -> str:
+        '''State with map details for debugging'''
+        data = self._data
+        return f"Lat:{data['latitude'][i]:.5f} \t Long:{data['longitude'][i]:.5f} \t x:{data['x'][i]} \t y:{data['y'][i]} \t Heading: {data['heading'][i]:3.5f} \t (start: {data['start_id'][i]} end:{data['end_id'][i]}) \t Speed:{data['speed'][i]:2.5f} \t Weight:{data['map_weight'][i]}\n"
+
+
+    def gps_line(self, i:int) -> str:
+        '''Position of the state in the gps log format'''
+        return f"{self._data['latitude'][i]}\t{self._data['longitude'][i]}\n"
+
+
+    def _grow(self, capacity:int):
+        for name, column in self._data.items():
+            grown = numpy.zeros(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._data[name] = grown
+        self._capacity = capacity
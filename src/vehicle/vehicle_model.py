@@ -1,16 +1,34 @@
 import math
-import copy
-from typing import List
 from can import Message
+from trace_handler.can_columns import CanColumns
 from map.map import Map
 from map.postition import Position
+from file_handlers.file_handlers import TrajectoryFileHandler
+from vehicle.trajectory import Trajectory
+from vehicle import dead_reckoning
 from utils.utils import Utils
+from utils.profiler import Profiler
 
 
 class Vehicle():
 
     _speed_id = int('0x410', 16)
     _steering_pos_id = int('0x180', 16)
+    used_arbitration_ids = (_steering_pos_id, _speed_id)  # every other frame is skipped by the model
+
+    # model constants that can be tuned without changing the code (see calibration.py)
+    tunable_parameters = (
+        "_vehicle_stearing_constant",
+        "_vehicle_speed_constant",
+        "minimum_correction_distance",
+        "minimum_update_time",
+        "minimum_heading_correction",
+        # map_position_weight and map_heading_weight are derived from these before every correction
+        "max_map_position_weight",
+        "max_map_heading_weight",
+        "map_max_heading_difference",
+        "max_intersection_distance",
+    )
 
     def __init__(self, start_poition:Position, start_heading:float, trace_file:str):
         self.config = Utils.get_config()
@@ -31,7 +49,8 @@ class Vehicle():
         
         self.trace_file = trace_file
         
-        self.previus_states:List[VehicleState] = []
+        self.trajectory:Trajectory = Trajectory()
+        self.state_listeners = []  # called with the trajectory index of every saved state
         
         # internal parameters of the car
         self._speed_id = int('0x410', 16)
@@ -58,25 +77,92 @@ class Vehicle():
         self.max_intersection_distance = 150 # meters
 
 
+    def set_parameters(self, parameters:dict):
+        """
+        Override model constants, only the ones listed in tunable_parameters are accepted
+        """
+        for name, value in parameters.items():
+            if name not in self.tunable_parameters:
+                raise Exception(f"Unknown vehicle parameter: {name}")
+            setattr(self, name, float(value))
+
+
+    def get_parameters(self) -> dict:
+        return {name: getattr(self, name) for name in self.tunable_parameters}
+
+
+    def get_state(self) -> dict:
+        '''Complete state of the model for a checkpoint, the trajectory included'''
+        return {
+            "parameters": self.get_parameters(),
+            "position": self.position.copy(),
+            "heading": self.heading,
+            "speed": self.speed,
+            "turn_radius": self._turn_radius,
+            "last_update_time": self.last_update_time,
+            "last_correction_location": self.last_correction_location.copy() if self.last_correction_location is not None else None,
+            "map_position_weight": self.map_position_weight,
+            "map_heading_weight": self.map_heading_weight,
+            "trajectory": {name: self.trajectory.column(name).copy() for name in self.trajectory.columns},
+        }
+
+
+    def set_state(self, state:dict):
+        '''Continue from the state of a checkpoint'''
+        self.set_parameters(state["parameters"])
+        self.position = state["position"].copy()
+        self.heading = state["heading"]
+        self.speed = state["speed"]
+        self._turn_radius = state["turn_radius"]
+        self.last_update_time = state["last_update_time"]
+        self.last_correction_location = state["last_correction_location"]
+        self.map_position_weight = state["map_position_weight"]
+        self.map_heading_weight = state["map_heading_weight"]
+        self.trajectory = Trajectory(max(len(state["trajectory"]["time"]), 4096))
+        self.trajectory.extend(**state["trajectory"])
+
+
     def process_can_message(self, msg:Message):
+        return self.process_frame(msg.timestamp, msg.arbitration_id, msg.data)
+
+
+    def process_frame(self, timestamp:float, arbitration_id:int, data):
         # for first iteration
         if self.last_update_time == 0:
-            self.last_update_time = msg.timestamp
+            self.last_update_time = timestamp
 
-        if msg.arbitration_id == self._steering_pos_id:
-            self.update_heading(msg.data)
+        if arbitration_id == self._steering_pos_id:
+            self.update_heading(data)
 
-        elif msg.arbitration_id == self._speed_id:
-            self.update_speed(msg.data)
+        elif arbitration_id == self._speed_id:
+            self.update_speed(data)
 
         else:
             # skip other messages
             return -1
 
         # if enough time passed, update the vehicle position
-        if msg.timestamp - self.last_update_time > self.minimum_update_time:
-            self.update_vehicle_state(msg.timestamp)
-            self.last_update_time = msg.timestamp
+        if timestamp - self.last_update_time > self.minimum_update_time:
+            self.update_vehicle_state(timestamp)
+            self.last_update_time = timestamp
+
+
+    def process_can_columns(self, columns:CanColumns):
+        """
+        Process the column arrays of the bulk trace parser without creating a Message for every frame
+        """
+        # without map based correction the trajectory is integrated in one batch
+        if not self.perform_map_based_correction:
+            dead_reckoning.process_can_columns(self, columns)
+            return
+
+        # the first message of the range starts the clock, even if its ID is filtered out
+        if self.last_update_time == 0 and columns.first_timestamp is not None:
+            self.last_update_time = columns.first_timestamp
+
+        payload = columns.data.tobytes()
+        for i, (timestamp, arbitration_id) in enumerate(zip(columns.timestamp.tolist(), columns.arbitration_id.tolist())):
+            self.process_frame(timestamp, arbitration_id, payload[8*i:8*i+8])
 
 
     def update_heading(self, data):
@@ -127,7 +213,7 @@ class Vehicle():
         
         # if there was no location correction previously
         if self.last_correction_location is None:
-            self.last_correction_location = copy.deepcopy(self.position)
+            self.last_correction_location = self.position.copy()
             return
 
         # calculate movement update parameters
@@ -147,11 +233,13 @@ class Vehicle():
         # if enough movement happened then correct location based on the map
         if self.perform_map_based_correction and self.position.distance_from(self.last_correction_location) > self.minimum_correction_distance:
             self.update_vehicle_state_from_map(current_time)
-            self.last_correction_location = copy.deepcopy(self.position)
-            self.logger.debug(f"State update to ({len(self.previus_states) - 1}): {self}")
+            self.last_correction_location = self.position.copy()
+            if Profiler.enabled:
+                Profiler.count("state_copies")
+            self.logger.debug("State update to (%d): %s", len(self.trajectory) - 1, self)
         else:
             # save current state to archive
-            self.previus_states.append(VehicleState(current_time, self, 0, 0, state_modified=False))
+            self.save_state(current_time, 0, 0, state_modified=False)
 
 
     def update_vehicle_state_from_map(self, current_time):
@@ -171,10 +259,20 @@ class Vehicle():
             if math.fabs(self.heading - edge_bearing) < self.map_max_heading_difference:
                 self.heading = (1.0 - self.map_heading_weight) * self.heading + self.map_heading_weight * edge_bearing
             else:
-                self.logger.debug(f"CRITICAL ERROR: car heading ({self.heading}) and edge heading ({edge_bearing}) mismatch.")
+                self.logger.debug("CRITICAL ERROR: car heading (%s) and edge heading (%s) mismatch.", self.heading, edge_bearing)
 
         # save current state to archive
-        self.previus_states.append(VehicleState(current_time, self, start_id, end_id, state_modified=True))
+        self.save_state(current_time, start_id, end_id, state_modified=True)
+
+
+    def save_state(self, current_time, start_id, end_id, state_modified:bool=False):
+        '''Save the current state to the trajectory archive'''
+        self.trajectory.append(current_time, self.position, self.heading, self.speed, self.map_position_weight,
+                               start_id, end_id, state_modified)
+        if Profiler.enabled:
+            Profiler.count("states")
+        for listener in self.state_listeners:
+            listener(len(self.trajectory) - 1)
 
 
     def update_map_weights(self):
@@ -244,30 +342,14 @@ class Vehicle():
         return f"Vehicle at: ({self.position}) \tspeed: {self.speed:.5f} m/s \theading: {self.heading:.5f}"
 
 
-    def dump_states_to_files(self, location_file):
-        # dump all vehicle states to file
-        location_file = open(location_file, "w")
-        for state in self.previus_states:
-            location_file.write(str(state))
-
-
-class VehicleState():
-
-    def __init__(self, time:float, car:Vehicle, start_id, end_id, state_modified:bool=False):
-        self.time = time
-        self.position = copy.deepcopy(car.position)
-        self.heading = car.heading
-        self.speed = car.speed
-        self.map_weight = car.map_position_weight
-        self.start_id = start_id
-        self.end_id = end_id
-        self.state_modified = state_modified
-
-    def __str__(self):
-        return f"Time: {self.time:.6f} \t Lat:{self.position.latitude:.5f} \t Long:{self.position.longitude:.5f} \t Heading: {self.heading:3.5f} \t Speed:{self.speed:2.5f}\n"
+    def save_trajectory(self, trajectory_file):
+        # binary columnar file of all vehicle states, read by the comparator and the plot
+        TrajectoryFileHandler(trajectory_file).write_trajectory(self.trajectory)
 
-    def map_print(self):
-        return f"Lat:{self.position.latitude:.5f} \t Long:{self.position.longitude:.5f} \t x:{self.position.x} \t y:{self.position.y} \t Heading: {self.heading:3.5f} \t (start: {self.start_id} end:{self.end_id}) \t Speed:{self.speed:2.5f} \t Weight:{self.map_weight}\n"
 
-    def gps_print(self):
-        return f"{self.position.latitude}\t{self.position.longitude}\n"
+    def dump_states_to_files(self, location_file, block_size:int = 1 << 16):
+        # text export of all vehicle states, written in blocks of lines
+        with open(location_file, "w") as location_log:
+            for start in range(0, len(self.trajectory), block_size):
+                end = min(start + block_size, len(self.trajectory))
+                location_log.write(''.join(self.trajectory.state_line(i) for i in range(start, end)))
@@ -0,0 +1,46 @@
+'''Shared fixtures, the modules are imported from src like the scripts do'''
+import os
+import sys
+import gzip
+import random
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from utils.utils import Utils  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def config(tmp_path_factory):
+    '''The config of the repository, the log files are written to a temporary folder'''
+    Utils.config.read(os.path.join(ROOT, "config", "config.ini"))
+    Utils.is_config_loaded = True
+    Utils.redirect_log(str(tmp_path_factory.mktemp("log")) + os.sep)
+    return Utils.config
+
+
+def native_trace_lines(count:int = 300, seed:int = 0) -> list:
+    '''Lines of a native format trace with a few arbitration ids and some lines that do not parse'''
+    generator = random.Random(seed)
+    lines = ["garbage header line\n"]
+    timestamp = 1618473026.0
+    for number in range(count):
+        timestamp += generator.uniform(0.001, 0.01)
+        arbitration_id = generator.choice((0x180, 0x280, 0x380, 0x410, 0x1A0))
+        dlc = generator.randint(0, 8)
+        data = " ".join(f"{generator.randrange(256):02x}" for _ in range(dlc))
+        lines.append(f"{timestamp:.6f}        {arbitration_id:04X}    000    {dlc}    {data}\n")
+        if number % 97 == 50:
+            lines.append(f"{timestamp:.6f}        0180    000    x    00\n")
+    return lines
+
+
+@pytest.fixture(params=["trace.log", "trace.log.gz"])
+def native_trace(request, tmp_path) -> str:
+    '''A small generated trace, plain and gzip compressed'''
+    file_name = str(tmp_path / request.param)
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(file_name, "wt") as trace_file:
+        trace_file.writelines(native_trace_lines())
+    return file_name
@@ -0,0 +1,105 @@
+'''The binary trace cache gives the same frames as the text log and follows its changes'''
+import os
+import multiprocessing
+import pytest
+from trace_handler.trace_cache import TraceCache
+from trace_handler.trace_reader import TraceFileReader
+from test_trace_reader import assert_same_frames, expected_columns
+from conftest import native_trace_lines
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    '''Number of cache builds'''
+    count = []
+    build = TraceCache.build
+    monkeypatch.setattr(TraceCache, "build", lambda self, chunks: (count.append(self.cache_folder), build(self, chunks)))
+    return count
+
+
+@pytest.mark.parametrize("wanted_ids, first_message, last_message", [
+    (None, 0, None),
+    ({0x180, 0x410}, 0, None),
+    ({0x280}, 25, 180),
+])
+def test_cache_matches_read_line(native_trace, builds, wanted_ids, first_message, last_message):
+    messages = list(TraceFileReader(native_trace).read_line())
+
+    columns = TraceFileReader(native_trace, use_cache=True).read_columns(wanted_ids, first_message, last_message, chunk_size=512)
+    assert len(builds) == 1
+    assert TraceCache(native_trace).is_fresh()
+    assert_same_frames(columns, expected_columns(messages, wanted_ids, first_message, last_message))
+    assert columns.first_timestamp == messages[max(first_message, 1) - 1].timestamp
+
+    # a fresh cache is used without use_cache and is not built again
+    reader = TraceFileReader(native_trace)
+    cached = reader.read_columns(wanted_ids, first_message, last_message)
+    assert len(builds) == 1
+    assert reader.message_count == (len(messages) if last_message is None else min(len(messages), last_message))
+    assert_same_frames(cached, expected_columns(messages, wanted_ids, first_message, last_message))
+    assert cached.first_timestamp == columns.first_timestamp
+
+
+def test_time_window(native_trace):
+    messages = list(TraceFileReader(native_trace).read_line())
+    start, end = messages[40].timestamp, messages[120].timestamp
+
+    columns = TraceFileReader(native_trace).read_time_window(start, end, {0x180, 0x380})
+    expected = [(number, message) for number, message in expected_columns(messages, {0x180, 0x380}) if start <= message.timestamp <= end]
+    assert_same_frames(columns, expected)
+
+
+def test_rebuild_after_modification(tmp_path, builds):
+    trace = str(tmp_path / "trace.log")
+    with open(trace, "w") as trace_file:
+        trace_file.writelines(native_trace_lines(200))
+    reader = TraceFileReader(trace, use_cache=True)
+    assert len(reader.read_columns().index) == len(list(reader.read_line()))
+    assert len(builds) == 1
+
+    # same content, the log is newer than the cache
+    trace_time = os.path.getmtime(trace)
+    os.utime(TraceCache(trace).meta_file, (trace_time - 10, trace_time - 10))
+    assert not TraceCache(trace).is_fresh()
+    reader.read_columns()
+    assert len(builds) == 2
+    assert TraceCache(trace).is_fresh()
+
+    # new frames appended
+    with open(trace, "w") as trace_file:
+        trace_file.writelines(native_trace_lines(400))
+    columns = reader.read_columns()
+    assert len(builds) == 3
+    assert_same_frames(columns, expected_columns(list(reader.read_line())))
+
+
+def test_corrupt_meta_is_rebuilt(tmp_path, builds):
+    trace = str(tmp_path / "trace.log")
+    with open(trace, "w") as trace_file:
+        trace_file.writelines(native_trace_lines(100))
+    reader = TraceFileReader(trace, use_cache=True)
+    expected = expected_columns(list(reader.read_line()))
+    reader.read_columns()
+
+    with open(TraceCache(trace).meta_file, "w") as meta_file:
+        meta_file.write('{"version": 1, "cou')
+    assert not TraceCache(trace).is_fresh()
+    assert_same_frames(reader.read_columns(), expected)
+    assert len(builds) == 2
+
+
+def _build_and_count(trace:str) -> list:
+    return TraceFileReader(trace, use_cache=True).read_columns({0x180, 0x280}).index.tolist()
+
+
+def test_concurrent_builds(tmp_path):
+    trace = str(tmp_path / "trace.log")
+    with open(trace, "w") as trace_file:
+        trace_file.writelines(native_trace_lines(5000))
+    expected = [number for number, _ in expected_columns(list(TraceFileReader(trace).read_line()), {0x180, 0x280})]
+
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        results = pool.map(_build_and_count, [trace] * 8)
+    assert all(result == expected for result in results)
+    assert TraceCache(trace).is_fresh()
+    assert sorted(os.listdir(tmp_path)) == ["trace.log", "trace.log.cache"]
@@ -0,0 +1,124 @@
+'''The bulk column parser gives the same frames as read_line'''
+import numpy
+import pytest
+from trace_handler.trace_reader import TraceFileReader, latest_resume_point
+from conftest import native_trace_lines
+
+
+def expected_columns(messages, wanted_ids=None, first_message=0, last_message=None):
+    '''Frames of read_line in a message counter range as (index, message) pairs'''
+    last_message = len(messages) if last_message is None else last_message
+    return [(number, message) for number, message in enumerate(messages, 1)
+            if max(first_message, 1) <= number <= last_message and (wanted_ids is None or message.arbitration_id in wanted_ids)]
+
+
+def assert_same_frames(columns, expected):
+    assert columns.index.tolist() == [number for number, _ in expected]
+    assert columns.timestamp.tolist() == [message.timestamp for _, message in expected]
+    assert columns.arbitration_id.tolist() == [message.arbitration_id for _, message in expected]
+    assert columns.dlc.tolist() == [message.dlc for _, message in expected]
+    payload = [bytes(message.data).ljust(8, b'\x00') for _, message in expected]
+    assert numpy.array_equal(columns.data, numpy.frombuffer(b"".join(payload), dtype=numpy.uint8).reshape(-1, 8))
+
+
+@pytest.mark.parametrize("chunk_size", [256, 1 << 22])
+def test_read_columns_matches_read_line(native_trace, chunk_size):
+    reader = TraceFileReader(native_trace)
+    messages = list(reader.read_line())
+
+    columns = reader.read_columns(chunk_size=chunk_size)
+    assert_same_frames(columns, expected_columns(messages))
+    assert columns.first_timestamp == messages[0].timestamp
+
+
+@pytest.mark.parametrize("wanted_ids, first_message, last_message", [
+    ({0x180, 0x410}, 0, None),
+    ({0x280}, 25, 180),
+    ({0x1A0, 0x380}, 101, 101),
+    ({0x7FF}, 10, 20),
+])
+def test_read_columns_filter_and_range(native_trace, wanted_ids, first_message, last_message):
+    reader = TraceFileReader(native_trace)
+    messages = list(reader.read_line())
+
+    columns = reader.read_columns(wanted_ids, first_message, last_message, chunk_size=512)
+    assert_same_frames(columns, expected_columns(messages, wanted_ids, first_message, last_message))
+    # timestamp of the first message of the range, whatever its arbitration id
+    assert columns.first_timestamp == messages[max(first_message, 1) - 1].timestamp
+    # messages read, the same number in every parsing mode
+    assert reader.message_count == (len(messages) if last_message is None else min(len(messages), last_message))
+
+
+def test_candump_columns_match_read_line(tmp_path):
+    trace = str(tmp_path / "candump.log")
+    with open(trace, "w") as trace_file:
+        for line in native_trace_lines(200):
+            split_line = line.split()
+            if len(split_line) < 4:
+                continue
+            trace_file.write(f"({split_line[0]}) can0 {split_line[1][1:]}#{''.join(split_line[4:])}\n")
+            if split_line[1] == "0180" and split_line[3] == "x":
+                trace_file.write(f"({split_line[0]}) can0 180#0g\n")
+    reader = TraceFileReader(trace)
+    assert reader.log_format == "candump"
+    messages = list(reader.read_line())
+
+    for wanted_ids, first_message, last_message in ((None, 0, None), ({0x280}, 25, 150)):
+        columns = reader.read_columns(wanted_ids, first_message, last_message, chunk_size=512)
+        assert_same_frames(columns, expected_columns(messages, wanted_ids, first_message, last_message))
+        assert columns.first_timestamp == messages[max(first_message, 1) - 1].timestamp
+        assert reader.message_count == (len(messages) if last_message is None else last_message)
+
+
+def test_payload_tokens_parsed_like_read_line(tmp_path):
+    trace = str(tmp_path / "tokens.log")
+    with open(trace, "w") as trace_file:
+        trace_file.write("0.5 0b4 000 2 zz 00\n"
+                         "1.0 0b4 000 2 1 23\n"
+                         "1.5 0b4 000 2 1234 00\n"
+                         "2.0 0b4 000 2 01 23\n"
+                         "3.0 0b4 000 2 0x1 ff\n"
+                         "4.0 0b4 000 2 0a ff\n")
+    reader = TraceFileReader(trace)
+    messages = list(reader.read_line())
+    assert [message.timestamp for message in messages] == [1.0, 2.0, 3.0, 4.0]
+
+    assert_same_frames(reader.read_columns(None), expected_columns(messages))
+    assert_same_frames(reader.read_columns(None, 3), expected_columns(messages, None, 3))
+    assert reader.read_columns(None, 3).first_timestamp == 3.0
+
+
+def test_resume_points(tmp_path):
+    trace = str(tmp_path / "trace.log")
+    with open(trace, "w") as trace_file:
+        trace_file.writelines(native_trace_lines(500))
+    reader = TraceFileReader(trace)
+    assert reader.seekable()
+    messages = list(reader.read_line())
+    wanted_ids = {0x180, 0x410}
+
+    list(reader.iter_column_chunks(wanted_ids, chunk_size=1024))
+    resume_points = reader.resume_points
+    assert len(resume_points) > 5
+    for checkpoint in (0, 1, 137, 250, len(messages) - 1):
+        resume_point = latest_resume_point(resume_points, checkpoint)
+        assert resume_point[0] <= checkpoint
+        columns = reader.read_columns(wanted_ids, checkpoint + 1, chunk_size=1024, resume_point=resume_point)
+        assert_same_frames(columns, expected_columns(messages, wanted_ids, checkpoint + 1))
+        assert columns.first_timestamp == messages[checkpoint].timestamp
+
+    # read_line continues right after the message the offset was taken at
+    lines = reader.read_line()
+    for _ in range(200):
+        next(lines)
+    resume_point = (200, reader.tell())
+    lines.close()
+    resumed = list(reader.read_line(resume_point))
+    assert [message.timestamp for message in resumed] == [message.timestamp for message in messages[200:]]
+
+
+def test_compressed_trace_is_not_seekable(native_trace):
+    reader = TraceFileReader(native_trace)
+    assert reader.seekable() == (not native_trace.endswith(".gz"))
+    list(reader.iter_column_chunks())
+    assert bool(reader.resume_points) == reader.seekable()